@@ -8,6 +8,7 @@ import itertools
 import math
 from abc import ABCMeta, abstractmethod
 from copy import deepcopy
+from collections import deque
 import tempfile
 import time
 import sys
@@ -27,36 +28,28 @@ import joblib
 from finetune.util import list_transpose
 from finetune.encoding.input_encoder import EncodedOutput
 from finetune.config import all_gpus, assert_valid_config, get_default_config
-from finetune.saver import Saver, InitializeHook
+from finetune.saver import Saver, InitializeHook, _atomic_dump
 from finetune.errors import FinetuneError
-from finetune.model import get_model_fn, PredictMode
+from finetune.model import get_model_fn, PredictMode, lm_logit_mask
 from finetune.util.download import download_data_if_required
 from finetune.util.shapes import shape_list
 from finetune.util.timing import ProgressBar
 from finetune.util.in_memory_finetune import make_in_memory_finetune_hooks
 from finetune.util.indico_estimator import IndicoEstimator
+from finetune.util.mapped_weights import dump_weights
+from finetune.util.text_generation import TextGenerator
+from finetune.util.async_utils import default_runner
 from finetune.util.gpu_info import gpu_info
 
 from finetune.base_models.bert.model import _BaseBert
 from finetune.base_models import GPTModel, GPTModelSmall
 from finetune.input_pipeline import InputMode
+from finetune.util.input_utils import restore_order, batch_dataset
+from finetune.util.featurizer_cache import FeaturizerCache, featurizer_cache_key, SHARD_BYTES
 
 LOGGER = logging.getLogger("finetune")
 
 
-def start_end_gen(gen):
-    """
-    yields from generator along with booleans for start and end.
-    """
-    start = True
-    previous = next(gen)
-    for g in gen:
-        yield previous, start, False
-        previous = g
-        start = False
-    yield previous, start, True
-
-
 class BaseModel(object, metaclass=ABCMeta):
     """
     A sklearn-style task agnostic base class for finetuning a Transformer language model.
@@ -142,6 +135,7 @@ class BaseModel(object, metaclass=ABCMeta):
         # state for prediction caching
         self._cached_predict = False
         self._cached_estimator = None
+        self._text_generator = None
 
         try:
             self.estimator_dir = os.path.abspath(
@@ -162,6 +156,8 @@ class BaseModel(object, metaclass=ABCMeta):
             exclude_matches=None if self.config.save_adam_vars else "OptimizeLoss",
             save_dtype=self.config.save_dtype,
             permit_uninitialized=self.config.permit_uninitialized,
+            mmap_weights=self.config.mmap_weights,
+            fallback_cache=getattr(self, "_fallback_cache", None),
         )
 
     def init_from_checkpoint(self, checkpoint_path):
@@ -172,6 +168,7 @@ class BaseModel(object, metaclass=ABCMeta):
             exclude_matches=None if self.config.save_adam_vars else "OptimizeLoss",
             save_dtype=self.config.save_dtype,
             restart_global_step=False,
+            mmap_weights=self.config.mmap_weights,
         )
 
     @abstractmethod
@@ -214,7 +211,10 @@ class BaseModel(object, metaclass=ABCMeta):
                 X=Xs, Y=Y, context=context
             )
             datasets = self.input_pipeline.get_dataset_from_list(
-                zipped_data_list, input_mode=InputMode.TRAIN, update_hook=update_hook
+                zipped_data_list,
+                input_mode=InputMode.TRAIN,
+                update_hook=update_hook,
+                featurizer_outputs=self._featurizer_outputs if self._use_featurizer_cache(Y) else None,
             )
 
         if self.config.keep_best_model:
@@ -273,6 +273,86 @@ class BaseModel(object, metaclass=ABCMeta):
 
         self._trained = True
 
+    def _use_featurizer_cache(self, Y):
+        if self.config.featurizer_cache_dir is None:
+            return False
+        if not self.config.base_model.featurizer_is_frozen(self.config):
+            reason = "the {} featurizer is trained with this config".format(self.config.base_model.__name__)
+        elif Y is None or self.config.lm_loss_coef > 0.0:
+            reason = "a language model loss is trained"
+        elif self.config.use_auxiliary_info:
+            reason = "the featurizer reads auxiliary info"
+        elif self.saver.variables is not None and any(
+            name.startswith("model/featurizer") for name in self.saver.variables
+        ):
+            reason = "the featurizer weights do not come from the base model file"
+        else:
+            return True
+        LOGGER.warning("Not using the featurizer cache, {}.".format(reason))
+        return False
+
+    def _featurizer_outputs(self, token_ids):
+        """
+        The cached featurizer outputs for each array of token ids. Examples missing from the cache are
+        featurized and added to it first.
+        """
+        cache = FeaturizerCache(
+            self.config.featurizer_cache_dir,
+            featurizer_cache_key(self.config, getattr(self.saver, "fallback_filename", None)),
+            max_bytes=self.config.featurizer_cache_max_bytes,
+        )
+        keys = [cache.example_key(tokens) for tokens in token_ids]
+        # Outputs are read as soon as they are available, later writes may evict their shards.
+        outputs = {key: cache.get(key) for key in keys}
+        missing = {key: tokens for key, tokens in zip(keys, token_ids) if outputs[key] is None}
+        LOGGER.info("{} of {} examples are in the featurizer cache.".format(len(keys) - len(missing), len(keys)))
+        if missing:
+            outputs.update(self._cache_featurizer_outputs(cache, missing))
+        LOGGER.info("Featurizer cache stats: {}".format(cache.stats()))
+        return [outputs[key] for key in keys]
+
+    def _cache_featurizer_outputs(self, cache, token_ids):
+        """
+        Featurizes and caches each array of token ids, returning the cached outputs of each.
+        """
+        # sorted by length to minimize padding, shards are flushed every SHARD_BYTES.
+        examples = sorted(token_ids.items(), key=lambda example: len(example[1]))
+        types = {"tokens": tf.int32}
+        shapes = {"tokens": tf.TensorShape([None])}
+        input_fn = batch_dataset(
+            lambda: Dataset.from_generator(
+                lambda: ({"tokens": tokens} for _, tokens in examples), types, shapes
+            ),
+            batch_size=self.config.predict_batch_size,
+            shapes=shapes,
+        )
+        estimator, hooks = self.get_estimator()
+        predictions = estimator.predict(
+            input_fn=input_fn,
+            predict_keys=[PredictMode.FEATURIZE, PredictMode.SEQUENCE, PredictMode.LENGTHS],
+            hooks=hooks,
+        )
+        outputs = dict()
+        pending = dict()
+        pending_bytes = 0
+        for pred, (key, tokens) in zip(
+            ProgressBar(predictions, total=len(examples), desc="Featurizing"), examples
+        ):
+            pending[key] = {
+                "features": pred[PredictMode.FEATURIZE],
+                "sequence_features": pred[PredictMode.SEQUENCE][: len(tokens)],
+                "lengths": pred[PredictMode.LENGTHS],
+            }
+            pending_bytes += sum(value.nbytes for value in pending[key].values())
+            if pending_bytes >= SHARD_BYTES:
+                cache.put(pending)
+                outputs.update((key, cache.get(key)) for key in pending)
+                pending = dict()
+                pending_bytes = 0
+        cache.put(pending)
+        outputs.update((key, cache.get(key)) for key in pending)
+        return outputs
+
     def _distribute_strategy(self, visible_gpus):
         """
         Select a distribution strategy based on available devices.
@@ -391,6 +471,11 @@ class BaseModel(object, metaclass=ABCMeta):
             self._cached_estimator.close_predict()
             self._cached_estimator = None
             gc.collect()
+        if getattr(self, "_text_generator", None) is not None:
+            self._text_generator.close()
+            self._text_generator = None
+        if getattr(self, "input_pipeline", None) is not None:
+            self.input_pipeline.close()
 
     @contextmanager
     def cached_predict(self):
@@ -430,13 +515,18 @@ class BaseModel(object, metaclass=ABCMeta):
         update_hook=None,
         chunked_length=None,
         list_output=True,
+        alignment_sink=None,
     ):
         def get_zipped_data():
             return iter(zipped_data)
 
-        input_fn = self.input_pipeline.get_dataset_from_generator(
-            get_zipped_data, input_mode=InputMode.PREDICT, update_hook=update_hook
-        )["predict_dataset"]
+        datasets = self.input_pipeline.get_dataset_from_generator(
+            get_zipped_data,
+            input_mode=InputMode.PREDICT,
+            update_hook=update_hook,
+            alignment_sink=alignment_sink,
+        )
+        input_fn = datasets["predict_dataset"]
 
         estimator, hooks = self.get_estimator(
             build_explain=PredictMode.EXPLAIN in predict_keys,
@@ -445,24 +535,21 @@ class BaseModel(object, metaclass=ABCMeta):
         length = chunked_length if chunked_length is not None else len(zipped_data)
 
         if self._cached_predict:
-            # Add commonly used (cheap) predict keys to the graph to prevent having to rebuild
-            required_predict_keys = list(
-                {
-                    PredictMode.FEATURIZE,
-                    PredictMode.SEQUENCE,
-                    PredictMode.NORMAL,
-                    PredictMode.PROBAS,
-                }
-                | set(predict_keys or {})
-            )
+            # The cached graph holds every prediction head, only `predict_keys` are fetched.
             prediction_iterator = estimator.cached_predict(
-                input_fn=input_fn, predict_keys=required_predict_keys, hooks=hooks
+                input_fn=input_fn,
+                predict_keys=predict_keys,
+                hooks=hooks,
+                queue_size=self.config.cached_predict_queue_size,
             )
         else:
             prediction_iterator = estimator.predict(
                 input_fn=input_fn, predict_keys=predict_keys, hooks=hooks
             )
 
+        if "predict_order" in datasets:
+            prediction_iterator = restore_order(prediction_iterator, datasets["predict_order"])
+
         predictions = ProgressBar(
             prediction_iterator, total=length, desc="Inference", update_hook=update_hook
         )
@@ -560,17 +647,22 @@ class BaseModel(object, metaclass=ABCMeta):
         These features are the same features that are fed into the target_model.
         """
         zipped_data = self.input_pipeline.zip_list_to_dict(X=Xs, context=context)
+        alignment = deque()
         raw_preds = self._inference(
-            zipped_data, predict_keys=[PredictMode.SEQUENCE], **kwargs
+            zipped_data,
+            predict_keys=[PredictMode.SEQUENCE],
+            alignment_sink=alignment,
+            **kwargs
         )
-        chunk_gens = [self.input_pipeline._text_to_ids(d["X"]) for d in zipped_data]
 
         chunks = []
         chunk_to_seq = []
-        for i, gen in enumerate(chunk_gens):
-            for chunk in gen:
-                chunks.append(chunk)
-                chunk_to_seq.append(i)
+        doc_idx = -1
+        for chunk, start_of_doc, _ in alignment:
+            if start_of_doc:
+                doc_idx += 1
+            chunks.append(chunk)
+            chunk_to_seq.append(doc_idx)
 
         processed_preds = [[] for _ in range(len(zipped_data))]
         for i, pred in enumerate(raw_preds):
@@ -585,6 +677,28 @@ class BaseModel(object, metaclass=ABCMeta):
         processed_preds = [np.asarray(pred) for pred in processed_preds]
         return processed_preds
 
+    async def apredict(self, Xs, *args, timeout=None, **kwargs):
+        """
+        Asyncio version of `predict`. The model runs on a thread shared by all models on the same device, inputs are
+        tokenized on a separate thread beforehand.
+
+        :param timeout: Seconds to wait for the predictions before raising `asyncio.TimeoutError`. A prediction that
+            has already started running is not interrupted.
+        """
+        return await default_runner().run(lambda: self, self.predict, Xs, *args, timeout=timeout, **kwargs)
+
+    async def apredict_proba(self, Xs, *args, timeout=None, **kwargs):
+        """
+        Asyncio version of `predict_proba`, see `apredict`.
+        """
+        return await default_runner().run(lambda: self, self.predict_proba, Xs, *args, timeout=timeout, **kwargs)
+
+    async def afeaturize(self, Xs, *args, timeout=None, **kwargs):
+        """
+        Asyncio version of `featurize`, see `apredict`.
+        """
+        return await default_runner().run(lambda: self, self.featurize, Xs, *args, timeout=timeout, **kwargs)
+
     @classmethod
     def get_eval_fn(cls):
         raise NotImplementedError(
@@ -624,12 +738,22 @@ class BaseModel(object, metaclass=ABCMeta):
         Performs a prediction on the Language modeling objective given some seed text. It uses a noisy greedy decoding.
         Temperature parameter for decoding is set in the config.
         :param max_length: The maximum length to decode to.
-        :param seed_text: Defaults to the empty string. This will form the starting point to begin modelling
-        :return: A string containing the generated text.
+        :param seed_text: Defaults to the empty string. This will form the starting point to begin modelling.
+            A list of seed texts may be given to generate for all of them in batches.
+        :return: A string containing the generated text, or a list of strings if `seed_text` is a list.
         """
         if use_extra_toks is None:
             use_extra_toks = self._trained
 
+        if self.config.base_model.cached_decoder is not None and self.config.cached_text_generation:
+            return self._generate_text_cached(seed_text, max_length, use_extra_toks)
+
+        if not isinstance(seed_text, str):
+            return [
+                self.generate_text(seed, max_length=max_length, use_extra_toks=use_extra_toks)
+                for seed in seed_text
+            ]
+
         def dataset_encoded():
             while not dataset_encoded.finished:
                 yield {"tokens": encoded.token_ids, "length": len(encoded.token_ids)}
@@ -677,6 +801,59 @@ class BaseModel(object, metaclass=ABCMeta):
 
         return self.input_pipeline.text_encoder.decode(encoded.token_ids)
 
+    def _get_text_generator(self):
+        generator = self._text_generator
+        if generator is not None and (
+            generator.variables is not self.saver.variables
+            or generator.temperature != self.config.lm_temp
+            or generator.max_length != self.config.max_length
+        ):
+            # weights or settings baked into the graph have changed since it was built.
+            generator.close()
+            generator = None
+        if generator is None:
+            generator = TextGenerator(
+                decoder=self.config.base_model.cached_decoder,
+                encoder=self.input_pipeline.text_encoder,
+                config=self.config,
+                saver=self.saver,
+                session_config=self._get_estimator_config().session_config,
+            )
+            self._text_generator = generator
+        return generator
+
+    def _generate_text_cached(self, seed_text, max_length, use_extra_toks):
+        text_encoder = self.input_pipeline.text_encoder
+        seed_texts = [seed_text] if isinstance(seed_text, str) else list(seed_text)
+        start = [text_encoder.start_token] if use_extra_toks else []
+        seed_ids = []
+        for text in seed_texts:
+            encoded = text_encoder._encode([text])
+            token_ids = list(encoded.token_ids[0]) if encoded.token_ids else []
+            if not token_ids and not use_extra_toks:
+                raise ValueError(
+                    "If you are not using the extra tokens, you must provide some non-empty seed text"
+                )
+            seed_ids.append(start + token_ids)
+
+        max_total = min(max_length or self.config.max_length, self.config.max_length) - 1
+        # seeds that already fill the context are returned as they are.
+        to_generate = [i for i, ids in enumerate(seed_ids) if len(ids) < max_total]
+        if to_generate:
+            logit_mask = lm_logit_mask(
+                text_encoder.vocab_size + self.config.max_length,
+                text_encoder,
+                mask_extra_toks=not use_extra_toks,
+            )
+            generated = self._get_text_generator().generate(
+                [seed_ids[i] for i in to_generate], max_total, logit_mask
+            )
+            for i, token_ids in zip(to_generate, generated):
+                seed_ids[i] = token_ids
+
+        generated_text = [text_encoder.decode(token_ids) for token_ids in seed_ids]
+        return generated_text[0] if isinstance(seed_text, str) else generated_text
+
     def __getstate__(self):
         """
         Leave serialization of all tf objects to tf
@@ -731,13 +908,18 @@ class BaseModel(object, metaclass=ABCMeta):
             for k, v in self.saver.variables.items()
             if "featurizer" in k and "Adam" not in k
         }
-        joblib.dump(weights_stripped, base_model_path)
+        # Replaced rather than overwritten in place, other processes may have the base model mapped.
+        if self.config.mmap_weights:
+            dump_weights(weights_stripped, base_model_path)
+        else:
+            _atomic_dump(weights_stripped, base_model_path)
 
-    def load(path, *args, **kwargs):
+    def load(path, *args, fallback_cache=None, **kwargs):
         """
         Load a saved fine-tuned model from disk.  Path provided should be a folder which contains .pkl and tf.Saver() files
 
         :param path: string path name to load model from.  Same value as previously provided to :meth:`save`. Must be a folder.
+        :param fallback_cache: A :class:`finetune.saver.FallbackCache` to share base model weights with other loaded models.
         :param **kwargs: key-value pairs of config items to override.
         """
         if type(path) != str and not hasattr(path, "write"):
@@ -775,7 +957,7 @@ class BaseModel(object, metaclass=ABCMeta):
         model.config = model.resolve_config(**model.config)
         model.input_pipeline.config = model.config
         download_data_if_required(model.config.base_model)
-        saver.set_fallback(model.config.base_model_path)
+        model._fallback_cache = fallback_cache
         model._initialize()
         model.saver.variables = saver.variables
         model._trained = True
@@ -899,34 +1081,27 @@ class BaseModel(object, metaclass=ABCMeta):
     def process_long_sequence(self, zipped_data):
         labels, batch_probas = [], []
 
+        # The input pipeline records the (probably chunked) encoded output of each
+        # document here, along with booleans for the start and end of documents,
+        # as it tokenizes them for the model.
+        alignment = deque()
+
         # outputs predictions for each chunk of each document.
         pred_iterator = self._inference(
             zipped_data,
             predict_keys=[PredictMode.PROBAS, PredictMode.NORMAL],
             chunked_length=0,
             list_output=False,
-        )
-
-        # Outputs (probably chunked) Encoded outputs for each document
-        chunk_generator = (
-            self.input_pipeline._text_to_ids(d["X"]) for d in zipped_data
-        )
-
-        # outputs flattened chunk by chunk tokenized outputs
-        # along with booleans for the start and end of documents.
-        chunk_alignment_iterator = (
-            (sample, is_start, is_end)
-            for ae in chunk_generator
-            for sample, is_start, is_end in start_end_gen(ae)
+            alignment_sink=alignment,
         )
 
         # By using iterators it means that we can handle prediction
         # and output processing doc by doc reducing the memory consumption
         # compared to having to hold the tokenized input and per-token
-        # probabilities for the whole dataset.
-        for pred, (arr_enc, start_of_doc, end_of_doc) in zip(
-            pred_iterator, chunk_alignment_iterator
-        ):
+        # probabilities for the whole dataset. A chunk is always encoded
+        # before its prediction is produced so the sink is never behind.
+        for pred in pred_iterator:
+            arr_enc, start_of_doc, end_of_doc = alignment.popleft()
             normal_pred = pred[PredictMode.NORMAL]
             if not hasattr(self, "multi_label"):
                 normal_pred = np.expand_dims(normal_pred, 0)
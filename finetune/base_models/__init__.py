@@ -11,6 +11,10 @@ COMMON_SETTINGS = {
 
 class SourceModel(metaclass=ABCMeta):
     is_bidirectional = True
+    # Optional fn(X, past, encoder, config) used by generate_text to decode incrementally with cached keys and values.
+    cached_decoder = None
+    # Config fields read by the featurizer, the featurizer cache is keyed on their values.
+    featurizer_settings = ("max_length",)
 
     @classmethod
     def get_optimal_params(cls, config):
@@ -41,6 +45,13 @@ class SourceModel(metaclass=ABCMeta):
     def get_featurizer(cls, X, encoder, config, train=False, reuse=None, **kwargs):
         return cls.featurizer(X, encoder, config, train=train, reuse=reuse, **kwargs)
 
+    @classmethod
+    def featurizer_is_frozen(cls, config):
+        """
+        Whether no featurizer variable is trained with `config`, so its outputs only depend on the token ids.
+        """
+        return False
+
     @classmethod
     def translate_base_model_format(cls):
         pass
@@ -61,9 +61,7 @@ class BERTEncoder(BaseEncoder):
         batch_char_ends = []
         batch_char_starts = []
         for i, text in enumerate(texts):
-            subtokens, token_starts, token_ends = self.tokenizer.tokenize(text)
-            subtoken_idxs = self.tokenizer.convert_tokens_to_ids(subtokens)
-            
+            subtokens, subtoken_idxs, token_starts, token_ends = self.tokenizer.tokenize_to_ids(text)
             batch_tokens.append(subtokens)
             batch_token_idxs.append(subtoken_idxs)
             batch_char_ends.append(token_ends)
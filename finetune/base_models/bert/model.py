@@ -67,6 +67,25 @@ DISTIL_BERT_PARAMS = {
 class _BaseBert(SourceModel):
     is_bidirectional = True
     is_roberta = False
+    featurizer_settings = (
+        "n_embed",
+        "n_layer",
+        "n_heads",
+        "bert_intermediate_size",
+        "act_fn",
+        "resid_p_drop",
+        "attn_p_drop",
+        "max_length",
+        "weight_stddev",
+        "low_memory_mode",
+        "context_injection",
+        "reading_order_removed",
+        "anneal_reading_order",
+        "context_channels",
+        "num_layers_trained",
+        "bert_use_pooler",
+        "bert_use_type_embed",
+    )
 
     @classmethod
     def get_optimal_params(cls, config):
@@ -107,6 +126,11 @@ class _BaseBert(SourceModel):
             )
         return overrides
 
+    @classmethod
+    def featurizer_is_frozen(cls, config):
+        # bert_featurizer stops the gradient to all of its outputs when no layers are trained.
+        return config.num_layers_trained == 0 and not config.anneal_reading_order
+
 
 class BERTModelCased(_BaseBert):
     encoder = BERTEncoder
@@ -22,7 +22,6 @@ import collections
 import re
 import unicodedata
 import six
-import numpy as np
 import tensorflow as tf
 
 
@@ -187,25 +186,36 @@ class FullTokenizer(object):
         self.wordpiece_tokenizer = WordpieceTokenizer(vocab=self.vocab)
 
     def tokenize(self, text):
+        split_tokens, _, token_starts, token_ends = self.tokenize_to_ids(text)
+        return split_tokens, token_starts, token_ends
+
+    def tokenize_to_ids(self, text):
+        """
+        Like `tokenize`, but also returns the vocab id of every token. Ids and character offsets are
+        produced in the same pass as the word pieces.
+        """
+        unk_token = self.wordpiece_tokenizer.unk_token
+        unk_id = self.vocab[unk_token]
         split_tokens = []
+        token_ids = []
         token_starts = []
         token_ends = []
 
         for token, token_idx in zip(*self.basic_tokenizer.tokenize(text)):
-            subtokens = self.wordpiece_tokenizer.tokenize(token, token_idx)[0]
-            if subtokens == [self.wordpiece_tokenizer.unk_token]:
-                subtokens = [token] # this will be unked later but it keeps lengths intact
-            split_tokens.extend(subtokens)
-                
-            token_start = token_idx[0]
-            subtoken_ends = (
-                np.cumsum([len(tok.replace("##", "")) for tok in subtokens]) + token_start
-            )
+            pieces = self.wordpiece_tokenizer.encode(token)
+            if pieces is None:
+                # this will be unked but it keeps lengths intact
+                pieces = [(token, self.vocab.get(token, unk_id), len(token.replace("##", "")), len(token))]
 
-            token_ends.extend(subtoken_ends)
-            token_starts.extend([token_start] + subtoken_ends[:-1].tolist())
+            start = token_idx[0]
+            for piece, piece_id, offset_length, _ in pieces:
+                split_tokens.append(piece)
+                token_ids.append(piece_id)
+                token_starts.append(start)
+                start += offset_length
+                token_ends.append(start)
 
-        return split_tokens, token_starts, token_ends
+        return split_tokens, token_ids, token_starts, token_ends
 
     def convert_tokens_to_ids(self, tokens):
         return convert_by_vocab(self.vocab, tokens, unk_token=self.wordpiece_tokenizer.unk_token)
@@ -358,6 +368,65 @@ class WordpieceTokenizer(object):
         self.vocab = vocab
         self.unk_token = unk_token
         self.max_input_chars_per_word = max_input_chars_per_word
+        self._start_trie = None
+        self._continuation_trie = None
+
+    def _build_tries(self):
+        # Prefix tries over the vocab, one for pieces that start a word and one for "##" continuations.
+        # Each node maps a character to its child, a complete piece stores its
+        # (piece, id, offset length) under "".
+        start_trie = dict()
+        continuation_trie = dict()
+        for piece, piece_id in self.vocab.items():
+            entry = (piece, piece_id, len(piece.replace("##", "")))
+            _trie_insert(start_trie, piece, entry)
+            if piece.startswith("##") and len(piece) > 2:
+                _trie_insert(continuation_trie, piece[2:], entry)
+        self._start_trie = start_trie
+        self._continuation_trie = continuation_trie
+
+    def encode(self, word):
+        """Splits a single word into word pieces by greedy longest-match-first.
+
+        Equivalent to probing the vocab with every candidate substring, longest first, but each
+        piece is found with one walk down a prefix trie, without building any substrings.
+
+        Args:
+          word: A single token without whitespace, already passed through `BasicTokenizer`.
+
+        Returns:
+          A list of (piece, id, offset_length, end) tuples, where `offset_length` is the length of
+          the piece without "##" and `end` is the index in `word` after the piece, or None if the
+          word cannot be split into pieces from the vocab.
+        """
+        if self._start_trie is None:
+            self._build_tries()
+        n_chars = len(word)
+        if n_chars > self.max_input_chars_per_word:
+            return None
+
+        pieces = []
+        trie = self._start_trie
+        start = 0
+        while start < n_chars:
+            node = trie
+            match = None
+            i = start
+            while i < n_chars:
+                node = node.get(word[i])
+                if node is None:
+                    break
+                i += 1
+                entry = node.get("")
+                if entry is not None:
+                    match = entry
+                    end = i
+            if match is None:
+                return None
+            pieces.append(match + (end,))
+            trie = self._continuation_trie
+            start = end
+        return pieces
 
     def tokenize(self, text, idxs):
         """Tokenizes a piece of text into its word pieces.
@@ -382,44 +451,28 @@ class WordpieceTokenizer(object):
         output_tokens = []
         output_idxs = []
         for token, idxs in zip(*whitespace_tokenize(text, idxs)):
-            chars = list(token)
-            if len(chars) > self.max_input_chars_per_word:
+            pieces = self.encode(token)
+            if pieces is None:
                 output_tokens.append(self.unk_token)
                 output_idxs.append(idxs)
                 continue
 
-            is_bad = False
             start = 0
-            sub_tokens = []
-            sub_token_idx = []
-            while start < len(chars):
-                end = len(chars)
-                cur_substr = None
-                while start < end:
-                    substr = "".join(chars[start:end])
-                    if start > 0:
-                        substr = "##" + substr
-                    if substr in self.vocab:
-                        cur_substr = substr
-                        break
-                    end -= 1
-                if cur_substr is None:
-                    is_bad = True
-                    break
-                sub_token_idx.append(idxs[start:end])
-                sub_tokens.append(cur_substr)
+            for piece, _, _, end in pieces:
+                output_tokens.append(piece)
+                output_idxs.append(idxs[start:end])
                 start = end
 
-            if is_bad:
-                output_tokens.append(self.unk_token)
-                output_idxs.append(idxs)
-            else:
-                output_tokens.extend(sub_tokens)
-                output_idxs.extend(sub_token_idx)
-
         return output_tokens, output_idxs
 
 
+def _trie_insert(trie, key, entry):
+    node = trie
+    for char in key:
+        node = node.setdefault(char, dict())
+    node[""] = entry
+
+
 def _is_whitespace(char):
     """Checks whether `chars` is a whitespace character."""
     # \t, \n, and \r are technically contorl characters but we treat them
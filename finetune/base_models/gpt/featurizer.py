@@ -10,9 +10,10 @@ from finetune.nn.nn_utils import dropout, norm
 
 
 def mask_attn_weights(w):
-    n = shape_list(w)[-1]
-    b = tf.linalg.band_part(tf.ones([n, n]), -1, 0)
-    b = tf.reshape(b, [1, 1, n, n])
+    # queries are the last nd of the ns positions, nd < ns when attending to cached keys.
+    nd, ns = shape_list(w)[-2:]
+    b = tf.linalg.band_part(tf.ones([nd, ns]), -1, ns - nd)
+    b = tf.reshape(b, [1, 1, nd, ns])
     w = w * b + -1e9 * (1 - b)
     return w
 
@@ -192,6 +193,30 @@ def block(
         return h
 
 
+def cached_block(x, past, n_head, act_fn, scope):
+    """
+    Inference only version of `block` that attends to keys and values cached from previous positions.
+
+    :param past: A tuple of (keys [batch, heads, features, past_length], values [batch, heads, past_length, features])
+        or None.
+    :return: The block output and the updated (keys, values) tuple.
+    """
+    with tf.compat.v1.variable_scope(scope):
+        nx = shape_list(x)[-1]
+        with tf.compat.v1.variable_scope("attn"):
+            q, k, v = multihead_qkv(x, nx, n_head, train=False)
+            if past is not None:
+                k = tf.concat([past[0], k], axis=-1)
+                v = tf.concat([past[1], v], axis=-2)
+            w = attn_weights(q, k, v, scale=True)
+            a = merge_heads(tf.matmul(w, v))
+            a = conv1d(a, "c_proj", nx, 1)
+        n = norm(x + a, "ln_1")
+        m = mlp(n, "mlp", nx * 4, act_fn, resid_pdrop=0.0)
+        h = norm(n + m, "ln_2")
+        return h, (k, v)
+
+
 def embed(X, we):
     return tf.reduce_sum(input_tensor=tf.gather(we, X), axis=2)
 
@@ -328,3 +353,48 @@ def gpt_featurizer(
         if explain:
             out["explain_out"] = explain_out
         return out
+
+
+def gpt_cached_decoder(X, past, encoder, config):
+    """
+    Runs the featurizer over new tokens only, attending to the keys and values cached by previous calls.
+    Used for autoregressive text generation.
+
+    :param X: A tensor of token ids with shape [batch_size, n_new_tokens].
+    :param past: The "past" returned by the previous call, or None for the first call.
+    :param encoder: A TextEncoder object.
+    :param config: A config object, containing all parameters for the featurizer.
+    :return: A dict containing;
+        embed_weights: the word embedding matrix.
+        sequence_features: The output of the featurizer for the new tokens.
+        past: The per-layer keys and values of every position so far.
+    """
+    past_length = 0 if past is None else shape_list(past[0][1])[-2]
+    batch_size, n_new = shape_list(X)
+    pos_values = get_pos_values(n_new, encoder.vocab_size) + past_length
+    X = tf.stack((X, tf.tile(pos_values, [batch_size, 1])), 2)
+
+    with tf.compat.v1.variable_scope("model/featurizer", reuse=tf.compat.v1.AUTO_REUSE):
+        embed_weights = tf.compat.v1.get_variable(
+            name="we",
+            shape=[encoder.vocab_size + config.max_length, config.n_embed],
+            initializer=tf.compat.v1.random_normal_initializer(stddev=config.weight_stddev),
+        )
+        h = embed(X, embed_weights)
+        presents = []
+        for layer in range(config.n_layer):
+            with tf.compat.v1.variable_scope("h%d_" % layer):
+                h, present = cached_block(
+                    h,
+                    None if past is None else past[layer],
+                    n_head=config.n_heads,
+                    act_fn=config.act_fn,
+                    scope="h%d" % layer,
+                )
+            presents.append(present)
+
+        return {
+            "embed_weights": embed_weights,
+            "sequence_features": h,
+            "past": presents,
+        }
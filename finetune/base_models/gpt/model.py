@@ -3,7 +3,7 @@ from urllib.parse import urljoin
 
 from finetune.base_models import SourceModel
 from finetune.base_models.gpt.encoder import GPTEncoder
-from finetune.base_models.gpt.featurizer import gpt_featurizer
+from finetune.base_models.gpt.featurizer import gpt_featurizer, gpt_cached_decoder
 from finetune.util.download import GPT_BASE_URL, FINETUNE_BASE_FOLDER
 
 
@@ -11,6 +11,7 @@ class GPTModel(SourceModel):
     is_bidirectional = False
     encoder = GPTEncoder
     featurizer = gpt_featurizer
+    cached_decoder = gpt_cached_decoder
     settings = {
         'n_embed': 768,
         'n_heads': 12,
@@ -52,7 +52,7 @@ def attention_mask(nd, ns, *, dtype):
     return tf.cast(m, dtype)
 
 
-def attn(x, scope, n_state, *, past, hparams, train=False):
+def attn(x, scope, n_state, *, past, hparams, train=False, return_present=False):
     assert x.shape.ndims == 3  # Should be [batch, sequence, features]
     assert n_state % hparams.n_heads == 0
     if past is not None:
@@ -98,6 +98,8 @@ def attn(x, scope, n_state, *, past, hparams, train=False):
         a = merge_heads(a)
         a = conv1d(a, "c_proj", n_state)
         a = dropout(a, hparams.resid_p_drop, train=train)
+        if return_present:
+            return a, tf.stack([k, v], axis=1)
         return a
 
 
@@ -110,12 +112,18 @@ def mlp(x, scope, n_state, *, hparams, train=False):
         return h2
 
 
-def block(x, *, past, hparams, train=False):
+def block(x, *, past, hparams, train=False, return_present=False):
     nx = x.shape[-1]
-    a = attn(norm(x, "ln_1"), "attn", nx, past=past, hparams=hparams, train=train)
+    a = attn(
+        norm(x, "ln_1"), "attn", nx, past=past, hparams=hparams, train=train, return_present=return_present
+    )
+    if return_present:
+        a, present = a
     x = x + a
     m = mlp(norm(x, "ln_2"), "mlp", nx * 4, hparams=hparams, train=train)
     x = x + m
+    if return_present:
+        return x, present
     return x
 
 
@@ -225,3 +233,48 @@ def gpt2_featurizer(
             "eos_idx": pool_idx,
             "length": lengths
         }
+
+
+def gpt2_cached_decoder(X, past, encoder, config):
+    """
+    Runs the featurizer over new tokens only, attending to the keys and values cached by previous calls.
+    Used for autoregressive text generation.
+
+    :param X: A tensor of token ids with shape [batch_size, n_new_tokens].
+    :param past: The "past" returned by the previous call, or None for the first call.
+    :param encoder: A TextEncoder object.
+    :param config: A config object, containing all parameters for the featurizer.
+    :return: A dict containing;
+        embed_weights: the word embedding matrix.
+        sequence_features: The output of the featurizer for the new tokens.
+        past: The per-layer stacked keys and values, [batch, 2, heads, sequence, features], of every position so far.
+    """
+    past_length = 0 if past is None else shape_list(past[0])[-2]
+    batch_size, n_new = shape_list(X)
+    pos_values = get_pos_values(n_new, encoder.vocab_size) + past_length
+    X = tf.stack((X, tf.tile(pos_values, [batch_size, 1])), 2)
+
+    with tf.compat.v1.variable_scope("model/featurizer", reuse=tf.compat.v1.AUTO_REUSE):
+        embed_weights = tf.compat.v1.get_variable(
+            name="we",
+            shape=[encoder.vocab_size + config.max_length, config.n_embed],
+            initializer=tf.compat.v1.random_normal_initializer(stddev=config.weight_stddev),
+        )
+        h = embed(X, embed_weights)
+        presents = []
+        for layer in range(config.n_layer):
+            with tf.compat.v1.variable_scope("h%d" % layer):
+                h, present = block(
+                    h,
+                    past=None if past is None else past[layer],
+                    hparams=config,
+                    return_present=True,
+                )
+            presents.append(present)
+        h = norm(h, "ln_f")
+
+        return {
+            "embed_weights": embed_weights,
+            "sequence_features": h,
+            "past": presents,
+        }
@@ -125,6 +125,44 @@ class Settings(dict):
     :param max_empty_chunk_ratio: Controls the maximum ratio of empty to labeled chunks for sequence labeling. None includes all chunks, defaults to 1.0.
     :param auto_negative_sampling: Method to use with long sparse documents to cut down on training
         time and limit false positives. Defaults to False
+    :param cached_predict_queue_size: Maximum number of input batches buffered ahead of the model when using cached predict.
+        Batches are streamed from the input pipeline on a background thread rather than materialized up front. Set to 0
+        to tokenize the full dataset before running the model. Defaults to `8`.
+    :param encoding_workers: Number of worker processes used to tokenize documents in the input pipeline. Workers are
+        started with the "spawn" method and each initializes its own text encoder, so this is only worth enabling for large
+        datasets. The workers are kept between calls until the model is closed. Defaults to `0` (tokenize in the main
+        process).
+    :param encoding_workers_min_docs: Inputs with fewer documents than this are tokenized in the main process even if
+        `encoding_workers` is set, as starting the workers would cost more than it saves. Defaults to `128`.
+    :param encoding_lookahead: Maximum number of documents submitted to the encoding workers ahead of the input pipeline.
+        Defaults to `64`.
+    :param encoding_cache_dir: Directory for a persistent cache of tokenized and chunked documents, keyed by a hash of
+        the text, the encoder and its vocab files and the length / chunking settings. It can be shared between processes
+        and runs. Defaults to `None` (no caching).
+    :param encoding_cache_max_bytes: Size above which least recently used entries are evicted from the encoding cache.
+        Defaults to `2 ** 30` (1GB).
+    :param featurizer_cache_dir: Directory for a persistent cache of featurizer outputs, keyed by a hash of the token ids
+        and the base model. Used when training with labels and a featurizer that is entirely frozen, eg. a BERT based model
+        with `num_layers_trained=0`: the featurizer then runs once per example and only the target model is trained on
+        every epoch. It can be shared between processes and runs. The sequence features of every token are stored, which
+        takes `4 * n_embed` bytes per token, about 3KB for BERT base. Defaults to `None` (no caching).
+    :param featurizer_cache_max_bytes: Size above which least recently used shards are evicted from the featurizer
+        cache, across all base models cached in `featurizer_cache_dir`. Defaults to `2 ** 34` (16GB).
+    :param mmap_weights: Save fine-tuned models and base models created with `create_base_model` in a memory-mappable
+        format with one uncompressed array per variable. Variables are then only read from disk when needed and base
+        model weights are shared between processes through the page cache. Both formats can always be loaded.
+        Defaults to `False`.
+    :param beam_search_use_cache: Cache decoder attention keys and values during seq2seq beam search so each step only
+        runs the decoder over the newest position. Defaults to `True`.
+    :param bucket_training_batches: Group training examples of similar token length into the same batch to reduce padding.
+        Examples are shuffled within length buckets and batches are shuffled every epoch, the number of steps per epoch
+        is unchanged. Only applies when training from a list. Defaults to `False`.
+    :param max_tokens_per_batch: If set, prediction batches are formed from inputs of similar token length and capped at
+        this many tokens (batch size times padded length) rather than `predict_batch_size` examples. Lengths are
+        bucketed at powers of two up to `max_length`. Defaults to `None` (fixed size batches).
+    :param cached_text_generation: For base models that support it (GPT and GPT2), `generate_text` keeps a live session
+        and decodes one token at a time against cached attention keys and values, with sampling run inside the graph.
+        Set to `False` to use the estimator based implementation. Defaults to `True`.
     :param max_document_chars: Maximum number of characters in a document before splitting into
         len(document) / max_document_chars "sub documents" for prediction to avoid memory issues
         during creation of the input pipeline. Defaults to None (no splitting)
@@ -210,6 +248,17 @@ def get_default_config():
         xla=False,
         optimize_for="accuracy",
         sort_by_length=True,
+        cached_predict_queue_size=8,
+        encoding_workers=0,
+        encoding_workers_min_docs=128,
+        encoding_lookahead=64,
+        encoding_cache_dir=None,
+        encoding_cache_max_bytes=2 ** 30,
+        featurizer_cache_dir=None,
+        featurizer_cache_max_bytes=2 ** 34,
+        max_tokens_per_batch=None,
+        bucket_training_batches=False,
+        mmap_weights=False,
         collapse_whitespace=False,
         permit_uninitialized=None,
         #
@@ -259,6 +308,7 @@ def get_default_config():
         # Language Model Settings
         lm_loss_coef=0.0,
         lm_temp=0.6,
+        cached_text_generation=True,
         lm_type="lm",
         mask_proba=0.15,
         #
@@ -336,6 +386,7 @@ def get_default_config():
         # T5
         beam_size=1,
         beam_search_alpha=0.2,
+        beam_search_use_cache=True,
         include_bos_eos=True,
         # Serialize finetune version with model
         version=VERSION,
@@ -184,6 +184,65 @@ class OrdinalRegressionEncoder(OrdinalEncoder, BaseEncoder):
         raise ValueError
 
 
+class TokenIndex:
+    """
+    Looks up the tokens a label can overlap without scanning every token for every label.
+
+    Special tokens (start and end of -1) can never overlap a label and are excluded. When the remaining token
+    starts and ends are in increasing order, which holds for all of our encoders, candidates are found by binary
+    search. Otherwise we fall back to scanning the tokens in order.
+    """
+
+    def __init__(self, token_starts, token_ends):
+        self.token_starts = np.asarray(token_starts)
+        self.token_ends = np.asarray(token_ends)
+        real = self.token_ends != -1
+        self.real_idxs = np.flatnonzero(real)
+        self.starts = self.token_starts[real]
+        self.ends = self.token_ends[real]
+        self.sorted = bool(
+            np.all(np.diff(self.starts) >= 0) and np.all(np.diff(self.ends) >= 0)
+        )
+        # Token midpoints, label must extend at least this far for the token to be considered.
+        self.mids = (self.starts + self.ends + 1) // 2
+
+    def candidates(self, label):
+        """
+        Indices of tokens to check against `label`, in order. Equivalent to scanning from the first token
+        and stopping at the first token whose midpoint is beyond the end of the label.
+        """
+        if not self.sorted:
+            for i, (start, end) in enumerate(zip(self.token_starts, self.token_ends)):
+                if label["end"] < (start + end + 1) // 2:
+                    break
+                yield i
+            return
+        # Any overlapping token must end at or after the start of the label.
+        lo = np.searchsorted(self.ends, min(label["start"], label["end"]), side="left")
+        hi = np.searchsorted(self.mids, label["end"], side="right")
+        yield from self.real_idxs[lo:hi].tolist()
+
+    def overlapping(self, label):
+        """
+        Indices of tokens that either start within [start, end) or end within (start, end] of the label.
+        """
+        if not self.sorted:
+            return [
+                i
+                for i, (start, end) in enumerate(zip(self.token_starts, self.token_ends))
+                if label["start"] <= start < label["end"] or label["start"] < end <= label["end"]
+            ]
+        starts_within = self.real_idxs[
+            np.searchsorted(self.starts, label["start"], side="left"):
+            np.searchsorted(self.starts, label["end"], side="left")
+        ]
+        ends_within = self.real_idxs[
+            np.searchsorted(self.ends, label["start"], side="right"):
+            np.searchsorted(self.ends, label["end"], side="right")
+        ]
+        return np.union1d(starts_within, ends_within).tolist()
+
+
 class SequenceLabelingEncoder(BaseEncoder):
 
     def __init__(self, pad_token):
@@ -225,11 +284,11 @@ class SequenceLabelingEncoder(BaseEncoder):
         labels, pad_idx = self.pre_process_label(out, labels)
         labels_out = [pad_idx for _ in out.tokens]
         offset = out.offset or 0
+        token_index = TokenIndex(out.token_starts, out.token_ends)
         for label in labels:
-            for i, (start, end, text) in enumerate(zip(out.token_starts, out.token_ends, out.tokens)):
-                # Label extends less than halfway through token
-                if label["end"] < (start + end + 1) // 2:
-                    break
+            # Only tokens that the label extends at least halfway through
+            for i in token_index.candidates(label):
+                start, end, text = out.token_starts[i], out.token_ends[i], out.tokens[i]
                 overlap, agree = self.overlaps(label, start, end, text, input_text, offset=offset)
                 if overlap:
                     if not agree:
@@ -259,16 +318,20 @@ class SequenceMultiLabelingEncoder(SequenceLabelingEncoder):
     def transform(self, out, labels):
         labels, _ = self.pre_process_label(out, labels)
         labels_out = [[0 for _ in self.classes_] for _ in out.tokens]
-        for i, (start, end) in enumerate(zip(out.token_starts, out.token_ends)):
-            for label in labels:
-                if label["start"] <= start < label["end"] or label["start"] < end <= label["end"]:
-                    if label["label"] not in self.lookup:
-                        LOGGER.warning(
-                            "Attempting to encode unknown labels, ignoring for now but this will likely not "
-                            "result in desirable behaviour"
-                        )
-                    else:
-                        labels_out[i][self.lookup[label["label"]]] = 1
+        token_index = TokenIndex(out.token_starts, out.token_ends)
+        for label in labels:
+            overlapping = token_index.overlapping(label)
+            if not overlapping:
+                continue
+            if label["label"] not in self.lookup:
+                LOGGER.warning(
+                    "Attempting to encode unknown labels, ignoring for now but this will likely not "
+                    "result in desirable behaviour"
+                )
+                continue
+            label_idx = self.lookup[label["label"]]
+            for i in overlapping:
+                labels_out[i][label_idx] = 1
         return labels_out
 
     def inverse_transform(self, y):
@@ -5,7 +5,7 @@ import math
 import os
 import warnings
 from collections.abc import Iterable
-from collections import Counter
+from collections import Counter, deque
 
 from abc import ABCMeta, abstractmethod
 
@@ -21,6 +21,9 @@ import finetune
 from finetune.errors import FinetuneError
 from finetune.encoding.input_encoder import EncodedOutput, tokenize_context
 from finetune.util.imbalance import compute_class_weights
+from finetune.util.parallel_encoding import EncodingPool
+from finetune.util.encoding_cache import EncodingCache, encoding_cache_key
+from finetune.util.featurizer_cache import cached_feature_name, cached_feature_types
 from finetune.util.input_utils import (
     InputMode,
     validation_settings,
@@ -28,6 +31,10 @@ from finetune.util.input_utils import (
     Chunker,
     has_targets,
     batch_dataset,
+    start_end_gen,
+    length_buckets,
+    length_bucketed_epochs,
+    token_budget_dataset,
 )
 
 LOGGER = logging.getLogger("finetune")
@@ -44,6 +51,11 @@ class BasePipeline(metaclass=ABCMeta):
         self._chunker = None
         self.current_epoch_offset = 0
         self.total_epoch_offset = 0
+        self._alignment_sink = None
+        self._pre_encoded = None
+        self._encoding_cache = None
+        self._encoding_pool = None
+        self._pretokenized = None
 
     @property
     def text_encoder(self):
@@ -51,6 +63,37 @@ class BasePipeline(metaclass=ABCMeta):
             self._text_encoder = self.config.base_model.get_encoder(self.config)
         return self._text_encoder
 
+    @property
+    def encoding_cache(self):
+        cache_dir = self.config.encoding_cache_dir
+        if cache_dir is None:
+            return None
+        cache = getattr(self, "_encoding_cache", None)
+        if cache is None or cache.cache_dir != cache_dir:
+            self._encoding_cache = EncodingCache(
+                cache_dir, max_bytes=self.config.encoding_cache_max_bytes
+            )
+        return self._encoding_cache
+
+    def encoding_pool(self, n_workers):
+        """
+        The pool of encoding worker processes, started on first use and kept across calls until the encoding
+        settings change or the pipeline is closed.
+        """
+        pool = getattr(self, "_encoding_pool", None)
+        if pool is not None and not pool.matches(self, n_workers):
+            pool.close()
+            pool = None
+        if pool is None:
+            pool = self._encoding_pool = EncodingPool(self, n_workers)
+        return pool
+
+    def close(self):
+        pool = getattr(self, "_encoding_pool", None)
+        if pool is not None:
+            pool.close()
+            self._encoding_pool = None
+
     @property
     def dataset_size(self):
         return self.config.dataset_size
@@ -115,8 +158,105 @@ class BasePipeline(metaclass=ABCMeta):
             out.append(sample)
         return out
 
+    def _encoded_chunks(self, X, pad_token=None):
+        """
+        Wraps `_text_to_ids`. When a prediction dataset has been given an alignment sink, each chunk
+        is also recorded there as (encoded_output, start_of_doc, end_of_doc) in the order it is fed to
+        the model, so predictions can be mapped back onto the text without encoding it a second time.
+        """
+        pre_encoded = getattr(self, "_pre_encoded", None)
+        if pre_encoded is not None:
+            self._pre_encoded = None
+            out_gen = iter(pre_encoded)
+        else:
+            out_gen = self._cached_text_to_ids(X, pad_token=pad_token)
+        sink = getattr(self, "_alignment_sink", None)
+        if sink is None:
+            yield from out_gen
+            return
+        for out, start_of_doc, end_of_doc in start_end_gen(out_gen):
+            sink.append((out, start_of_doc, end_of_doc))
+            yield out
+
+    def _encoding_pad_token(self):
+        """
+        The pad token that `text_to_tokens_mask` passes to `_text_to_ids`.
+        """
+        return self.config.pad_token
+
+    @staticmethod
+    def _pretokenized_key(X, pad_token):
+        # pad tokens may be unhashable, eg. [pad_token] for multi-label sequence labeling.
+        return repr(X), repr(pad_token)
+
+    def pretokenize(self, Xs):
+        """
+        Encodes documents ahead of a prediction call, eg. while the model is still busy with another request.
+        The next prediction over the same text uses these encodings instead of encoding it again.
+        """
+        pretokenized = getattr(self, "_pretokenized", None)
+        if pretokenized is None:
+            pretokenized = self._pretokenized = dict()
+        pad_token = self._encoding_pad_token()
+        for X in Xs:
+            key = self._pretokenized_key(X, pad_token)
+            pretokenized[key] = list(self._cached_text_to_ids(X, pad_token=pad_token))
+
+    def discard_pretokenized(self, Xs):
+        pretokenized = getattr(self, "_pretokenized", None)
+        if pretokenized:
+            pad_token = self._encoding_pad_token()
+            for X in Xs:
+                pretokenized.pop(self._pretokenized_key(X, pad_token), None)
+
+    def _cached_text_to_ids(self, X, pad_token=None):
+        """
+        `_text_to_ids`, served from the on-disk encoding cache when `config.encoding_cache_dir` is set.
+        """
+        pretokenized = getattr(self, "_pretokenized", None)
+        if pretokenized:
+            encoded = pretokenized.pop(self._pretokenized_key(X, pad_token), None)
+            if encoded is not None:
+                return iter(encoded)
+        cache = self.encoding_cache
+        if cache is None:
+            return self._text_to_ids(X, pad_token=pad_token)
+        key = encoding_cache_key(X, self)
+        input_text = self._format_for_encoding(X)
+        encoded = cache.get(key, input_text=input_text)
+        if encoded is None:
+            encoded = list(self._text_to_ids(X, pad_token=pad_token))
+            cache.put(key, encoded, input_text=input_text)
+        return iter(encoded)
+
+    def _tokenize_documents(self, docs):
+        """
+        Runs `text_to_tokens_mask` over each document. If `config.encoding_workers` is set and there are at
+        least `config.encoding_workers_min_docs` documents, the text encoding for upcoming documents is done in
+        a pool of worker processes while the outputs are consumed here in order.
+        """
+        n_workers = self.config.encoding_workers
+        if n_workers:
+            docs = iter(docs)
+            head = list(itertools.islice(docs, self.config.encoding_workers_min_docs))
+            if len(head) < self.config.encoding_workers_min_docs:
+                n_workers = 0  # too few documents to be worth handing to the workers
+            docs = itertools.chain(head, docs)
+        if not n_workers:
+            for d in docs:
+                yield from self.text_to_tokens_mask(**d)
+            return
+
+        pool = self.encoding_pool(n_workers)
+        for d, encoded in pool.text_to_ids(docs, lookahead=self.config.encoding_lookahead):
+            self._pre_encoded = encoded
+            try:
+                yield from self.text_to_tokens_mask(**d)
+            finally:
+                self._pre_encoded = None
+
     def text_to_tokens_mask(self, X, Y=None, context=None):
-        out_gen = self._text_to_ids(X, pad_token=self.config.pad_token)
+        out_gen = self._encoded_chunks(X, pad_token=self._encoding_pad_token())
         for i, out in enumerate(out_gen):
             if context is None:
                 feats = {"tokens": out.token_ids}
@@ -183,10 +323,15 @@ class BasePipeline(metaclass=ABCMeta):
 
         return dataset_fn
 
-    def get_dataset_from_generator(self, generator_fn, input_mode, update_hook=None):
+    def get_dataset_from_generator(
+        self, generator_fn, input_mode, update_hook=None, alignment_sink=None
+    ):
         def chunked_and_tokenized_dataset():
-            for d in generator_fn():
-                yield from self.text_to_tokens_mask(**d)
+            self._alignment_sink = alignment_sink
+            try:
+                yield from self._tokenize_documents(generator_fn())
+            finally:
+                self._alignment_sink = None
 
         types, shapes = self.feed_shape_type_def()
 
@@ -207,6 +352,21 @@ class BasePipeline(metaclass=ABCMeta):
             shapes=shapes,
             skip_val=input_mode == InputMode.TRAIN,
         )
+        if input_mode == InputMode.PREDICT and self.config.max_tokens_per_batch:
+            # batches are grouped by length, predictions are put back in order using "predict_order".
+            predict_order = deque()
+            return {
+                "predict_dataset": token_budget_dataset(
+                    chunked_and_tokenized_dataset,
+                    types=types,
+                    shapes=shapes,
+                    max_tokens=self.config.max_tokens_per_batch,
+                    boundaries=length_buckets(self.config.max_length),
+                    order_sink=predict_order,
+                ),
+                "predict_order": predict_order,
+            }
+
         if input_mode == InputMode.PREDICT:
             return {
                 "predict_dataset": batch_dataset(
@@ -272,7 +432,37 @@ class BasePipeline(metaclass=ABCMeta):
             ),
         }
 
-    def get_dataset_from_list(self, data_list, input_mode, update_hook=None):
+    def _add_featurizer_outputs(self, splits, featurizer_outputs):
+        """
+        Adds the cached featurizer outputs of every example to its features, see `finetune.util.featurizer_cache`.
+
+        :param splits: Lists of (features, target) tuples.
+        :param featurizer_outputs: Function from a list of token id arrays to the cached outputs of each.
+        :return: The updated splits, and the types and shapes of the added features.
+        """
+        examples = [example for split in splits for example in split]
+        if not examples:
+            return splits, {}, {}
+        outputs = featurizer_outputs([feats["tokens"] for feats, _ in examples])
+        types, shapes = cached_feature_types(outputs[0])
+        outputs = iter(outputs)
+        splits = [
+            [
+                (
+                    {**feats, **{cached_feature_name(name): value for name, value in next(outputs).items()}},
+                    target,
+                )
+                for feats, target in split
+            ]
+            for split in splits
+        ]
+        return splits, types, shapes
+
+    def get_dataset_from_list(self, data_list, input_mode, update_hook=None, featurizer_outputs=None):
+        """
+        :param featurizer_outputs: Optional function from a list of token id arrays to their cached featurizer
+            outputs, which are then fed to the model instead of running the featurizer.
+        """
         assert input_mode == InputMode.TRAIN, "use the generator path for prediction"
 
         data_list = list(data_list)
@@ -294,19 +484,14 @@ class BasePipeline(metaclass=ABCMeta):
             train_split = dataset_shuffle(data_list, random_state=self.config.seed)
             val_split = self.config.val_set or []
 
-        tokenized_train_split = list(
-            itertools.chain.from_iterable(
-                self.text_to_tokens_mask(**d) for d in train_split
-            )
-        )
+        tokenized_train_split = list(self._tokenize_documents(train_split))
 
         self.config.dataset_size = len(tokenized_train_split)
 
-        tokenized_val_split = list(
-            itertools.chain.from_iterable(
-                self.text_to_tokens_mask(**d) for d in val_split
-            )
-        )
+        tokenized_val_split = list(self._tokenize_documents(val_split))
+
+        if self.encoding_cache is not None:
+            LOGGER.info("Encoding cache stats: {}".format(self.encoding_cache.stats()))
 
         if self.config.class_weights is not None:
             class_counts = self._compute_class_counts(tokenized_train_split)
@@ -318,9 +503,29 @@ class BasePipeline(metaclass=ABCMeta):
         if not has_targets(lambda: tokenized_train_split):
             types = types[0]
             shapes = shapes[0]
+        elif featurizer_outputs is not None:
+            if shapes[0]["tokens"].rank == 1:
+                splits, cached_types, cached_shapes = self._add_featurizer_outputs(
+                    [tokenized_train_split, tokenized_val_split], featurizer_outputs
+                )
+                tokenized_train_split, tokenized_val_split = splits
+                types = ({**types[0], **cached_types}, types[1])
+                shapes = ({**shapes[0], **cached_shapes}, shapes[1])
+            else:
+                LOGGER.warning("The featurizer cache is not supported for inputs with more than one sequence")
+
+        if self.config.bucket_training_batches:
+            train_data_fn = length_bucketed_epochs(
+                tokenized_train_split,
+                batch_size=self.config.batch_size,
+                boundaries=length_buckets(self.config.max_length),
+                seed=self.config.seed,
+            )
+        else:
+            train_data_fn = lambda: tokenized_train_split
 
         train_dataset_unbatched = self.make_dataset_fn(
-            data_fn=lambda: tokenized_train_split,
+            data_fn=train_data_fn,
             tqdm_mode="train",
             update_hook=update_hook,
             types=types,
@@ -426,5 +631,11 @@ class BasePipeline(metaclass=ABCMeta):
     def __getstate__(self):
         state = self.__dict__.copy()
         del state["_text_encoder"]
+        # transient state that is only valid while a dataset is being generated
+        state["_alignment_sink"] = None
+        state["_pre_encoded"] = None
+        state["_encoding_cache"] = None
+        state["_encoding_pool"] = None
+        state["_pretokenized"] = None
         return state
 
@@ -10,6 +10,7 @@ from finetune.util.text_generation import sample_with_temperature
 from finetune.util.optimize_loss import optimize_loss
 
 from finetune.util.imbalance import class_weight_tensor
+from finetune.util.featurizer_cache import cached_featurizer_state
 from finetune.errors import FinetuneError
 from finetune.base_models import GPTModel, GPTModelSmall
 
@@ -27,6 +28,7 @@ class PredictMode:
     ASSOCIATION = "ASSOCIATION"
     ASSOCIATION_PROBAS = "ASSOCIATION_PROBA"
     EXPLAIN = "EXPLAIN"
+    LENGTHS = "LENGTHS"
 
 def fp16_variable_getter(getter, name, shape=None, dtype=None,
                          initializer=None, regularizer=None,
@@ -39,6 +41,20 @@ def fp16_variable_getter(getter, name, shape=None, dtype=None,
                       *args, **kwargs)
 
 
+def lm_logit_mask(n_logits, encoder, mask_extra_toks):
+    """
+    A [1, n_logits] mask to add to language model logits. Removes the positional embeddings that share the
+    tied embedding matrix and, if `mask_extra_toks`, the start, delimiter and end tokens.
+    """
+    mask = np.zeros([1, n_logits], dtype=np.float32)
+    mask[:, encoder.vocab_size :] = -np.inf
+    if mask_extra_toks:
+        mask[:, encoder.start_token] = -np.inf
+        mask[:, encoder.delimiter_token] = -np.inf
+        mask[:, encoder.end_token] = -np.inf
+    return mask
+
+
 def language_model_op(X, params, featurizer_state, mode, encoder):
     language_model_state = language_model(
         X=X,
@@ -51,18 +67,10 @@ def language_model_op(X, params, featurizer_state, mode, encoder):
     lm_logits = language_model_state["logits"]
 
     if lm_logits is not None:
-
-        lm_logit_mask = np.zeros(
-            [1, lm_logits.get_shape().as_list()[-1]], dtype=np.float32
-        )
-        lm_logit_mask[:, encoder.vocab_size :] = -np.inf
-
         if "use_extra_toks" in params and not params.use_extra_toks:
-            lm_logit_mask[:, encoder.start_token] = -np.inf
-            lm_logit_mask[:, encoder.delimiter_token] = -np.inf
-            lm_logit_mask[:, encoder.end_token] = -np.inf
-
-            lm_logits += lm_logit_mask
+            lm_logits += lm_logit_mask(
+                lm_logits.get_shape().as_list()[-1], encoder, mask_extra_toks=True
+            )
         lm_predict_op = sample_with_temperature(lm_logits, params.lm_temp)
     else:
         lm_predict_op = tf.no_op()
@@ -171,20 +179,25 @@ def get_model_fn(
             
         with tf.compat.v1.variable_scope(tf.compat.v1.get_variable_scope(), custom_getter=var_getter):
             train_loss = 0.0
-            featurizer_state = params.base_model.get_featurizer(
-                X,
-                encoder=encoder,
-                config=params,
-                train=train,
-                explain=build_explain,
-                context=context,
-                total_num_steps=total_num_steps,
-                lengths=features["length"]
-            )
+            # Inputs from the featurizer cache already hold the outputs of the frozen featurizer.
+            featurizer_state = cached_featurizer_state(features)
+            if featurizer_state is None:
+                featurizer_state = params.base_model.get_featurizer(
+                    X,
+                    encoder=encoder,
+                    config=params,
+                    train=train,
+                    explain=build_explain,
+                    context=context,
+                    total_num_steps=total_num_steps,
+                    lengths=features["length"]
+                )
             predictions = {
                 PredictMode.FEATURIZE: featurizer_state["features"], 
                 PredictMode.SEQUENCE: featurizer_state["sequence_features"]
             }
+            if "lengths" in featurizer_state:
+                predictions[PredictMode.LENGTHS] = featurizer_state["lengths"]
 
             if params.base_model in [GPTModel, GPTModelSmall]:
                 predictions[PredictMode.ATTENTION] = featurizer_state[
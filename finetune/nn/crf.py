@@ -37,6 +37,54 @@ def viterbi_decode(score, transition_params):
     return viterbi, np_softmax(trellis, axis=-1)
 
 
+def viterbi_decode_batch(scores, transition_params, sequence_lengths=None):
+    """Decode the highest scoring sequence of tags for a whole batch outside of TensorFlow.
+    Equivalent to running `viterbi_decode` on each sequence truncated to its length, but each
+    timestep is processed for the whole batch at once.
+    Args:
+        scores: A [batch_size, seq_len, num_tags] array of unary potentials.
+        transition_params: A [num_tags, num_tags] matrix of binary potentials.
+        sequence_lengths: A [batch_size] array of sequence lengths. Defaults to seq_len for all sequences.
+    Returns:
+        viterbi: A [batch_size, seq_len] int32 array of the highest scoring tag indices.
+            Positions past the end of a sequence repeat its final tag.
+        viterbi_probas: A [batch_size, seq_len, num_tags] float32 array, the softmax of the trellis.
+    """
+    batch_size, seq_len, num_tags = scores.shape
+    if sequence_lengths is None:
+        sequence_lengths = np.full([batch_size], seq_len)
+    sequence_lengths = np.asarray(sequence_lengths).reshape([batch_size])
+    if seq_len == 0:
+        return np.zeros([batch_size, 0], dtype=np.int32), scores.astype(np.float32)
+
+    trellis = np.zeros_like(scores)
+    # Past the end of a sequence the trellis is carried forward and the backpointers
+    # are the identity, so backtracking from the last timestep passes straight through.
+    backpointers = np.broadcast_to(
+        np.arange(num_tags, dtype=np.int32), scores.shape
+    ).copy()
+    trellis[:, 0] = scores[:, 0]
+
+    max_length = max(1, min(seq_len, int(np.max(sequence_lengths, initial=0))))
+    for t in range(1, max_length):
+        active = t < sequence_lengths
+        # [batch_size, from_tag, to_tag]
+        v = np.expand_dims(trellis[:, t - 1], 2) + transition_params
+        best = np.argmax(v, 1)
+        best_v = np.take_along_axis(v, np.expand_dims(best, 1), 1)[:, 0]
+        trellis[:, t] = np.where(active[:, None], scores[:, t] + best_v, trellis[:, t - 1])
+        backpointers[active, t] = best[active]
+    trellis[:, max_length:] = trellis[:, max_length - 1 : max_length]
+
+    viterbi = np.zeros([batch_size, seq_len], dtype=np.int32)
+    viterbi[:, -1] = np.argmax(trellis[:, -1], -1)
+    batch_idx = np.arange(batch_size)
+    for t in range(seq_len - 1, 0, -1):
+        viterbi[:, t - 1] = backpointers[batch_idx, t, viterbi[:, t]]
+
+    return viterbi, np_softmax(trellis, axis=-1).astype(np.float32)
+
+
 def sequence_decode(logits, transition_matrix, sequence_length, use_gpu_op, use_crf):
     """ A simple py_func wrapper around the Viterbi decode allowing it to be included in the tensorflow graph. """
     if not use_crf:
@@ -51,13 +99,13 @@ def sequence_decode(logits, transition_matrix, sequence_length, use_gpu_op, use_
         probs = tf.nn.softmax(logits, -1)
         return tags, probs
     else:
-        def _sequence_decode(logits, transition_matrix):
-            all_predictions = []
-            all_logits = []
-            for logit in logits:
-                viterbi_sequence, viterbi_logits = viterbi_decode(logit, transition_matrix)
-                all_predictions.append(viterbi_sequence)
-                all_logits.append(viterbi_logits)
-            return np.array(all_predictions, dtype=np.int32), np.array(all_logits, dtype=np.float32)
-        
-        return tf.compat.v1.py_func(_sequence_decode, [logits, transition_matrix], [tf.int32, tf.float32])
+        if sequence_length is None:
+            sequence_length = tf.fill(tf.shape(input=logits)[:1], tf.shape(input=logits)[1])
+        tags, probs = tf.compat.v1.py_func(
+            viterbi_decode_batch,
+            [logits, transition_matrix, sequence_length],
+            [tf.int32, tf.float32],
+        )
+        tags.set_shape(logits.shape[:-1])
+        probs.set_shape(logits.shape)
+        return tags, probs
@@ -1,68 +1,172 @@
+import logging
+
+import numpy as np
 import tensorflow as tf
+from tensorflow.python.distribute import distribution_strategy_context as distribute_ctx
+from tensorflow.python.distribute import values as distribute_values
+from tensorflow.python.ops import resource_variable_ops
+
+LOGGER = logging.getLogger("finetune")
+
+
+def _accumulate(accumulator, grad):
+    # Works on the handle so that, in a replica context, only this replica's copy of the accumulator is updated.
+    if isinstance(grad, tf.IndexedSlices):
+        return resource_variable_ops.resource_scatter_add(accumulator.handle, grad.indices, grad.values)
+    return resource_variable_ops.assign_add_variable_op(accumulator.handle, grad)
+
 
-from finetune.errors import FinetuneError
+def _group_replicas(distribution, per_replica_op):
+    return tf.group(*distribution.experimental_local_results(per_replica_op))
 
 
 def get_grad_accumulation_optimizer(optimizer_class, accum_steps):
     """
     Adds gradient accumulation to an Optimizer.
 
-    Unlike most optimizers, this will create a global step if one does not already exist.
-    This optimizer also increments this global step automatically, whether a step is passed or not.
+    Gradients are summed into one accumulator per variable and applied once every `accum_steps` calls to
+    `apply_gradients`. Sparse gradients, eg. for embeddings, are scattered into their accumulator rather than
+    densified on every step. Under a `MirroredStrategy` each replica sums its own gradients, which are only
+    reduced across replicas when they are applied. Under a `CentralStorageStrategy` the replicas add into shared
+    accumulators.
 
-    :param optimizer_class: A subclass of tf.train.Optimizer to add gradient accumulation too.
+    If a global step is passed to `apply_gradients` it is incremented on every call, as with other optimizers,
+    whether or not the accumulated gradients are applied.
+
+    :param optimizer_class: A subclass of tf.compat.v1.train.Optimizer to add gradient accumulation to.
     :param accum_steps: An int value determining how many gradients to accumulate before performing an optimizer step.
 
-    :return: A new Optimizer, with gradient accumulation.
+    :return: A new Optimizer, with gradient accumulation. Its `accumulator_bytes` attribute holds the memory used by
+        the accumulators once the train op is built.
     """
 
     class GradAccumulationOptimizer(optimizer_class):
         def __init__(self, *args, **kwargs):
             super().__init__(*args, **kwargs)
+            self.accumulators = []
+            self.accumulator_bytes = 0
+            self._accumulation_step = None
+            self._apply_now = None
 
-        def apply_gradients(self, grads_and_vars, global_step=None, name=None, *args, **kwargs):
-            # If global step is set we should increment it as per tf1 optimizers
-            global_step_set = global_step is not None
-            add_gradients_ops = []
-            accumulation_vars = []
-            grads_and_accumulated_vars = []
+        def _get_accumulators(self, grads_and_vars, num_replicas):
+            accumulators = []
             for g, v in grads_and_vars:
-                if g is None:
-                    continue
-                g = tf.convert_to_tensor(value=g)
-                accum_grad = tf.compat.v1.get_variable(
-                    name=v.name[:-2] + "_acc",
-                    shape=g.shape,
-                    dtype=g.dtype,
-                    initializer=tf.compat.v1.constant_initializer(0),
+                dtype = g.values.dtype if isinstance(g, tf.IndexedSlices) else g.dtype
+                accumulators.append(
+                    tf.compat.v1.get_variable(
+                        name=v.name[:-2] + "_acc",
+                        shape=v.shape,
+                        dtype=dtype.base_dtype,
+                        initializer=tf.compat.v1.zeros_initializer(),
+                        use_resource=True,
+                        trainable=False,
+                        synchronization=tf.VariableSynchronization.ON_READ,
+                        aggregation=tf.VariableAggregation.SUM,
+                    )
+                )
+            if not self.accumulators:
+                copies = num_replicas if accumulators and self._is_replica_local(accumulators[0]) else 1
+                self.accumulator_bytes = copies * sum(
+                    int(np.prod(acc.shape.as_list())) * acc.dtype.size for acc in accumulators
+                )
+                LOGGER.info(
+                    "Accumulating gradients over {} steps in {:.1f}MB of accumulators, {} of {} gradients are sparse.".format(
+                        accum_steps,
+                        self.accumulator_bytes / 1024 ** 2,
+                        sum(isinstance(g, tf.IndexedSlices) for g, _ in grads_and_vars),
+                        len(grads_and_vars),
+                    )
+                )
+            self.accumulators = accumulators
+            return accumulators
+
+        def _is_replica_local(self, accumulator):
+            return isinstance(accumulator, distribute_values.DistributedValues)
+
+        def _get_accumulation_step(self):
+            if self._accumulation_step is None:
+                self._accumulation_step = tf.compat.v1.get_variable(
+                    name="grad_accumulation_step",
+                    shape=[],
+                    dtype=tf.int64,
+                    initializer=tf.compat.v1.zeros_initializer(),
                     use_resource=True,
-                    trainable=False
+                    trainable=False,
+                    aggregation=tf.VariableAggregation.ONLY_FIRST_REPLICA,
                 )
-                try:
-                    add_gradients_ops.append(accum_grad.assign_add(g))
-                except ValueError:
-                    raise FinetuneError("GradAccumulationOptimizer does not currently support multiple GPUs")
-                accumulation_vars.append(accum_grad)
-
-                grads_and_accumulated_vars.append((accum_grad, v))
-
-            global_step = global_step if global_step_set else tf.compat.v1.train.get_or_create_global_step()
-            if global_step_set:
-                kwargs["global_step"] = global_step
-            with tf.control_dependencies(add_gradients_ops):
-                def apply_grads():
-                    with tf.control_dependencies([
-                        super(GradAccumulationOptimizer, self).apply_gradients(
-                            grads_and_accumulated_vars, name=name, *args, **kwargs
-                        )
-                    ]):
-                        apply_grads_op = tf.group(*[g.assign(g.initial_value) for g in accumulation_vars])
-                    return apply_grads_op
-
-                return tf.cond(
-                    pred=tf.equal(global_step % accum_steps, accum_steps - 1),
-                    true_fn=apply_grads,
-                    false_fn=lambda: tf.no_op() if global_step_set else tf.group(global_step.assign_add(1))
+            return self._accumulation_step
+
+        def apply_gradients(self, grads_and_vars, global_step=None, name=None):
+            grads_and_vars = [(g, v) for g, v in grads_and_vars if g is not None]
+            replica_context = tf.distribute.get_replica_context()
+            num_replicas = replica_context.num_replicas_in_sync if replica_context is not None else 1
+            accumulators = self._get_accumulators(grads_and_vars, num_replicas)
+            accumulation_step = self._get_accumulation_step()
+
+            accumulate_ops = [_accumulate(acc, g) for acc, (g, _) in zip(accumulators, grads_and_vars)]
+            shared = num_replicas > 1 and bool(accumulators) and not self._is_replica_local(accumulators[0])
+            if shared:
+                # Every replica adds into the same accumulators, wait for all of them before reading. Each replica
+                # then contributes an equal share to the sum taken across replicas when the gradients are applied.
+                accumulate_ops = [replica_context.merge_call(_group_replicas, args=(tf.group(*accumulate_ops),))]
+            with tf.control_dependencies(accumulate_ops):
+                grads_and_accumulators = [
+                    (resource_variable_ops.read_variable_op(acc.handle, acc.dtype) / (num_replicas if shared else 1), v)
+                    for acc, (_, v) in zip(accumulators, grads_and_vars)
+                ]
+            with tf.control_dependencies([accumulation_step.assign_add(1)]):
+                # Read in `_distributed_apply` as well, every replica computes the same value.
+                self._apply_now = tf.equal(accumulation_step.read_value() % accum_steps, 0)
+
+            if distribute_ctx.has_strategy():
+                # Reduces the gradients across replicas and calls `_distributed_apply` in a cross replica context.
+                return super().apply_gradients(grads_and_accumulators, global_step=global_step, name=name)
+
+            def skip():
+                if global_step is None:
+                    return tf.no_op()
+                return tf.group(global_step.assign_add(1))
+
+            return self._apply_every_n(
+                lambda: super(GradAccumulationOptimizer, self).apply_gradients(
+                    grads_and_accumulators, global_step=global_step, name=name
+                ),
+                skip,
+                accumulators,
+            )
+
+        def _distributed_apply(self, distribution, grads_and_vars, global_step=None, name=None):
+            def skip():
+                if global_step is None:
+                    return tf.no_op()
+                return tf.group(
+                    distribution.extended.update(
+                        global_step, lambda step: step.assign_add(1, read_value=False), group=False
+                    )
                 )
 
+            return self._apply_every_n(
+                lambda: super(GradAccumulationOptimizer, self)._distributed_apply(
+                    distribution, grads_and_vars, global_step=global_step, name=name
+                ),
+                skip,
+                [
+                    component
+                    for acc in self.accumulators
+                    for component in distribution.experimental_local_results(acc)
+                ],
+            )
+
+        def _apply_every_n(self, apply_fn, skip_fn, accumulators):
+            def apply_grads():
+                with tf.control_dependencies([apply_fn()]):
+                    return tf.group(
+                        *[
+                            resource_variable_ops.assign_variable_op(acc.handle, tf.zeros(acc.shape, acc.dtype))
+                            for acc in accumulators
+                        ]
+                    )
+
+            return tf.cond(pred=self._apply_now, true_fn=apply_grads, false_fn=skip_fn)
+
     return GradAccumulationOptimizer
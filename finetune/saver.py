@@ -4,6 +4,10 @@ import logging
 import sys
 import warnings
 import re
+import tempfile
+import time
+import threading
+from collections import Counter
 
 import joblib
 import numpy as np
@@ -13,7 +17,8 @@ from tensorflow_estimator.python.estimator.early_stopping import _StopOnPredicat
 
 from finetune.errors import FinetuneError
 from finetune.config import get_config
-from finetune.util.metrics import read_eval_metrics
+from finetune.util.metrics import EvalMetricsReader
+from finetune.util.mapped_weights import is_mapped_weights, load_weights, dump_weights
 
 LOGGER = logging.getLogger("finetune")
 
@@ -21,6 +26,84 @@ LOGGER = logging.getLogger("finetune")
 def should_be_randomly_initialized(name):
     return "OptimizeLoss" in name or "global_step" in name
 
+
+def load_fallback(filename):
+    if is_mapped_weights(filename):
+        return load_weights(filename)[0]
+    return joblib.load(filename)
+
+
+class FallbackCache:
+    """
+    Reference counted, in-process cache of base model weights so that every Saver with the same
+    fallback file shares a single copy of its arrays.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._weights = dict()
+        self._refs = Counter()
+
+    def acquire(self, filename):
+        with self._lock:
+            if filename not in self._weights:
+                self._weights[filename] = load_fallback(filename)
+            self._refs[filename] += 1
+            return self._weights[filename]
+
+    def release(self, filename):
+        with self._lock:
+            self._refs[filename] -= 1
+            if self._refs[filename] <= 0:
+                del self._refs[filename]
+                del self._weights[filename]
+
+    def references(self):
+        with self._lock:
+            return dict(self._refs)
+
+    def peek(self, filename):
+        """
+        The cached weights for `filename` without taking a reference, None if no Saver holds them.
+        """
+        with self._lock:
+            return self._weights.get(filename)
+
+
+def _atomic_dump(obj, path):
+    """
+    `joblib.dump` to a temporary file next to `path`, renamed over it once complete, so readers never see a
+    partially written file.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", prefix=".tmp-", suffix=os.path.basename(path))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            joblib.dump(obj, f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _fingerprint(arr, n_samples=64):
+    flat = arr.reshape(-1)
+    return flat[:: max(1, flat.size // n_samples)][:n_samples]
+
+
+def _unchanged(fallback_value, value):
+    """
+    Equivalent to `np.allclose` between a saved variable and its base model value, but rejects
+    mismatched shapes and most fine-tuned variables from a strided sample before comparing in full.
+    """
+    if fallback_value.shape != value.shape:
+        return False
+    if not np.allclose(_fingerprint(fallback_value), _fingerprint(value)):
+        return False
+    if fallback_value.dtype == value.dtype and np.array_equal(fallback_value, value):
+        return True
+    return np.allclose(fallback_value, value)
+
 class SaverHook(_StopOnPredicateHook):
     def __init__(
         self,
@@ -45,11 +128,17 @@ class SaverHook(_StopOnPredicateHook):
         self.steps_per_epoch = steps_per_epoch
         self.estimator = estimator
         self.cache_weights_to_file = cache_weights_to_file
+        self._metrics_reader = None
+        # weights are written to disk on a background thread so training continues while they serialize.
+        self._writer = None
+        self._write_future = None
 
     def stop_if_no_metric_improvement_fn(self):
         if not self.keep_best_model:
             return False
-        eval_results = read_eval_metrics(self.estimator.eval_dir())
+        if self._metrics_reader is None:
+            self._metrics_reader = EvalMetricsReader(self.estimator.eval_dir())
+        eval_results = self._metrics_reader.read()
         if len(eval_results) == 0:
             return False
         most_recent_eval = max(eval_results.items(), key=lambda x: x[0])  # last steps.
@@ -79,16 +168,40 @@ class SaverHook(_StopOnPredicateHook):
 
     def _get_weights(self, session):
         if not self.keep_best_model or self.saver.variables is None or self.get_current_weights:
+            start = time.time()
             self.saver.variables = dict(
                 zip(
                     (var.name for var in self.included),
                     session.run(self.included),
                 )
             )
+            LOGGER.debug("Fetched weights in {:.2f}s".format(time.time() - start))
             if self.cache_weights_to_file:
-                joblib.dump(self.saver.variables, os.path.join(self.estimator.eval_dir(), "..", "weights.jl"))
+                self._write_weights(self.saver.variables)
             self.get_current_weights = False
 
+    def _write_weights(self, variables):
+        # A snapshot that has not started writing yet is superseded by the newer one, the file always ends
+        # up holding the most recent weights. The dict is never mutated after it is fetched, so it is safe
+        # to serialize while training continues.
+        if self._writer is None:
+            self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="finetune-weights")
+        if self._write_future is not None:
+            self._write_future.cancel()
+        path = os.path.normpath(os.path.join(self.estimator.eval_dir(), "..", "weights.jl"))
+        self._write_future = self._writer.submit(_atomic_dump, variables, path)
+
+    def _wait_for_write(self):
+        if self._writer is None:
+            return
+        try:
+            if self._write_future is not None:
+                self._write_future.result()
+        finally:
+            self._write_future = None
+            self._writer.shutdown(wait=True)
+            self._writer = None
+
     def after_run(self, run_context, run_values):
         super().after_run(run_context, run_values)
         if self.get_current_weights:
@@ -98,6 +211,7 @@ class SaverHook(_StopOnPredicateHook):
         self.stop_if_no_metric_improvement_fn()
         if not self.keep_best_model or self.saver.variables is None or self.get_current_weights:
             self._get_weights(session=session)
+        self._wait_for_write()
 
 
 class InitializeHook(SessionRunHook):
@@ -144,32 +258,66 @@ class Saver:
         save_dtype=None,
         restart_global_step=True,
         permit_uninitialized=None,
+        mmap_weights=False,
+        fallback_cache=None,
     ):
         self.variable_transforms = variable_transforms or []
         self.exclude_matches = exclude_matches
         self.variables = None
         self.save_dtype = save_dtype
+        self.fallback_cache = fallback_cache
+        self.fallback_acquired = False
         if fallback_filename is not None:
             self.set_fallback(fallback_filename)
         self.restart_global_step = restart_global_step
         self.permit_uninitialized = permit_uninitialized
+        self.mmap_weights = mmap_weights
 
     def set_fallback(self, fallback_filename):
         self.tpe = ThreadPoolExecutor()
         if not os.path.exists(fallback_filename):
             raise FileNotFoundError("Error loading base model {} - file not found.".format(fallback_filename))
         self.fallback_filename = fallback_filename
-        self.fallback_future = self.tpe.submit(joblib.load, fallback_filename)
+        if self.fallback_cache is not None:
+            self.fallback_acquired = True
+            self.fallback_future = self.tpe.submit(self.fallback_cache.acquire, fallback_filename)
+        else:
+            self.fallback_future = self.tpe.submit(load_fallback, fallback_filename)
         self.fallback_ = None
 
     @property
     def fallback(self):
-        if self.fallback_ is None:
+        if getattr(self, "fallback_", None) is None:
+            if getattr(self, "fallback_future", None) is None:
+                # released after the variables were initialized, acquired again for a rebuild or a save.
+                return self._reacquire_fallback()
             self.fallback_ = self.fallback_future.result()
             self.fallback_future = None
             self.tpe.shutdown()
         return self.fallback_
 
+    def _reacquire_fallback(self):
+        if self.fallback_cache is not None:
+            self.fallback_acquired = True
+            self.fallback_ = self.fallback_cache.acquire(self.fallback_filename)
+        else:
+            self.fallback_ = load_fallback(self.fallback_filename)
+        return self.fallback_
+
+    def release_fallback(self):
+        """
+        Drop this saver's reference to the fallback weights, returning them to the shared cache if there is one.
+        They are acquired again the next time `fallback` is read.
+        """
+        if getattr(self, "fallback_future", None) is not None:
+            self.fallback_future.result()
+            self.fallback_future = None
+            self.tpe.shutdown()
+        self.fallback_ = None
+        if self.fallback_acquired:
+            self.fallback_cache.release(self.fallback_filename)
+            self.fallback_acquired = False
+
     def get_saver_hook(
         self,
         estimator,
@@ -212,15 +360,35 @@ class Saver:
             LOGGER.info("Saving with {} precision.".format(self.save_dtype.__name__))
             values = [a.astype(self.save_dtype) for a in values]
 
+        start_diff = time.time()
+        held = self.fallback_acquired
         var_names_reduced, vals_reduced = self.remove_unchanged(
             names, values, self.fallback
         )
+        if self.fallback_cache is not None and not held:
+            # shared base weights acquired again for the diff are not kept past it.
+            self.release_fallback()
+        end_diff = time.time()
         var_dict = dict(zip(var_names_reduced, vals_reduced))
         assert len(vals_reduced) == len(var_names_reduced) == len(var_dict)
-        joblib.dump((var_dict, finetune_obj), path)
+        # Files are replaced rather than overwritten in place, `self.variables` may be mapped from `path`.
+        if self.mmap_weights:
+            dump_weights(var_dict, path, obj=finetune_obj)
+        elif isinstance(path, str):
+            _atomic_dump((var_dict, finetune_obj), path)
+        else:
+            joblib.dump((var_dict, finetune_obj), path)
+        LOGGER.info(
+            "Saved {} of {} variables ({:.2f}s diffing against the base model, {:.2f}s writing).".format(
+                len(var_dict), len(names), end_diff - start_diff, time.time() - end_diff
+            )
+        )
 
     def load(self, path):
-        self.variables, finetune_obj = joblib.load(path)
+        if is_mapped_weights(path):
+            self.variables, finetune_obj = load_weights(path)
+        else:
+            self.variables, finetune_obj = joblib.load(path)
         finetune_obj.config = get_config(
             error_on_invalid_keywords=False, 
             **dict(finetune_obj.config)
@@ -262,22 +430,20 @@ class Saver:
 
                     
             var_loader.run(session)
+            if self.fallback_cache is not None:
+                # the session holds its own copy, so the shared base weights can be freed once no model needs them.
+                self.release_fallback()
         return init_fn
 
     def remove_unchanged(self, variable_names, variable_values, fallback_vars):
         skips = []
         for var_val, var_name in zip(variable_values, variable_names):
-            skip = False
-            for fb_var_name, fb_var in fallback_vars.items():
-                if fb_var_name == var_name:
-                    for func in self.variable_transforms:
-                        fb_var = func(var_name, fb_var)
-                    if fb_var.shape == var_val.shape and np.allclose(fb_var, var_val):
-                        skip = True
-                        break
-            skips.append(skip)
+            fb_var = fallback_vars.get(var_name)
+            if fb_var is not None:
+                for func in self.variable_transforms:
+                    fb_var = func(var_name, fb_var)
+            skips.append(fb_var is not None and _unchanged(fb_var, var_val))
         return (
             [var for skip, var in zip(skips, variable_names) if not skip],
             [var_val for skip, var_val in zip(skips, variable_values) if not skip],
         )
-
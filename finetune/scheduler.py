@@ -1,6 +1,7 @@
 import gc
 import logging
 import functools
+import threading
 
 import psutil
 
@@ -8,6 +9,8 @@ import tensorflow as tf
 from finetune.base import BaseModel
 from finetune.custom_ops import BytesInUse, BytesLimit, MaxBytesInUse
 from finetune.errors import FinetuneSchedulerError
+from finetune.saver import FallbackCache
+from finetune.util.async_utils import AsyncRunner
 
 LOGGER = logging.getLogger("finetune")
 
@@ -16,12 +19,178 @@ def bytes_to_meg(x):
     return x / 1024 / 1024
 
 
+def _rss():
+    return psutil.Process().memory_info().rss
+
+
+def _nbytes(variables):
+    if not variables:
+        return 0
+    return int(sum(getattr(value, "nbytes", 0) for value in variables.values()))
+
+
+def _weight_bytes(model):
+    # the weights are only held until the first call, see `Scheduler._update_memory_limit`.
+    if getattr(model.saver, "variables", None) is None:
+        return None
+    saver = model.saver
+    # shared base weights are released once the variables are initialized, read them without acquiring them again.
+    fallback = getattr(saver, "fallback_", None)
+    if fallback is None and saver.fallback_cache is not None:
+        fallback = saver.fallback_cache.peek(saver.fallback_filename)
+    return _nbytes(saver.variables), _nbytes(fallback)
+
+
+class PeakRSS:
+    """
+    Context manager that samples the resident set size of this process on a background thread and records
+    the highest value seen, as `peak`.
+    """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        while True:
+            self.peak = max(self.peak, _rss())
+            if self._stop.wait(self.interval):
+                break
+
+    def __enter__(self):
+        self.peak = _rss()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, _rss())
+        return False
+
+
+class _PendingBatch:
+    """
+    Inputs from concurrent calls that will be run as a single call by the first caller.
+    """
+
+    def __init__(self):
+        self.inputs = []
+        self.full = threading.Event()
+        self.done = threading.Event()
+        self.preds = None
+        self.error = None
+
+    def add(self, x):
+        start = len(self.inputs)
+        self.inputs.extend(x)
+        return start, len(self.inputs)
+
+    def result(self, start, end):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.preds[start:end]
+
+
 def scheduled(fn):
     @functools.wraps(fn)
     def scheduled_predict(self, model_file, x, *args, **kwargs):
-        model = self._rotate_in_model(model_file)
+        if self.coalesce_max_wait and not args and not kwargs:
+            return self._coalesced_call(fn, model_file, x)
+        return self._scheduled_call(fn, model_file, x, *args, **kwargs)
+
+    return scheduled_predict
+
+
+def scheduled_async(fn):
+    async def scheduled_predict_async(self, model_file, x, *args, timeout=None, **kwargs):
+        return await self._async_runner().run(
+            lambda: self._rotate_in_model(model_file),
+            functools.partial(fn, self, model_file),
+            x,
+            *args,
+            timeout=timeout,
+            **kwargs
+        )
+
+    scheduled_predict_async.__name__ = "a" + fn.__name__
+    scheduled_predict_async.__doc__ = "Asyncio version of `{}`, see `async_max_pending`.".format(fn.__name__)
+    return scheduled_predict_async
+
+
+class Scheduler:
+    """
+    Keeps a bounded set of models loaded for prediction, closing the least recently used model when
+    `max_models` or the available memory would be exceeded.
+
+    :param max_models: Maximum number of models to keep loaded.
+    :param config: Config overrides applied to every loaded model.
+    :param reserved: Bytes of GPU memory to keep free.
+    :param ram_max_frac: Fraction of system memory above which models are closed. On hosts without a GPU,
+        this sets the memory budget when `cpu_memory_budget` is not given.
+    :param share_base_weights: Keep a single reference counted copy of the base model weights for all
+        loaded models with the same `base_model_path`, instead of reading them from disk for every load.
+    :param cpu_memory_budget: Bytes of resident memory this process may use for models. When set, or when no
+        GPU is available, models are closed based on the measured memory use of each model rather than GPU
+        allocator state. See `stats`.
+    :param coalesce_max_wait: Seconds to hold a call so that calls to the same method and model from other threads
+        can be run with it as one batched call. Only calls without extra arguments are coalesced. Defaults to 0
+        (no coalescing).
+    :param coalesce_max_batch: Number of inputs at which a coalesced call runs without waiting any longer.
+    :param async_max_pending: Maximum number of calls in flight through the async methods (`apredict`,
+        `apredict_proba`, ...). Further calls wait for a slot. Defaults to None (no limit).
+
+    The scheduler can be shared between threads. Each model is loaded once, however many threads ask for it at the
+    same time, and calls to the same model run one at a time. The async methods accept a `timeout` in seconds and
+    run the model on a thread per device, so they can be awaited from an event loop without blocking it.
+    """
+
+    def __init__(
+        self,
+        max_models=None,
+        config=None,
+        reserved=750000000,
+        ram_max_frac=0.8,
+        share_base_weights=False,
+        cpu_memory_budget=None,
+        coalesce_max_wait=0.0,
+        coalesce_max_batch=None,
+        async_max_pending=None,
+    ):
+        self.loaded_models = list()
+        self.max_models = max_models
+        self.gpu_memory_limit = None
+        self.model_cache = dict()
+        self.max_above_resting = None
+        self.previous_in_use = 0
+        self.max_model_size = None
+        self.config = config or {}
+        self.reserved = reserved
+        self.ram_max_frac = ram_max_frac
+        self.fallback_cache = FallbackCache() if share_base_weights else None
+        self.cpu_accounting = cpu_memory_budget is not None or not tf.config.list_physical_devices("GPU")
+        if self.cpu_accounting and cpu_memory_budget is None:
+            cpu_memory_budget = int(ram_max_frac * psutil.virtual_memory().total)
+        self.cpu_memory_budget = cpu_memory_budget
+        self.model_stats = dict()
+        self.coalesce_max_wait = coalesce_max_wait
+        self.coalesce_max_batch = coalesce_max_batch
+        # guards the fields above, it is never held while waiting on a model lock.
+        self._lock = threading.RLock()
+        self._loaded = threading.Condition(self._lock)
+        self._loading = set()
+        self._model_locks = dict()
+        self._pending = dict()
+        self.async_max_pending = async_max_pending
+        self._runner = None
+
+    def _scheduled_call(self, fn, model_file, x, *args, **kwargs):
         try:
-            preds = fn(self, model_file=model_file, x=x, *args, model=model, **kwargs)
+            return self._call_model(fn, model_file, x, *args, **kwargs)
         except Exception as orig_except:
             LOGGER.warning(
                 "Exception '{}' raised. Closing all models and retrying".format(
@@ -32,38 +201,149 @@ def scheduled(fn):
             self.close_all()
             try:
                 # Reload in preparation for prediction
-                model = self._rotate_in_model(model_file)
-                preds = fn(
-                    self, model_file=model_file, x=x, *args, model=model, **kwargs
-                )
+                return self._call_model(fn, model_file, x, *args, **kwargs)
             except Exception as e:
                 raise FinetuneSchedulerError(
                     "Original Error: {}, Retry Error: {}".format(
                         str(orig_except), str(e)
                     )
                 )
-        self._update_memory_limit(model)
+
+    def _call_model(self, fn, model_file, x, *args, **kwargs):
+        model, lock = self._acquire_model(model_file)
+        try:
+            rss_before = _rss()
+            with PeakRSS() as rss:
+                preds = fn(self, model_file=model_file, x=x, *args, model=model, **kwargs)
+            weights = _weight_bytes(model)
+            self._update_memory_limit(model)
+        finally:
+            lock.release()
+        with self._lock:
+            if self.model_cache.get(model_file) is model:
+                self._record_call(model_file, weights, rss_before, rss.peak)
         return preds
 
-    return scheduled_predict
+    def _coalesced_call(self, fn, model_file, x):
+        key = (fn.__name__, model_file)
+        with self._lock:
+            batch = self._pending.get(key)
+            leader = batch is None
+            if leader:
+                batch = self._pending[key] = _PendingBatch()
+            start, end = batch.add(x)
+            if self.coalesce_max_batch is not None and len(batch.inputs) >= self.coalesce_max_batch:
+                self._pending.pop(key)
+                batch.full.set()
 
+        if not leader:
+            return batch.result(start, end)
 
-class Scheduler:
-    def __init__(
-        self, max_models=None, config=None, reserved=750000000, ram_max_frac=0.8
-    ):
-        self.loaded_models = list()
-        self.max_models = max_models
-        self.gpu_memory_limit = None
-        self.model_cache = dict()
-        self.max_above_resting = None
-        self.previous_in_use = 0
-        self.max_model_size = None
-        self.config = config or {}
-        self.reserved = reserved
-        self.ram_max_frac = ram_max_frac
+        batch.full.wait(self.coalesce_max_wait)
+        with self._lock:
+            if self._pending.get(key) is batch:
+                self._pending.pop(key)
+        try:
+            batch.preds = self._scheduled_call(fn, model_file, batch.inputs)
+        except Exception as e:
+            batch.error = e
+            raise
+        finally:
+            batch.done.set()
+        if len(batch.inputs) > end:
+            LOGGER.info("Coalesced {} inputs into one call to {}".format(len(batch.inputs), fn.__name__))
+        return batch.preds[start:end]
+
+    def _acquire_model(self, model_file):
+        # returns the loaded model with its lock held, retrying if it is closed before the lock is acquired.
+        while True:
+            model = self._rotate_in_model(model_file)
+            with self._lock:
+                lock = self._model_locks.setdefault(model_file, threading.Lock())
+            lock.acquire()
+            if self.model_cache.get(model_file) is model:
+                return model, lock
+            lock.release()
+
+    def _async_runner(self):
+        with self._lock:
+            if self._runner is None:
+                self._runner = AsyncRunner(max_pending=self.async_max_pending)
+            return self._runner
+
+    def _record_load(self, model_file, load_rss_bytes):
+        self.model_stats[model_file] = {
+            "load_rss_bytes": load_rss_bytes,
+            "resident_bytes": None,
+            "peak_predict_bytes": 0,
+            "weight_bytes": None,
+            "base_weight_bytes": None,
+            "calls": 0,
+        }
+
+    def _record_call(self, model_file, weights, rss_before, peak_rss):
+        stats = self.model_stats[model_file]
+        if stats["weight_bytes"] is None and weights is not None:
+            stats["weight_bytes"], stats["base_weight_bytes"] = weights
+        rss_after = _rss()
+        stats["peak_predict_bytes"] = max(stats["peak_predict_bytes"], peak_rss - rss_after)
+        if stats["resident_bytes"] is None:
+            # the first call builds the graph and loads the weights into the session, whatever it
+            # still holds once the numpy copies are freed stays resident while the model is loaded.
+            stats["resident_bytes"] = max(stats["load_rss_bytes"] + rss_after - rss_before, 0)
+        stats["calls"] += 1
+        if self.cpu_accounting:
+            if self.max_model_size is None or stats["resident_bytes"] > self.max_model_size:
+                self.max_model_size = stats["resident_bytes"]
+            if self.max_above_resting is None or stats["peak_predict_bytes"] > self.max_above_resting:
+                self.max_above_resting = stats["peak_predict_bytes"]
+
+    def _cpu_memory_for_one_more(self):
+        if self.max_model_size is None:
+            return True  # first run
+        in_use = _rss()
+        LOGGER.info(
+            (
+                "models loaded: {num_models}, rss: {in_use}, max_above_resting: {mar},"
+                " max_model_size: {mms}, cpu_memory_budget: {budget}"
+            ).format(
+                num_models=len(self.loaded_models),
+                in_use=bytes_to_meg(in_use),
+                mar=bytes_to_meg(self.max_above_resting),
+                mms=bytes_to_meg(self.max_model_size),
+                budget=bytes_to_meg(self.cpu_memory_budget),
+            )
+        )
+        return in_use + self.max_above_resting + self.max_model_size < self.cpu_memory_budget
+
+    def stats(self):
+        """
+        Memory accounting for the loaded models.
+
+        :return: A dict with the current resident set size of the process ("rss_bytes"), the CPU memory budget
+            if CPU accounting is used, and per loaded model file:
+            - load_rss_bytes: growth in resident memory while loading the model.
+            - resident_bytes: memory held by the model once it has been used, None before the first call.
+            - peak_predict_bytes: largest amount of resident memory above what the model holds between calls,
+              reached during a call.
+            - weight_bytes, base_weight_bytes: size of the fine-tuned and base model weights.
+            - calls: number of scheduled calls to the model.
+        """
+        with self._lock:
+            return {
+                "rss_bytes": _rss(),
+                "cpu_accounting": self.cpu_accounting,
+                "cpu_memory_budget": self.cpu_memory_budget,
+                "gpu_memory_limit": self.gpu_memory_limit,
+                "models": {
+                    name: dict(self.model_stats[name]) for name in self.loaded_models
+                },
+            }
 
     def _memory_for_one_more(self):
+        if self.cpu_accounting:
+            return self._cpu_memory_for_one_more()
+
         if self.gpu_memory_limit is None:
             return True # first run
 
@@ -100,40 +380,79 @@ class Scheduler:
         ) < self.gpu_memory_limit
 
     def _close_oldest_model(self):
-        if len(self.loaded_models):
+        # must be called without self._lock held: the model is removed from the cache under the lock, which is
+        # released before waiting for any call in progress on the model to finish.
+        with self._lock:
+            if not self.loaded_models:
+                LOGGER.info("No models cached -- cannot remove oldest model.")
+                return
             name = self.loaded_models.pop(0)
-            self.model_cache[name].close()
-            del self.model_cache[name]
-            gc.collect()
-        else:
-            LOGGER.info("No models cached -- cannot remove oldest model.")
+            model = self.model_cache.pop(name)
+            lock = self._model_locks.pop(name, None) or threading.Lock()
+            del self.model_stats[name]
+        with lock:
+            model.close()
+            if self.fallback_cache is not None:
+                model.saver.release_fallback()
+        gc.collect()
 
     def _rotate_in_model(self, model):
-        if model not in self.loaded_models:
-            if (
-                (
+        with self._lock:
+            while model in self._loading:
+                # single flight, another thread is already loading this model
+                self._loaded.wait()
+            if model in self.model_cache:
+                out_model = self.model_cache[model]
+                self.loaded_models.remove(model)  # put it back at the end of the queue
+                self.loaded_models.append(model)
+                return out_model
+
+            self._loading.add(model)
+
+        try:
+            with self._lock:
+                make_room = (
                     self.max_models is not None
-                    and len(self.loaded_models) + 1 > self.max_models
-                )
-                or not self._memory_for_one_more()
-            ):
+                    and len(self.loaded_models) + len(self._loading) > self.max_models
+                ) or not self._memory_for_one_more()
+            if make_room:
                 self._close_oldest_model()
-            out_model = BaseModel.load(model, **self.config)
-            self.model_cache[model] = out_model
-        else:
-            out_model = self.model_cache[model]
-            self.loaded_models.remove(model)  # put it back at the end of the queue
+                # the budget is in bytes so keep closing until the new model fits
+                while self.cpu_accounting:
+                    with self._lock:
+                        if not self.loaded_models or self._memory_for_one_more():
+                            break
+                    self._close_oldest_model()
 
-        self.loaded_models.append(model)
-        out_model._cached_predict = True
+            rss_before = _rss()
+            out_model = BaseModel.load(
+                model, fallback_cache=self.fallback_cache, **self.config
+            )
+            out_model._cached_predict = True
+            load_rss_bytes = _rss() - rss_before
 
-        return out_model
+            # models loaded concurrently can each have found room before any of them was added.
+            while True:
+                with self._lock:
+                    if self.max_models is None or len(self.loaded_models) < self.max_models:
+                        self.model_cache[model] = out_model
+                        self.loaded_models.append(model)
+                        self._record_load(model, load_rss_bytes)
+                        return out_model
+                self._close_oldest_model()
+        finally:
+            with self._lock:
+                self._loading.discard(model)
+                self._loaded.notify_all()
 
     def _update_memory_limit(self, model):
         if hasattr(model.saver, "variables"):
             del model.saver.variables
-            del model.saver.fallback_
-        self.gpu_memory_limit = BytesLimit() # delay this so that any options get applied from finetune.
+            if self.fallback_cache is None:
+                # shared base weights are released by the saver once the variables are initialized
+                del model.saver.fallback_
+        if not self.cpu_accounting:
+            self.gpu_memory_limit = BytesLimit() # delay this so that any options get applied from finetune.
 
     def close_all(self):
         while self.loaded_models:
@@ -158,3 +477,9 @@ class Scheduler:
     @scheduled
     def featurize_sequence(self, model_file, x, *args, model=None, **kwargs):
         return model.featurize_sequence(x, *args, **kwargs)
+
+    apredict = scheduled_async(predict)
+    apredict_proba = scheduled_async(predict_proba)
+    aattention_weights = scheduled_async(attention_weights)
+    afeaturize = scheduled_async(featurize)
+    afeaturize_sequence = scheduled_async(featurize_sequence)
@@ -35,7 +35,7 @@ class MaskedLanguageModelPipeline(BasePipeline):
         )
 
     def text_to_tokens_mask(self, X, Y=None):
-        out_gen = self._text_to_ids(X, pad_token=self.config.pad_token)
+        out_gen = self._encoded_chunks(X, pad_token=self.config.pad_token)
        
         for out in out_gen:
             seq_len = out.token_ids.shape[0]
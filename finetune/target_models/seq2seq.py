@@ -78,29 +78,60 @@ class HFS2S(BaseModel):
             }
 
         else:
+            def run_decoder(input_symbols, state, past_key_value_states=None, use_cache=False):
+                return hf_decoder(
+                    (
+                        input_symbols, #decoder_input_ids,
+                        None, #decoder_attention_mask, # Seems like it does this automagically because these values are unpadded
+                        state["encoder_output"], #hidden_states,
+                        state["encoder_decoder_mask"], #encoder_attention_mask,
+                        None, #decoder_inputs_embeds,
+                        None, #head_mask,
+                        past_key_value_states, #decoder_past_key_value_states,
+                        use_cache, #use_cache,
+                        None, #output_attentions,
+                        None, #output_hidden_states,
+                    ),
+                    training=False,
+                )
+
             def symbols_to_logits_fn(input_symbols, i, state): #[batch_size, decoded_ids] to [batch_size, vocab_size]
                 with tf.compat.v1.variable_scope("model"):
                     with tf.compat.v1.variable_scope("target"):
-                        embeds = hf_decoder(
-                            (
-                                input_symbols, #decoder_input_ids,
-                                None, #decoder_attention_mask, # Seems like it does this automagically because these values are unpadded
-                                state["encoder_output"], #hidden_states,
-                                state["encoder_decoder_mask"], #encoder_attention_mask,
-                                None, #decoder_inputs_embeds,
-                                None, #head_mask,
-                                None, #decoder_past_key_value_states,
-                                False, #use_cache,
-                                None, #output_attentions,
-                                None, #output_hidden_states,
-                            ),
-                            training=False,
-                        )[0]
+                        embeds = run_decoder(input_symbols, state)[0]
                         logits = featurizer_state["embedding"](normalize_embeds(embeds[:, -1]), mode="linear")
-                        logits_shape = tf.shape(logits)
                         return (logits, state)
 
             initial_ids = tf.tile(tf.constant([text_encoder.start_token], dtype=tf.int32), [tf.shape(featurizer_state["sequence_features"])[0]])
+            states = {"encoder_output": featurizer_state["sequence_features"], "encoder_decoder_mask": encoder_decoder_mask}
+
+            if config.beam_search_use_cache:
+                # Decoding the start token once gives the encoder-decoder attention keys and values for every layer.
+                # They are identical for every step and every beam of a document so they are repeated to the beam size
+                # here rather than carried through the beam search state, which is gathered at every step.
+                _, present_key_value_states = run_decoder(initial_ids[:, None], states, use_cache=True)[:2]
+                cross_attention_cache = [
+                    tuple(tf.repeat(t, config.beam_size, axis=0) for t in layer[2:])
+                    for layer in present_key_value_states
+                ]
+                # Self attention keys and values start empty and grow by one position per step.
+                states["cache"] = tuple(
+                    (key[:, :, :0], value[:, :, :0]) for key, value, *_ in present_key_value_states
+                )
+
+                def symbols_to_logits_fn(input_symbols, i, state):
+                    past_key_value_states = tuple(
+                        self_attention + cross_attention
+                        for self_attention, cross_attention in zip(state["cache"], cross_attention_cache)
+                    )
+                    with tf.compat.v1.variable_scope("model"):
+                        with tf.compat.v1.variable_scope("target"):
+                            embeds, present_key_value_states = run_decoder(
+                                input_symbols[:, -1:], state, past_key_value_states, use_cache=True
+                            )[:2]
+                            logits = featurizer_state["embedding"](normalize_embeds(embeds[:, -1]), mode="linear")
+                    cache = tuple(tuple(layer[:2]) for layer in present_key_value_states)
+                    return (logits, dict(state, cache=cache))
 
             beams, probs, _ = beam_search(
                 symbols_to_logits_fn=symbols_to_logits_fn,
@@ -109,7 +140,7 @@ class HFS2S(BaseModel):
                 decode_length=config.max_length,
                 vocab_size=featurizer_state["embedding"].vocab_size,
                 alpha=config.beam_search_alpha,
-                states={"encoder_output": featurizer_state["sequence_features"], "encoder_decoder_mask": encoder_decoder_mask}, # TODO: Use states to enable cache in t5
+                states=states,
                 eos_id=text_encoder.end_token,
                 stop_early=True,
                 use_top_k_with_unique=True,
@@ -39,11 +39,12 @@ class SequencePipeline(BasePipeline):
         # Smoothed to prevent zero division
         return self.empty_counts["empty"] / (self.empty_counts["labeled"] + 1)
 
+    def _encoding_pad_token(self):
+        return [self.config.pad_token] if self.multi_label else self.config.pad_token
+
     def text_to_tokens_mask(self, X, Y=None, context=None):
-        pad_token = (
-            [self.config.pad_token] if self.multi_label else self.config.pad_token
-        )
-        out_gen = self._text_to_ids(X, pad_token=pad_token)
+        pad_token = self._encoding_pad_token()
+        out_gen = self._encoded_chunks(X, pad_token=pad_token)
 
         for out in out_gen:
             feats = {"tokens": out.token_ids}
@@ -353,6 +354,7 @@ class SequenceLabeler(BaseModel):
         :returns: list of class labels.
         """
         classes = list(self.input_pipeline.label_encoder.classes_)
+        class_idx = {label: i for i, label in enumerate(classes)}
         doc_idx = -1
         doc_annotations = []
         raw_text = [data.get("raw_text", data["X"]) for data in zipped_data]
@@ -368,11 +370,10 @@ class SequenceLabeler(BaseModel):
         ) in self.process_long_sequence(zipped_data, **kwargs):
             if start_of_doc:
                 # if this is the first chunk in a document, start accumulating from scratch
-                doc_subseqs = []
-                doc_labels = []
-                doc_probs = []
-                doc_positions = []
-                doc_starts = []
+                # spans are [char start, char end, first proba row, label, position]
+                doc_spans = []
+                doc_proba_rows = []
+                n_rows = 0
                 doc_idx += 1
                 last_end = 0
                 doc_level_probas = []
@@ -382,56 +383,80 @@ class SequenceLabeler(BaseModel):
             start_of_token_seq = token_start_idx[start:end]
             proba_seq = proba_seq[start:end]
 
-            proba_seq_masked = proba_seq.copy()
-
-            for il, label in enumerate(label_seq):
-                # covers the multilabel case where pad is not a distinct class.
-                if label in classes:
-                    label_idx = classes.index(label)
-                    proba_seq_masked[il:, label_idx] = 0.0
-            doc_level_probas.append(np.max(proba_seq_masked, axis=0))
-
-            for label, start_idx, end_idx, proba in zip(
-                label_seq, start_of_token_seq, end_of_token_seq, proba_seq
-            ):
-                if end_idx == -1:
-                    # indicates padding / special tokens
-                    continue
+            # zero the probability of each class from its first predicted occurrence on.
+            # covers the multilabel case where pad is not a distinct class.
+            label_ids = np.asarray(
+                [class_idx.get(label, -1) for label in label_seq], dtype=np.int64
+            )
+            predicted = np.flatnonzero(label_ids >= 0)
+            if len(predicted):
+                first_seen = np.full(len(classes), len(label_seq))
+                ids, first = np.unique(label_ids[predicted], return_index=True)
+                first_seen[ids] = predicted[first]
+                proba_seq_masked = proba_seq.copy()
+                proba_seq_masked[
+                    np.arange(len(proba_seq))[:, None] >= first_seen[None, :]
+                ] = 0.0
+                doc_level_probas.append(np.max(proba_seq_masked, axis=0))
+            else:
+                doc_level_probas.append(np.max(proba_seq, axis=0))
 
-                assert start_idx >= last_end, "Start idx: {}, last_end: {}".format(
-                    start_idx, last_end
+            n_tokens = min(
+                len(label_seq),
+                len(start_of_token_seq),
+                len(end_of_token_seq),
+                len(proba_seq),
+            )
+            # end of -1 indicates padding / special tokens
+            keep = np.flatnonzero(np.asarray(end_of_token_seq[:n_tokens]) != -1)
+            if len(keep):
+                chunk_starts = np.asarray(start_of_token_seq)[keep]
+                chunk_ends = np.asarray(end_of_token_seq)[keep]
+                prev_ends = np.concatenate([[last_end], chunk_ends[:-1]])
+                overlapping = np.flatnonzero(chunk_starts < prev_ends)
+                assert not len(overlapping), "Start idx: {}, last_end: {}".format(
+                    chunk_starts[overlapping[0]], prev_ends[overlapping[0]]
                 )
-                last_end = end_idx
+                inverted = np.flatnonzero(chunk_starts > chunk_ends)
+                assert not len(inverted), "Start: {}, End: {}".format(
+                    chunk_starts[inverted[0]], chunk_ends[inverted[0]]
+                )
+                last_end = end_of_token_seq[keep[-1]]
+                rows = np.asarray(proba_seq)[keep]
+                doc_proba_rows.append(rows.reshape(len(keep), -1))
 
+            for i, token in enumerate(keep):
+                label = label_seq[token]
                 # if there are no current subsequences
                 # or the current subsequence has the wrong label
-                if not doc_subseqs or label != doc_labels[-1] or per_token:
-                    assert start_idx <= end_idx, "Start: {}, End: {}".format(
-                        start_idx, end_idx
+                if not doc_spans or label != doc_spans[-1][3] or per_token:
+                    start_idx = start_of_token_seq[token]
+                    end_idx = end_of_token_seq[token]
+                    doc_spans.append(
+                        [start_idx, end_idx, n_rows + i, label, (start_idx, end_idx)]
                     )
-                    # start new subsequence
-                    doc_subseqs.append(raw_text[doc_idx][start_idx:end_idx])
-                    doc_labels.append(label)
-                    doc_probs.append([proba])
-                    doc_positions.append((start_idx, end_idx))
-                    doc_starts.append(start_idx)
                 else:
-                    assert start_idx <= end_idx, "Start: {}, End: {}".format(
-                        start_idx, end_idx
-                    )
-                    # continue appending to current subsequence
-                    assert doc_starts[-1] <= end_idx, "Start: {}, End: {}".format(
-                        doc_starts[-1], end_idx
-                    )
-                    doc_subseqs[-1] = raw_text[doc_idx][doc_starts[-1] : end_idx]
-                    doc_probs[-1].append(proba)
+                    # continue the current subsequence
+                    doc_spans[-1][1] = end_of_token_seq[token]
+            n_rows += len(keep)
 
             if end_of_doc:
                 # last chunk in a document
+                if doc_proba_rows:
+                    doc_probas = np.concatenate(doc_proba_rows)
+                doc_subseqs = []
+                doc_labels = []
+                doc_positions = []
                 prob_dicts = []
-                for prob_seq in doc_probs:
+                span_ends = [span[2] for span in doc_spans[1:]] + [n_rows]
+                for (start_idx, end_idx, row, label, position), row_end in zip(
+                    doc_spans, span_ends
+                ):
+                    doc_subseqs.append(raw_text[doc_idx][start_idx:end_idx])
+                    doc_labels.append(label)
+                    doc_positions.append(position)
                     # format probabilities as dictionary
-                    probs = np.mean(np.vstack(prob_seq), axis=0)
+                    probs = np.mean(doc_probas[row:row_end], axis=0)
                     prob_dicts.append(
                         dict(zip(self.input_pipeline.label_encoder.classes_, probs))
                     )
@@ -0,0 +1,126 @@
+"""
+Helpers to call blocking prediction methods from asyncio code.
+
+Session runs are sent to a single worker thread per device so that requests for the same device queue up
+instead of competing for it, while tokenization runs on a separate pool of threads and so overlaps with the
+model run of the previous request.
+"""
+import asyncio
+import functools
+import logging
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+
+from finetune.config import all_gpus
+
+LOGGER = logging.getLogger("finetune")
+
+_DEVICE_EXECUTORS = dict()
+_DEVICE_EXECUTORS_LOCK = threading.Lock()
+_DEFAULT_RUNNER = None
+
+
+def model_device(model):
+    """
+    Name of the device that `model` runs its sessions on.
+    """
+    visible_gpus = model.config.visible_gpus
+    if isinstance(visible_gpus, (list, tuple)):
+        gpus = all_gpus(visible_gpus=tuple(visible_gpus))
+    else:
+        gpus = all_gpus()
+    return "/gpu:{}".format(gpus[0]) if gpus else "/cpu:0"
+
+
+def device_executor(device):
+    """
+    The single thread executor that runs all sessions for `device`, shared by the whole process.
+    """
+    with _DEVICE_EXECUTORS_LOCK:
+        if device not in _DEVICE_EXECUTORS:
+            _DEVICE_EXECUTORS[device] = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="finetune-{}".format(device.strip("/"))
+            )
+        return _DEVICE_EXECUTORS[device]
+
+
+class AsyncRunner:
+    """
+    Runs blocking calls for asyncio callers.
+
+    :param max_pending: Maximum number of calls in flight. Further calls wait for a slot, which applies
+        backpressure to the caller. `None` for no limit.
+    :param tokenize_workers: Number of threads used to encode inputs ahead of their model run.
+    """
+
+    def __init__(self, max_pending=None, tokenize_workers=2):
+        self.max_pending = max_pending
+        self.tokenize_executor = ThreadPoolExecutor(
+            max_workers=tokenize_workers, thread_name_prefix="finetune-tokenize"
+        )
+        self._semaphores = weakref.WeakKeyDictionary()
+
+    def _slot(self):
+        # asyncio primitives belong to the event loop they are first used on.
+        loop = asyncio.get_running_loop()
+        if loop not in self._semaphores:
+            self._semaphores[loop] = asyncio.Semaphore(self.max_pending)
+        return self._semaphores[loop]
+
+    async def _pretokenize(self, pipeline, Xs):
+        loop = asyncio.get_running_loop()
+        try:
+            await loop.run_in_executor(self.tokenize_executor, pipeline.pretokenize, Xs)
+        except Exception as e:
+            # the model run encodes the inputs itself and raises any real error.
+            LOGGER.debug("Pretokenization failed: {}".format(e))
+
+    async def _run(self, get_model, fn, Xs, args, kwargs):
+        loop = asyncio.get_running_loop()
+        model = await loop.run_in_executor(None, get_model)
+        pipeline = model.input_pipeline
+        try:
+            await self._pretokenize(pipeline, Xs)
+            return await loop.run_in_executor(
+                device_executor(model_device(model)), functools.partial(fn, Xs, *args, **kwargs)
+            )
+        finally:
+            pipeline.discard_pretokenized(Xs)
+
+    async def run(self, get_model, fn, Xs, *args, timeout=None, **kwargs):
+        """
+        Calls `fn(Xs, *args, **kwargs)` on the device executor of the model returned by `get_model`.
+
+        :param get_model: Blocking function returning the model, eg. loading it. Run on the default executor.
+        :param fn: Blocking prediction function.
+        :param Xs: The inputs, encoded on the tokenization threads first.
+        :param timeout: Seconds before `asyncio.TimeoutError` is raised, including time spent waiting for a slot.
+        :return: The result of `fn`.
+
+        Cancelling the caller, or timing out, drops the call if it has not reached the device yet. A session run
+        that has already started cannot be interrupted and runs to completion in the background.
+        """
+        Xs = list(Xs)
+
+        async def run_with_slot():
+            if self.max_pending is None:
+                return await self._run(get_model, fn, Xs, args, kwargs)
+            async with self._slot():
+                return await self._run(get_model, fn, Xs, args, kwargs)
+
+        return await asyncio.wait_for(run_with_slot(), timeout)
+
+    def close(self):
+        self.tokenize_executor.shutdown(wait=False)
+
+
+def default_runner():
+    """
+    The runner shared by the async methods of every model that is not owned by a `Scheduler`.
+    """
+    global _DEFAULT_RUNNER
+    with _DEVICE_EXECUTORS_LOCK:
+        if _DEFAULT_RUNNER is None:
+            _DEFAULT_RUNNER = AsyncRunner()
+        return _DEFAULT_RUNNER
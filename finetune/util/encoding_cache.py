@@ -0,0 +1,215 @@
+"""
+Persistent on-disk cache of encoded (tokenized and chunked) documents.
+
+Each entry holds the chunks produced by `BasePipeline._text_to_ids` for a single document as a
+sequence of plain `.npy` arrays written back to back in one file: an int32 [3, n_tokens] array
+of token ids, starts and ends, a fixed-width unicode array of tokens and an int32 [n_chunks, 4]
+array of chunk lengths, useful starts / ends and offsets. No pickles are used, so every array
+can be memory-mapped at the offset following its header.
+"""
+import os
+import hashlib
+import logging
+import tempfile
+
+import numpy as np
+
+from finetune.encoding.input_encoder import EncodedOutput
+
+LOGGER = logging.getLogger("finetune")
+
+ENTRY_SUFFIX = ".enc"
+MISSING = -1
+
+
+def encoding_settings(pipeline):
+    """
+    Everything other than the text that changes the output of `pipeline._text_to_ids`: pipeline and encoder
+    classes, the base model and its vocab files or tokenizer and the length / chunking settings. Encoders such
+    as `HuggingFaceEncoder` share one class across base models and have no vocab files, so the base model is
+    always included.
+    """
+    config = pipeline.config
+    encoder = pipeline.text_encoder
+    return [
+        type(pipeline).__name__,
+        type(encoder).__name__,
+        str(getattr(encoder, "encoder_path", None)),
+        str(getattr(encoder, "vocab_path", None)),
+        str(getattr(getattr(encoder, "tokenizer", None), "name_or_path", None)),
+        config.base_model.__name__,
+        str(config.base_model_path),
+        str(config.max_length),
+        str(config.chunk_long_sequences),
+        str(config.chunk_context),
+        str(config.chunk_alignment),
+        str(config.add_eos_bos_to_chunk),
+        str(config.collapse_whitespace),
+        str(config.include_bos_eos),
+    ]
+
+
+def encoding_cache_key(text, pipeline):
+    """
+    Content address for the encoding of `text` by `pipeline`, see `encoding_settings`.
+    """
+    parts = [repr(text)] + encoding_settings(pipeline)
+    return hashlib.sha1("\x00".join(parts).encode("utf-8")).hexdigest()
+
+
+def _read_arrays(f, n_arrays):
+    return [np.lib.format.read_array(f, allow_pickle=False) for _ in range(n_arrays)]
+
+
+def _as_flat_array(value):
+    arr = np.asarray(value)
+    if arr.ndim != 1 or arr.dtype == object:
+        return None
+    return arr
+
+
+class EncodingCache:
+    """
+    A size-bounded cache of encoded documents that can be shared across processes and runs.
+
+    Writes are atomic (write to a temporary file then rename) so concurrent readers never see a
+    partial entry. When the total size exceeds `max_bytes` the least recently used entries are
+    evicted, using file modification times which are refreshed on every hit.
+    """
+
+    def __init__(self, cache_dir, max_bytes=None):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._size = self._scan_size()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + ENTRY_SUFFIX)
+
+    def _entries(self):
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith(ENTRY_SUFFIX):
+                    yield os.path.join(root, name)
+
+    def _scan_size(self):
+        size = 0
+        for path in self._entries():
+            try:
+                size += os.path.getsize(path)
+            except FileNotFoundError:
+                continue  # evicted by another process
+        return size
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "bytes": self._size,
+        }
+
+    def get(self, key, input_text):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                ints, tokens, chunks = _read_arrays(f, 3)
+            os.utime(path)
+        except (FileNotFoundError, ValueError, EOFError):
+            self.misses += 1
+            return None
+        self.hits += 1
+
+        outputs = []
+        position = 0
+        for length, useful_start, useful_end, offset in chunks.tolist():
+            end = position + length
+            outputs.append(
+                EncodedOutput(
+                    token_ids=ints[0, position:end],
+                    token_starts=ints[1, position:end],
+                    token_ends=ints[2, position:end],
+                    tokens=tokens[position:end],
+                    useful_start=None if useful_start == MISSING else useful_start,
+                    useful_end=None if useful_end == MISSING else useful_end,
+                    offset=None if offset == MISSING else offset,
+                    input_text=input_text,
+                )
+            )
+            position = end
+        return outputs
+
+    def put(self, key, encoded, input_text):
+        """
+        Store the chunks of one document. Outputs that cannot be represented as flat arrays
+        (eg. multi-field comparison inputs) or that encode text other than `input_text` are not cached.
+        """
+        ints, tokens, chunks = [], [], []
+        for out in encoded:
+            if out.input_text != input_text:
+                return False
+            fields = [
+                _as_flat_array(getattr(out, field))
+                for field in ["token_ids", "token_starts", "token_ends", "tokens"]
+            ]
+            if any(field is None for field in fields) or len(set(map(len, fields))) != 1:
+                return False
+            ints.append(np.stack(fields[:3]).astype(np.int32))
+            tokens.append(fields[3].astype(str))
+            chunks.append(
+                [
+                    len(fields[0]),
+                    MISSING if out.useful_start is None else out.useful_start,
+                    MISSING if out.useful_end is None else out.useful_end,
+                    MISSING if out.offset is None else out.offset,
+                ]
+            )
+
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for arr in [
+                    np.concatenate(ints, axis=1),
+                    np.concatenate(tokens),
+                    np.asarray(chunks, dtype=np.int32),
+                ]:
+                    np.lib.format.write_array(f, arr, allow_pickle=False)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self._size += os.path.getsize(path)
+        if self.max_bytes is not None and self._size > self.max_bytes:
+            self.evict()
+        return True
+
+    def evict(self):
+        """
+        Remove least recently used entries until the cache is under 90% of `max_bytes`.
+        Other processes may be writing to the same directory so the size is re-scanned first.
+        """
+        entries = []
+        for path in self._entries():
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        self._size = sum(size for _, size, _ in entries)
+        target = 0.9 * self.max_bytes
+        for _, size, path in entries:
+            if self._size <= target:
+                break
+            try:
+                os.remove(path)
+                self.evictions += 1
+            except FileNotFoundError:
+                pass
+            self._size -= size
@@ -0,0 +1,216 @@
+"""
+Persistent on-disk cache of the outputs of a frozen featurizer.
+
+When no featurizer variable is trained, the featurizer outputs for an example only depend on its token
+ids and the base model weights. They are computed once, stored here and fed to the target model in
+place of the featurizer on every epoch, so only the target model is run during training.
+
+Entries are keyed by a hash of the token ids, within a directory keyed by the base model. Outputs are
+written in shards, each a file in the memory-mappable format of `finetune.util.mapped_weights` holding
+the outputs of many examples under `<example key>/<output name>`. Shards are added with an atomic rename
+so the cache can be shared between processes and runs, and the least recently used shards are evicted
+once the whole cache directory grows over a size bound.
+"""
+import os
+import uuid
+import hashlib
+import logging
+import tempfile
+
+import numpy as np
+import tensorflow as tf
+
+from finetune.util.mapped_weights import dump_weights, load_weights
+
+LOGGER = logging.getLogger("finetune")
+
+SHARD_SUFFIX = ".ftw"
+# Outputs are written to a new shard once they reach this size.
+SHARD_BYTES = 2 ** 28
+# Featurizer outputs that target models read, the cached value replaces the featurizer output of the same name.
+CACHED_OUTPUTS = ("features", "sequence_features", "lengths")
+# Outputs with one entry per token, batched with padding.
+SEQUENCE_OUTPUTS = ("sequence_features",)
+CACHED_FEATURE_PREFIX = "cached_featurizer_"
+
+
+def cached_feature_name(output):
+    """
+    Name of the input feature that holds the cached value of a featurizer output.
+    """
+    return CACHED_FEATURE_PREFIX + output
+
+
+def cached_featurizer_state(features):
+    """
+    The featurizer state read back from the cached input features, or None if the features are not cached.
+    """
+    if cached_feature_name(CACHED_OUTPUTS[0]) not in features:
+        return None
+    return {output: features[cached_feature_name(output)] for output in CACHED_OUTPUTS}
+
+
+def cached_feature_types(outputs):
+    """
+    Dataset types and shapes of the cached input features, given the cached outputs of any one example.
+    """
+    TS = tf.TensorShape
+    types, shapes = {}, {}
+    for output, value in outputs.items():
+        types[cached_feature_name(output)] = tf.as_dtype(value.dtype)
+        if output in SEQUENCE_OUTPUTS:
+            shapes[cached_feature_name(output)] = TS([None] + list(value.shape[1:]))
+        else:
+            shapes[cached_feature_name(output)] = TS(value.shape)
+    return types, shapes
+
+
+def featurizer_cache_key(config, weights_path):
+    """
+    Identifies the featurizer whose outputs are cached: the base model, its weights file and every config
+    field the featurizer reads (`SourceModel.featurizer_settings`), plus the precision it is run at.
+    """
+    try:
+        stat = os.stat(weights_path)
+        weights = "{}:{}:{}".format(os.path.abspath(weights_path), stat.st_size, int(stat.st_mtime))
+    except (TypeError, OSError):
+        weights = str(weights_path)
+    settings = sorted(set(config.base_model.featurizer_settings) | {"float_16_predict"})
+    parts = [config.base_model.__name__, weights] + [
+        "{}={!r}".format(setting, config.get(setting)) for setting in settings
+    ]
+    return hashlib.sha1("\x00".join(parts).encode("utf-8")).hexdigest()
+
+
+class FeaturizerCache:
+    """
+    Featurizer outputs stored under `cache_dir`, in a subdirectory for `key` (see `featurizer_cache_key`).
+    Cached arrays are memory-mapped, they are only read from disk as they are fed to the model.
+
+    When the total size of the shards under `cache_dir`, for any key, exceeds `max_bytes` the least recently
+    used shards are evicted, using file modification times which are refreshed when a shard is first read.
+    Arrays already returned by `get` stay readable after their shard is evicted.
+    """
+
+    def __init__(self, cache_dir, key, max_bytes=None):
+        self.root = cache_dir
+        self.cache_dir = os.path.join(cache_dir, key)
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.evictions = 0
+        self._shards = dict()  # path -> mapped shard
+        self._entries = dict()  # example key -> path of the shard holding its outputs
+        self._touched = set()
+        self._size = sum(size for _, size, _ in self._scan())
+        self.refresh()
+
+    @staticmethod
+    def example_key(token_ids):
+        return hashlib.sha1(np.asarray(token_ids, dtype=np.int32).tobytes()).hexdigest()
+
+    def _scan(self):
+        """
+        (mtime, size, path) of every shard under the cache root.
+        """
+        for root, _, files in os.walk(self.root):
+            for name in files:
+                if not name.endswith(SHARD_SUFFIX):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue  # evicted by another process
+                yield stat.st_mtime, stat.st_size, path
+
+    def refresh(self):
+        """
+        Map any shards written since the last refresh, eg. by another process.
+        """
+        for filename in sorted(os.listdir(self.cache_dir)):
+            path = os.path.join(self.cache_dir, filename)
+            if not filename.endswith(SHARD_SUFFIX) or path in self._shards:
+                continue
+            try:
+                shard, _ = load_weights(path)
+            except (OSError, ValueError) as e:
+                LOGGER.warning("Skipping unreadable featurizer cache shard {}: {}".format(path, e))
+                continue
+            self._shards[path] = shard
+            for name in shard:
+                self._entries.setdefault(name.partition("/")[0], path)
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "shards": len(self._shards),
+            "evictions": self.evictions,
+            "bytes": self._size,
+        }
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        path = self._entries.get(key)
+        if path is None:
+            return None
+        if path not in self._touched:
+            self._touched.add(path)
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                pass
+        shard = self._shards[path]
+        return {output: shard["{}/{}".format(key, output)] for output in CACHED_OUTPUTS}
+
+    def put(self, outputs):
+        """
+        Store the outputs of several examples as a new shard.
+
+        :param outputs: Dict from example key to a dict of the `CACHED_OUTPUTS` of that example.
+        """
+        if not outputs:
+            return
+        variables = {
+            "{}/{}".format(key, output): value
+            for key, example in outputs.items()
+            for output, value in example.items()
+        }
+        path = os.path.join(self.cache_dir, uuid.uuid4().hex + SHARD_SUFFIX)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                dump_weights(variables, f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self._size += os.path.getsize(path)
+        self._touched.add(path)
+        self.refresh()
+        if self.max_bytes is not None and self._size > self.max_bytes:
+            self.evict(keep=path)
+
+    def evict(self, keep=None):
+        """
+        Remove least recently used shards, other than `keep`, until the cache is under 90% of `max_bytes`.
+        Other processes may be writing to the same directory so the size is re-scanned first.
+        """
+        shards = sorted(self._scan())
+        self._size = sum(size for _, size, _ in shards)
+        target = 0.9 * self.max_bytes
+        for _, size, path in shards:
+            if self._size <= target:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+                self.evictions += 1
+            except FileNotFoundError:
+                pass
+            self._size -= size
+            if self._shards.pop(path, None) is not None:
+                self._entries = {key: shard_path for key, shard_path in self._entries.items() if shard_path != path}
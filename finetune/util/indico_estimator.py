@@ -1,3 +1,6 @@
+import queue
+import threading
+
 import numpy as np
 import tensorflow as tf
 
@@ -12,6 +15,74 @@ def parse_input_fn_result(result):
     return result, init
 
 
+class _FeederDone:
+    pass
+
+
+class FeatureFeeder:
+    """
+    Runs the predict input pipeline in its own graph and session on a background thread,
+    handing padded batches to the consumer through a bounded queue. This lets the model
+    session start on the first batch while the rest of the dataset is still being tokenized,
+    and caps the number of batches held in host memory at `queue_size`.
+    """
+
+    def __init__(self, input_fn, call_input_fn, session_config, queue_size=8, predict=True):
+        self.queue = queue.Queue(maxsize=max(1, queue_size))
+        self.stop_event = threading.Event()
+        self.g = tf.Graph()
+        with self.g.as_default():
+            result = call_input_fn(input_fn, tf.estimator.ModeKeys.PREDICT)
+            features, initializer = parse_input_fn_result(result)
+            if type(features) == tuple and predict:
+                features = features[0]
+            self.features = features
+            self.sess = tf.compat.v1.Session(config=session_config)
+            self.sess.run(initializer)
+        self.thread = threading.Thread(target=self._feed, daemon=True)
+        self.thread.start()
+
+    def _put(self, item):
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _feed(self):
+        try:
+            while not self.stop_event.is_set():
+                try:
+                    batch = self.sess.run(self.features)
+                except tf.errors.OutOfRangeError:
+                    break
+                if not self._put(batch):
+                    return
+            self._put(_FeederDone)
+        except Exception as e:
+            self._put(e)
+
+    def __iter__(self):
+        try:
+            while True:
+                item = self.queue.get()
+                if item is _FeederDone:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            self.close()
+
+    def close(self):
+        self.stop_event.set()
+        if self.thread.is_alive() and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.sess.close()
+
+
 class IndicoEstimator(tf.estimator.Estimator):
     def __init__(self, *args, **kwargs):
         self.estimator_spec = None
@@ -56,58 +127,74 @@ class IndicoEstimator(tf.estimator.Estimator):
         hooks=None,
         checkpoint_path=None,
         yield_single_examples=True,
+        queue_size=None,
     ):
         # Check that model has been trained.
         self.g = self.g or tf.Graph()
         tf.compat.v1.set_random_seed(self._config.tf_random_seed)
-        features_real, features = self.get_features_from_fn(input_fn)
+        if queue_size:
+            features_real = FeatureFeeder(
+                input_fn,
+                call_input_fn=self._call_input_fn,
+                session_config=self._session_config,
+                queue_size=queue_size,
+            )
+            features = features_real.features
+        else:
+            features_real, features = self.get_features_from_fn(input_fn)
         with self.g.as_default():
-            if self.estimator_spec is None:
-                self._create_and_assert_global_step(self.g)
-                if not checkpoint_path:
-                    checkpoint_path = tf.train.latest_checkpoint(self._model_dir)
-                if not checkpoint_path:
-                    tf.compat.v1.logging.info(
-                        "Could not find trained model in model_dir: {}, running "
-                        "initialization to predict.".format(self._model_dir)
+            try:
+                if self.estimator_spec is None:
+                    self._create_and_assert_global_step(self.g)
+                    if not checkpoint_path:
+                        checkpoint_path = tf.train.latest_checkpoint(self._model_dir)
+                    if not checkpoint_path:
+                        tf.compat.v1.logging.info(
+                            "Could not find trained model in model_dir: {}, running "
+                            "initialization to predict.".format(self._model_dir)
+                        )
+
+                    self.placeholder_feats = tf.nest.map_structure(
+                        placeholder_like, features
+                    )
+                    self.estimator_spec = self._call_model_fn(
+                        self.placeholder_feats,
+                        None,
+                        tf.estimator.ModeKeys.PREDICT,
+                        self.config,
                     )
+                    # Call to warm_start has to be after model_fn is called.
+                    self._maybe_warm_start(checkpoint_path)
 
-                self.placeholder_feats = tf.nest.map_structure(
-                    placeholder_like, features
-                )
-                self.estimator_spec = self._call_model_fn(
-                    self.placeholder_feats,
-                    None,
-                    tf.estimator.ModeKeys.PREDICT,
-                    self.config,
-                )
-                # Call to warm_start has to be after model_fn is called.
-                self._maybe_warm_start(checkpoint_path)
-
-                self.predictions = self._extract_keys(
-                    self.estimator_spec.predictions, predict_keys
-                )
-                all_hooks = hooks or []
-                all_hooks.extend(list(self.estimator_spec.prediction_hooks or []))
-
-                self.mon_sess = tf.compat.v1.train.MonitoredSession(
-                    session_creator=tf.compat.v1.train.ChiefSessionCreator(
-                        checkpoint_filename_with_path=checkpoint_path,
-                        master=self._config.master,
-                        scaffold=self.estimator_spec.scaffold,
-                        config=self._session_config,
-                    ),
-                    hooks=all_hooks,
-                )
+                    # The graph is built once with every prediction head, each call then only fetches
+                    # the heads it asks for, so large outputs like sequence features are not copied back
+                    # to the host unless they are needed.
+                    self.predictions = self.estimator_spec.predictions
+                    all_hooks = hooks or []
+                    all_hooks.extend(list(self.estimator_spec.prediction_hooks or []))
+
+                    self.mon_sess = tf.compat.v1.train.MonitoredSession(
+                        session_creator=tf.compat.v1.train.ChiefSessionCreator(
+                            checkpoint_filename_with_path=checkpoint_path,
+                            master=self._config.master,
+                            scaffold=self.estimator_spec.scaffold,
+                            config=self._session_config,
+                        ),
+                        hooks=all_hooks,
+                    )
 
+                predictions = self._extract_keys(self.predictions, predict_keys)
+            except BaseException:
+                # the feeder is closed by iterating over it below, close it here if that never happens.
+                if isinstance(features_real, FeatureFeeder):
+                    features_real.close()
+                raise
             for feats in features_real:
                 feed_dict = {self.placeholder_feats[k]: v for k, v in feats.items()}
-                preds_evaluated = self.mon_sess.run(
-                    self.predictions, feed_dict=feed_dict
-                )
+                preds_evaluated = self.mon_sess.run(predictions, feed_dict=feed_dict)
                 if not yield_single_examples:
                     yield preds_evaluated
-                elif not isinstance(self.predictions, dict):
+                elif not isinstance(predictions, dict):
                     for pred in preds_evaluated:
                         yield pred
                 else:
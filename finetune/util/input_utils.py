@@ -1,9 +1,14 @@
 import math
+import bisect
+import logging
 
+import numpy as np
 import tensorflow as tf
 
 from finetune.util.timing import ProgressBar
 
+LOGGER = logging.getLogger("finetune")
+
 
 class InputMode:
     PREDICT = "predict"
@@ -49,6 +54,19 @@ def validation_settings(
     return int(val_size), val_interval
 
 
+def start_end_gen(gen):
+    """
+    yields from generator along with booleans for start and end.
+    """
+    start = True
+    previous = next(gen)
+    for g in gen:
+        yield previous, start, False
+        previous = g
+        start = False
+    yield previous, start, True
+
+
 def has_targets(generator):
     sample = next(iter(generator()))
     return isinstance(sample, tuple) and len(sample) == 2
@@ -79,6 +97,165 @@ def batch_dataset(dataset, batch_size, shapes, n_epochs=1):
     return batched_dataset
 
 
+def length_buckets(max_length, min_length=16):
+    """
+    Bucket boundaries for token budget batching: powers of two from `min_length` up to `max_length`.
+    """
+    boundaries = []
+    boundary = min_length
+    while boundary < max_length:
+        boundaries.append(boundary)
+        boundary *= 2
+    return boundaries + [max_length]
+
+
+def _bucket_length(length, boundaries):
+    idx = bisect.bisect_left(boundaries, length)
+    return boundaries[idx] if idx < len(boundaries) else length
+
+
+def _pad_batch(examples, seq_length):
+    # Pads every feature to the largest example, features aligned with the tokens are padded to `seq_length`.
+    lengths = [len(example["tokens"]) for example in examples]
+    batch = {"length": np.asarray(lengths, dtype=np.int32)}
+    for key in examples[0]:
+        values = [np.asarray(example[key]) for example in examples]
+        target_shape = [max(dims) for dims in zip(*[value.shape for value in values])]
+        if target_shape and all(value.shape[0] == length for value, length in zip(values, lengths)):
+            target_shape[0] = max(target_shape[0], seq_length)
+        padded = np.zeros([len(values)] + target_shape, dtype=values[0].dtype)
+        for i, value in enumerate(values):
+            padded[(i,) + tuple(slice(0, dim) for dim in value.shape)] = value
+        batch[key] = padded
+    return batch
+
+
+def token_budget_batches(examples, max_tokens, boundaries, order_sink, window_batches=8):
+    """
+    Groups examples into batches of similar length, capped at `max_tokens` tokens including padding.
+
+    Examples are read into a window worth roughly `window_batches` batches, sorted by their length bucket
+    and cut into batches padded to the bucket of their longest example. The position of each example in
+    `examples` is appended to `order_sink` as its batch is produced, see `restore_order`.
+
+    :param examples: An iterable of feature dicts, each with a "tokens" array.
+    :param max_tokens: Maximum of batch size * padded length.
+    :param boundaries: Sorted bucket boundaries, see `length_buckets`.
+    :param order_sink: A deque that receives example indices in the order they are batched.
+    :return: A generator of padded batches, with the unpadded lengths under "length".
+    """
+    order_sink.clear()
+
+    def flush(window):
+        window.sort(key=lambda item: item[0])
+        batch = []
+        for bucket, idx, example in window:
+            if batch and (len(batch) + 1) * bucket > max_tokens:
+                yield batch
+                batch = []
+            batch.append((bucket, idx, example))
+        if batch:
+            yield batch
+
+    def batches():
+        window = []
+        window_tokens = 0
+        for idx, example in enumerate(examples):
+            bucket = _bucket_length(len(example["tokens"]), boundaries)
+            window.append((bucket, idx, example))
+            window_tokens += bucket
+            if window_tokens >= window_batches * max_tokens:
+                yield from flush(window)
+                window = []
+                window_tokens = 0
+        yield from flush(window)
+
+    for batch in batches():
+        order_sink.extend(idx for _, idx, _ in batch)
+        yield _pad_batch([example for _, _, example in batch], batch[-1][0])
+
+
+def _padding_ratio(lengths, batches):
+    padded = sum(len(batch) * lengths[batch].max() for batch in batches)
+    return 1.0 - lengths.sum() / max(padded, 1)
+
+
+def length_bucketed_epochs(examples, batch_size, boundaries, seed):
+    """
+    Orders training examples so that consecutive runs of `batch_size` examples have similar lengths.
+
+    Each call returns one epoch: examples are shuffled within their length bucket, cut into batches in
+    bucket order, then the full batches are shuffled. The number of batches per epoch is the same as
+    without bucketing and the partial batch, if any, stays last so that `padded_batch(batch_size)` sees
+    the same batch boundaries.
+
+    :param examples: A list of examples, either feature dicts or (features, target) tuples.
+    :param batch_size: The batch size the examples will be batched with.
+    :param boundaries: Sorted bucket boundaries, see `length_buckets`.
+    :param seed: Seed for the shuffles, offset by the epoch number.
+    :return: A function that returns the examples for the next epoch.
+    """
+    lengths = np.asarray(
+        [len((example[0] if isinstance(example, tuple) else example)["tokens"]) for example in examples]
+    )
+    buckets = np.asarray([_bucket_length(length, boundaries) for length in lengths])
+    unbucketed_ratio = _padding_ratio(
+        lengths, [np.arange(i, min(i + batch_size, len(examples))) for i in range(0, len(examples), batch_size)]
+    )
+    epoch = 0
+
+    def data_fn():
+        nonlocal epoch
+        rng = np.random.RandomState(seed + epoch)
+        epoch += 1
+        order = rng.permutation(len(examples))
+        order = order[np.argsort(buckets[order], kind="stable")]
+        batches = [order[i : i + batch_size] for i in range(0, len(order), batch_size)]
+        n_full = len(order) // batch_size
+        batches = [batches[i] for i in rng.permutation(n_full)] + batches[n_full:]
+        LOGGER.info(
+            "Epoch {}: {:.1%} of training tokens are padding ({:.1%} without length bucketing)".format(
+                epoch, _padding_ratio(lengths, batches), unbucketed_ratio
+            )
+        )
+        return [examples[i] for batch in batches for i in batch]
+
+    return data_fn
+
+
+def restore_order(predictions, order):
+    """
+    Re-orders per-example predictions of batches produced by `token_budget_batches` back to input order.
+    """
+    pending = {}
+    next_idx = 0
+    for pred in predictions:
+        pending[order.popleft()] = pred
+        while next_idx in pending:
+            yield pending.pop(next_idx)
+            next_idx += 1
+
+
+def token_budget_dataset(data_fn, types, shapes, max_tokens, boundaries, order_sink):
+    """
+    Alternative to `batch_dataset` for prediction, see `token_budget_batches`.
+    """
+    types = {**types, "length": tf.int32}
+    shapes = {
+        **{key: tf.TensorShape([None]).concatenate(shape) for key, shape in shapes.items()},
+        "length": tf.TensorShape([None]),
+    }
+
+    def batched_dataset():
+        return tf.data.Dataset.from_generator(
+            lambda: token_budget_batches(data_fn(), max_tokens, boundaries, order_sink),
+            types,
+            shapes,
+        ).prefetch(tf.data.experimental.AUTOTUNE)
+
+    return batched_dataset
+
+
 def wrap_tqdm(
     gen,
     mode,
@@ -0,0 +1,153 @@
+"""
+A memory-mappable on-disk format for model weights.
+
+Files start with `MAGIC` followed by one raw, uncompressed array per variable, each aligned to
+`ALIGNMENT` bytes. An optional joblib blob (the pickled model object for fine-tuned models) follows
+the arrays, then a JSON index mapping variable names to their dtype, shape and offset, and finally
+the offset of that index as a little-endian uint64. Files are opened with `mmap`, so variables are
+only read from disk when they are used and the pages are shared between every process that opens
+the same file.
+"""
+import io
+import os
+import json
+import mmap
+import struct
+import tempfile
+from collections.abc import Mapping
+
+import joblib
+import numpy as np
+
+MAGIC = b"\x93FTWEIGHTS\x01"
+ALIGNMENT = 64
+_FOOTER = struct.Struct("<Q")
+
+
+def is_mapped_weights(path):
+    """
+    Whether `path` (a filename or seekable file object) is in the memory-mappable weight format.
+    """
+    if isinstance(path, str):
+        with open(path, "rb") as f:
+            return f.read(len(MAGIC)) == MAGIC
+    position = path.tell()
+    try:
+        return path.read(len(MAGIC)) == MAGIC
+    finally:
+        path.seek(position)
+
+
+def _pad(position):
+    return b"\x00" * (-position % ALIGNMENT)
+
+
+def dump_weights(variables, path, obj=None):
+    """
+    Write a dict of arrays, and optionally an object to pickle alongside them, to `path`.
+
+    :param variables: Dict from variable name to array.
+    :param path: Filename or writeable file object. Files are written next to `path` and renamed over it
+        once complete, so processes that have mapped the previous file keep reading its original contents.
+    :param obj: Optional object stored with joblib, eg. the model that owns the weights.
+    """
+    if isinstance(path, str):
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(path) or ".", prefix=".tmp-", suffix=os.path.basename(path)
+        )
+        try:
+            with os.fdopen(fd, "wb") as f:
+                dump_weights(variables, f, obj=obj)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return
+
+    index = {"variables": {}, "object": None}
+    path.write(MAGIC)
+    position = len(MAGIC)
+    for name, value in variables.items():
+        value = np.asarray(value)
+        if value.dtype.hasobject:
+            raise ValueError("Cannot store variable {} with dtype {}".format(name, value.dtype))
+        padding = _pad(position)
+        path.write(padding)
+        position += len(padding)
+        index["variables"][name] = {
+            "dtype": value.dtype.str,
+            "shape": list(value.shape),
+            "offset": position,
+        }
+        path.write(value.tobytes())
+        position += value.nbytes
+
+    if obj is not None:
+        buffer = io.BytesIO()
+        joblib.dump(obj, buffer)
+        blob = buffer.getvalue()
+        index["object"] = {"offset": position, "length": len(blob)}
+        path.write(blob)
+        position += len(blob)
+
+    path.write(json.dumps(index).encode("utf-8"))
+    path.write(_FOOTER.pack(position))
+
+
+def load_weights(path):
+    """
+    Open a file written by `dump_weights`.
+
+    :param path: Filename or file object. Filenames are memory-mapped, file objects are read into memory.
+    :return: A tuple of a read-only `MappedWeights` mapping and the stored object (or None).
+    """
+    if isinstance(path, str):
+        with open(path, "rb") as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    else:
+        buffer = path.read()
+
+    (index_offset,) = _FOOTER.unpack_from(buffer, len(buffer) - _FOOTER.size)
+    index = json.loads(bytes(buffer[index_offset : len(buffer) - _FOOTER.size]).decode("utf-8"))
+    obj = None
+    if index["object"] is not None:
+        start = index["object"]["offset"]
+        obj = joblib.load(io.BytesIO(buffer[start : start + index["object"]["length"]]))
+    return MappedWeights(buffer, index["variables"]), obj
+
+
+class MappedWeights(Mapping):
+    """
+    Read-only dict-like view over the variables of a weights file. Arrays are created on access
+    and backed directly by the underlying buffer, they are never copied into the heap.
+    """
+
+    def __init__(self, buffer, index):
+        self._buffer = buffer
+        self._index = index
+
+    def __getitem__(self, name):
+        entry = self._index[name]
+        dtype = np.dtype(entry["dtype"])
+        shape = tuple(entry["shape"])
+        flat = np.frombuffer(
+            self._buffer, dtype=dtype, count=int(np.prod(shape)), offset=entry["offset"]
+        )
+        return np.reshape(flat, shape)
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, name):
+        return name in self._index
+
+
+def convert_weights(joblib_path, path):
+    """
+    Convert a joblib weights file, eg. a base model from the finetune file store, to this format.
+    """
+    dump_weights(joblib.load(joblib_path), path)
@@ -1,13 +1,15 @@
 import os
-import copy
+import struct
+from bisect import bisect_left, bisect_right
 from functools import partial
+from itertools import accumulate
 from collections import defaultdict, OrderedDict
 
 import numpy as np
 from sklearn.metrics import confusion_matrix
 
+from tensorflow.core.util import event_pb2
 from tensorflow.python.platform import gfile
-from tensorflow.python.summary import summary_iterator
 
 import tabulate
 
@@ -21,68 +23,70 @@ def _get_unique_classes(true, predicted):
         [seq['label'] for seqs in true_and_pred for seq in seqs]
     ))
 
-def _convert_to_token_list(annotations, doc_idx=None):
+def _tokenize(texts, n_process=1):
+    """
+    Map from each distinct text to the (offset, text) of its spaCy tokens. Texts are tokenized
+    together with `nlp.pipe`, using `n_process` worker processes if greater than 1.
+    """
     nlp = get_spacy()
-    tokens = []
-    annotations = copy.deepcopy(annotations)
+    unique_texts = list(OrderedDict.fromkeys(texts))
+    # n_process is not supported before spaCy 2.2
+    pipe_kwargs = {"n_process": n_process} if n_process != 1 else {}
+    return {
+        text: [(token.idx, token.text) for token in doc]
+        for text, doc in zip(unique_texts, nlp.pipe(unique_texts, **pipe_kwargs))
+    }
+
+def _convert_to_token_list(annotations, tokenized, doc_idx=None):
+    return [
+        {
+            'start': annotation.get('start') + idx,
+            'end': annotation.get('start') + idx + len(text),
+            'text': text,
+            'label': annotation.get('label'),
+            'doc_idx': doc_idx
+        }
+        for annotation in annotations
+        for idx, text in tokenized[annotation.get('text')]
+    ]
 
+def _token_labels(tokens, annotations, none_class):
+    """
+    Label of the first annotation that starts or ends within each token, as in `sequences_overlap`.
+    """
+    token_starts = [idx for idx, _ in tokens]
+    token_ends = [idx + len(text) for idx, text in tokens]
+    labels = [None] * len(tokens)
     for annotation in annotations:
-        start_idx = annotation.get('start')
-        tokens.extend([
-            {
-                'start': start_idx + token.idx,
-                'end': start_idx + token.idx + len(token.text),
-                'text': token.text,
-                'label': annotation.get('label'),
-                'doc_idx': doc_idx
-            }
-            for token in nlp(annotation.get('text'))
-        ])
-
-    return tokens
-
-def sequence_labeling_token_confusion(text, true, predicted):
-    nlp = get_spacy()
+        # tokens do not overlap, so only the last token starting at or before a position can contain it.
+        start_token = bisect_right(token_starts, annotation['start']) - 1
+        if start_token >= 0 and annotation['start'] < token_ends[start_token] and labels[start_token] is None:
+            labels[start_token] = annotation['label']
+        end_token = bisect_left(token_starts, annotation['end']) - 1
+        if end_token >= 0 and annotation['end'] <= token_ends[end_token] and labels[end_token] is None:
+            labels[end_token] = annotation['label']
+    return [none_class if label is None else label for label in labels]
+
+def sequence_labeling_token_confusion(text, true, predicted, n_process=1):
     none_class = "<None>"
     unique_classes = _get_unique_classes(true, predicted)
     unique_classes.append(none_class)
+    text = list(text)
+    tokenized = _tokenize(text, n_process=n_process)
 
     true_per_token_all = []
     pred_per_token_all = []
 
-    for i, (text_i, true_list, pred_list) in enumerate(zip(text, true, predicted)):
-        tokens = nlp(text_i)
-        true_per_token = []
-        pred_per_token = []
-        for token in tokens:
-            token_start_end = {"start": token.idx, "end": token.idx + len(token.text)}
-            for true_i in true_list:
-                if sequences_overlap(
-                    token_start_end,
-                    true_i
-                ):
-                    true_per_token.append(true_i["label"])
-                    break
-            else:
-                true_per_token.append(none_class)
-
-            for	pred_i in pred_list:
-                if sequences_overlap(
-                    token_start_end,
-                    pred_i
-                ):
-                    pred_per_token.append(pred_i["label"])
-                    break
-            else:
-                pred_per_token.append(none_class)
-        true_per_token_all.extend(true_per_token)
-        pred_per_token_all.extend(pred_per_token)
+    for text_i, true_list, pred_list in zip(text, true, predicted):
+        tokens = tokenized[text_i]
+        true_per_token_all.extend(_token_labels(tokens, true_list, none_class))
+        pred_per_token_all.extend(_token_labels(tokens, pred_list, none_class))
     cm = confusion_matrix(y_true=true_per_token_all, y_pred=pred_per_token_all, labels=unique_classes)
     return tabulate.tabulate([["Predicted\nTrue", *unique_classes]] + [[l, *r] for l, r in zip(unique_classes, cm)])
     
         
 
-def sequence_labeling_token_counts(true, predicted):
+def sequence_labeling_token_counts(true, predicted, n_process=1):
     """
     Return FP, FN, and TP counts
     """
@@ -97,34 +101,34 @@ def sequence_labeling_token_counts(true, predicted):
         }
         for cls_ in unique_classes
     }
-    
+    tokenized = _tokenize(
+        [annotation.get('text') for annotations in list(true) + list(predicted) for annotation in annotations],
+        n_process=n_process
+    )
+
     for i, (true_list, pred_list) in enumerate(zip(true, predicted)):
-        true_tokens = _convert_to_token_list(true_list, doc_idx=i)
-        pred_tokens = _convert_to_token_list(pred_list, doc_idx=i)
+        true_tokens = _convert_to_token_list(true_list, tokenized, doc_idx=i)
+        pred_tokens = _convert_to_token_list(pred_list, tokenized, doc_idx=i)
+
+        first_pred_tokens = {}
+        for pred_token in pred_tokens:
+            first_pred_tokens.setdefault((pred_token['start'], pred_token['end']), pred_token)
 
         # correct + false negatives
         for true_token in true_tokens:
-            for pred_token in pred_tokens:
-                if (pred_token['start'] == true_token['start'] and
-                    pred_token['end'] == true_token['end']):
-
-                    if pred_token['label'] == true_token['label']:
-                        d[true_token['label']]['true_positives'].append(true_token)
-                    else:
-                        d[true_token['label']]['false_negatives'].append(true_token)
-                        d[pred_token['label']]['false_positives'].append(pred_token)
-                    
-                    break
+            pred_token = first_pred_tokens.get((true_token['start'], true_token['end']))
+            if pred_token is None:
+                d[true_token['label']]['false_negatives'].append(true_token)
+            elif pred_token['label'] == true_token['label']:
+                d[true_token['label']]['true_positives'].append(true_token)
             else:
                 d[true_token['label']]['false_negatives'].append(true_token)
+                d[pred_token['label']]['false_positives'].append(pred_token)
 
         # false positives
+        true_spans = {(true_token['start'], true_token['end']) for true_token in true_tokens}
         for pred_token in pred_tokens:
-            for true_token in true_tokens:
-                if (pred_token['start'] == true_token['start'] and
-                    pred_token['end'] == true_token['end']):
-                    break
-            else:
+            if (pred_token['start'], pred_token['end']) not in true_spans:
                 d[pred_token['label']]['false_positives'].append(pred_token)
     
     return d
@@ -151,9 +155,7 @@ def calc_f1(recall, precision):
         return 0.0
 
 
-def seq_recall(true, predicted, span_type="token"):
-    count_fn = get_seq_count_fn(span_type)
-    class_counts = count_fn(true, predicted)
+def _recalls(class_counts):
     results = {}
     for cls_, counts in class_counts.items():
         FN = len(counts['false_negatives'])
@@ -162,9 +164,7 @@ def seq_recall(true, predicted, span_type="token"):
     return results
 
 
-def seq_precision(true, predicted, span_type="token"):
-    count_fn = get_seq_count_fn(span_type)
-    class_counts = count_fn(true, predicted)
+def _precisions(class_counts):
     results = {}
     for cls_, counts in class_counts.items():
         FP = len(counts['false_positives'])
@@ -173,8 +173,18 @@ def seq_precision(true, predicted, span_type="token"):
     return results
 
 
-def micro_f1(true, predicted, span_type="token"):
-    count_fn = get_seq_count_fn(span_type)
+def seq_recall(true, predicted, span_type="token", n_process=1):
+    count_fn = get_seq_count_fn(span_type, n_process=n_process)
+    return _recalls(count_fn(true, predicted))
+
+
+def seq_precision(true, predicted, span_type="token", n_process=1):
+    count_fn = get_seq_count_fn(span_type, n_process=n_process)
+    return _precisions(count_fn(true, predicted))
+
+
+def micro_f1(true, predicted, span_type="token", n_process=1):
+    count_fn = get_seq_count_fn(span_type, n_process=n_process)
     class_counts = count_fn(true, predicted)
     TP, FP, FN = 0, 0, 0
     for cls_, counts in class_counts.items():
@@ -186,11 +196,11 @@ def micro_f1(true, predicted, span_type="token"):
     return calc_f1(recall, precision)
 
 
-def per_class_f1(true, predicted, span_type="token"):
+def per_class_f1(true, predicted, span_type="token", n_process=1):
     """
     F1-scores per class
     """
-    count_fn = get_seq_count_fn(span_type)
+    count_fn = get_seq_count_fn(span_type, n_process=n_process)
     class_counts = count_fn(true, predicted)
     results = OrderedDict()
     for cls_, counts in class_counts.items():
@@ -205,15 +215,15 @@ def per_class_f1(true, predicted, span_type="token"):
     return results
 
 
-def sequence_f1(true, predicted, span_type="token", average=None):
+def sequence_f1(true, predicted, span_type="token", average=None, n_process=1):
     """
     If average = None, return per-class F1 scores, otherwise
     return the requested model-level score.
     """
     if average == "micro":
-        return micro_f1(true, predicted, span_type)
+        return micro_f1(true, predicted, span_type, n_process=n_process)
 
-    f1s_by_class = per_class_f1(true, predicted, span_type)
+    f1s_by_class = per_class_f1(true, predicted, span_type, n_process=n_process)
     f1s = [value.get("f1-score") for key, value in f1s_by_class.items()]
     supports = [value.get("support") for key, value in f1s_by_class.items()]
 
@@ -284,11 +294,111 @@ def sequence_superset(true_seq, pred_seq):
     return pred_seq["start"] <= true_seq["start"] and pred_seq["end"] >= true_seq["end"]
 
 
+def _overlap_matches(true_seqs, pred_seqs):
+    """
+    For each true seq whether a pred seq overlaps it, and for each pred seq whether it overlaps a true seq,
+    using sorted boundaries rather than comparing every pair.
+    """
+    pred_starts = sorted(pred_seq['start'] for pred_seq in pred_seqs)
+    pred_ends = sorted(pred_seq['end'] for pred_seq in pred_seqs)
+    true_matched = [
+        bisect_left(pred_starts, true_seq['start']) < bisect_left(pred_starts, true_seq['end']) or
+        bisect_right(pred_ends, true_seq['start']) < bisect_right(pred_ends, true_seq['end'])
+        for true_seq in true_seqs
+    ]
+
+    true_seqs = sorted(true_seqs, key=lambda seq: seq['start'])
+    true_starts = [true_seq['start'] for true_seq in true_seqs]
+    # furthest end of the true seqs starting before each position
+    max_true_ends = list(accumulate((true_seq['end'] for true_seq in true_seqs), max))
+    pred_matched = []
+    for pred_seq in pred_seqs:
+        start_idx = bisect_right(true_starts, pred_seq['start'])
+        end_idx = bisect_left(true_starts, pred_seq['end'])
+        pred_matched.append(
+            (start_idx > 0 and max_true_ends[start_idx - 1] > pred_seq['start']) or
+            (end_idx > 0 and max_true_ends[end_idx - 1] >= pred_seq['end'])
+        )
+    return true_matched, pred_matched
+
+
+def _exact_matches(true_seqs, pred_seqs):
+    true_spans = [(seq['start'], seq['end']) for seq in map(strip_whitespace, true_seqs)]
+    pred_spans = [(seq['start'], seq['end']) for seq in map(strip_whitespace, pred_seqs)]
+    true_span_set = set(true_spans)
+    pred_span_set = set(pred_spans)
+    return [span in pred_span_set for span in true_spans], [span in true_span_set for span in pred_spans]
+
+
+def _superset_matches(true_seqs, pred_seqs):
+    true_seqs = [strip_whitespace(seq) for seq in true_seqs]
+    pred_seqs = [strip_whitespace(seq) for seq in pred_seqs]
+
+    sorted_preds = sorted(pred_seqs, key=lambda seq: seq['start'])
+    pred_starts = [pred_seq['start'] for pred_seq in sorted_preds]
+    # furthest end of the pred seqs starting at or before each position
+    max_pred_ends = list(accumulate((pred_seq['end'] for pred_seq in sorted_preds), max))
+    true_matched = []
+    for true_seq in true_seqs:
+        idx = bisect_right(pred_starts, true_seq['start'])
+        true_matched.append(idx > 0 and max_pred_ends[idx - 1] >= true_seq['end'])
+
+    sorted_trues = sorted(true_seqs, key=lambda seq: seq['start'], reverse=True)
+    true_starts = [true_seq['start'] for true_seq in reversed(sorted_trues)]
+    # nearest end of the true seqs starting at or after each position
+    min_true_ends = list(accumulate((true_seq['end'] for true_seq in sorted_trues), min))[::-1]
+    pred_matched = []
+    for pred_seq in pred_seqs:
+        idx = bisect_left(true_starts, pred_seq['start'])
+        pred_matched.append(idx < len(true_starts) and min_true_ends[idx] <= pred_seq['end'])
+    return true_matched, pred_matched
+
+
+def _pairwise_matches(equality_fn):
+    def matches(true_seqs, pred_seqs):
+        return (
+            [any(equality_fn(true_seq, pred_seq) for pred_seq in pred_seqs) for true_seq in true_seqs],
+            [any(equality_fn(true_seq, pred_seq) for true_seq in true_seqs) for pred_seq in pred_seqs],
+        )
+    return matches
+
+
+_SEQUENCE_MATCHERS = {
+    sequences_overlap: _overlap_matches,
+    sequence_exact_match: _exact_matches,
+    sequence_superset: _superset_matches,
+}
+
+
+def _matches_by_label(true_annotations, predicted_annotations, match_fn):
+    true_matched = [False] * len(true_annotations)
+    pred_matched = [False] * len(predicted_annotations)
+    true_by_label = defaultdict(list)
+    pred_by_label = defaultdict(list)
+    for i, annotation in enumerate(true_annotations):
+        true_by_label[annotation['label']].append(i)
+    for i, annotation in enumerate(predicted_annotations):
+        pred_by_label[annotation['label']].append(i)
+
+    for label in set(true_by_label) & set(pred_by_label):
+        true_idxs = true_by_label[label]
+        pred_idxs = pred_by_label[label]
+        label_true_matched, label_pred_matched = match_fn(
+            [true_annotations[i] for i in true_idxs], [predicted_annotations[i] for i in pred_idxs]
+        )
+        for i, matched in zip(true_idxs, label_true_matched):
+            true_matched[i] = matched
+        for i, matched in zip(pred_idxs, label_pred_matched):
+            pred_matched[i] = matched
+    return true_matched, pred_matched
+
+
 def sequence_labeling_counts(true, predicted, equality_fn):
     """
     Return FP, FN, and TP counts
     """
     unique_classes = _get_unique_classes(true, predicted)
+    match_fn = _SEQUENCE_MATCHERS.get(equality_fn) or _pairwise_matches(equality_fn)
 
     d = {
         cls_: {
@@ -305,32 +415,24 @@ def sequence_labeling_counts(true, predicted, equality_fn):
             for annotation in annotations:
                 annotation['doc_idx'] = i
 
-        for true_annotation in true_annotations: 
-            for pred_annotation in predicted_annotations:
-                if equality_fn(true_annotation, pred_annotation):
-                    if pred_annotation['label'] == true_annotation['label']:
-                            d[true_annotation['label']]['true_positives'].append(true_annotation)
-                            break
+        # annotations only match annotations of the same label
+        true_matched, pred_matched = _matches_by_label(true_annotations, predicted_annotations, match_fn)
+        for true_annotation, matched in zip(true_annotations, true_matched):
+            if matched:
+                d[true_annotation['label']]['true_positives'].append(true_annotation)
             else:
                 d[true_annotation['label']]['false_negatives'].append(true_annotation)
 
-        for pred_annotation in predicted_annotations: 
-            for true_annotation in true_annotations:
-                if (
-                    equality_fn(
-                        true_annotation, pred_annotation
-                    ) and true_annotation["label"] == pred_annotation["label"]
-                ):
-                    break
-            else:
+        for pred_annotation, matched in zip(predicted_annotations, pred_matched):
+            if not matched:
                 d[pred_annotation['label']]['false_positives'].append(pred_annotation)
 
     return d
 
 
-def get_seq_count_fn(span_type="token"):
+def get_seq_count_fn(span_type="token", n_process=1):
     span_type_fn_mapping = {
-        "token": sequence_labeling_token_counts,
+        "token": partial(sequence_labeling_token_counts, n_process=n_process),
         "overlap": partial(sequence_labeling_counts, equality_fn=sequences_overlap),
         "exact": partial(sequence_labeling_counts, equality_fn=sequence_exact_match),
         "superset": partial(sequence_labeling_counts, equality_fn=sequence_superset),
@@ -360,12 +462,16 @@ def sequence_labeling_overlap_micro_f1(true, predicted):
 
 
 
-def annotation_report(y_true, y_pred, labels=None, target_names=None, sample_weight=None, digits=2, width=20):
+def annotation_report(
+    y_true, y_pred, labels=None, target_names=None, sample_weight=None, digits=2, width=20, n_process=1
+):
     # Adaptation of https://github.com/scikit-learn/scikit-learn/blob/f0ab589f/sklearn/metrics/classification.py#L1363
-    token_precision = sequence_labeling_token_precision(y_true, y_pred)
-    token_recall = sequence_labeling_token_recall(y_true, y_pred)
-    overlap_precision = sequence_labeling_overlap_precision(y_true, y_pred)
-    overlap_recall = sequence_labeling_overlap_recall(y_true, y_pred)
+    token_counts = get_seq_count_fn("token", n_process=n_process)(y_true, y_pred)
+    overlap_counts = get_seq_count_fn("overlap")(y_true, y_pred)
+    token_precision = _precisions(token_counts)
+    token_recall = _recalls(token_counts)
+    overlap_precision = _precisions(overlap_counts)
+    overlap_recall = _recalls(overlap_counts)
 
     count_dict = defaultdict(int)
     for annotation_seq in y_true:
@@ -398,16 +504,56 @@ def annotation_report(y_true, y_pred, labels=None, target_names=None, sample_wei
 
 
 def read_eval_metrics(eval_dir):
-    eval_metrics_dict = defaultdict(dict)
-    if gfile.Exists(eval_dir):
-        for event_file in gfile.Glob(os.path.join(eval_dir, _EVENT_FILE_GLOB_PATTERN)):
-            for event in summary_iterator.summary_iterator(event_file):
-                if not event.HasField('summary'):
-                    continue
-                metrics = {}
-                for value in event.summary.value:
-                    if value.HasField('simple_value'):
-                        metrics[value.tag] = value.simple_value
-                if metrics:
-                    eval_metrics_dict[event.step].update(metrics)
-    return eval_metrics_dict
+    return EvalMetricsReader(eval_dir).read()
+
+
+class EvalMetricsReader:
+    """
+    Reads the scalar eval metrics written to the event files in `eval_dir`, as a dict from step to metrics.
+
+    The reader remembers how far it got in each event file, so repeated calls to `read` only parse the records
+    appended since the previous call rather than the whole history.
+    """
+
+    # TFRecord framing: a uint64 length and its crc32, the record, then the crc32 of the record.
+    _HEADER = struct.Struct("<QI")
+    _FOOTER_SIZE = 4
+
+    def __init__(self, eval_dir):
+        self.eval_dir = eval_dir
+        self._offsets = dict()
+        self._metrics = defaultdict(dict)
+
+    def read(self):
+        if gfile.Exists(self.eval_dir):
+            for event_file in sorted(gfile.Glob(os.path.join(self.eval_dir, _EVENT_FILE_GLOB_PATTERN))):
+                self._offsets[event_file] = self._read_events(event_file, self._offsets.get(event_file, 0))
+        eval_metrics_dict = defaultdict(dict)
+        eval_metrics_dict.update((step, dict(metrics)) for step, metrics in self._metrics.items())
+        return eval_metrics_dict
+
+    def _read_events(self, event_file, offset):
+        with gfile.GFile(event_file, "rb") as f:
+            f.seek(offset)
+            while True:
+                header = f.read(self._HEADER.size)
+                if len(header) < self._HEADER.size:
+                    break
+                length, _ = self._HEADER.unpack(header)
+                record = f.read(length + self._FOOTER_SIZE)
+                if len(record) < length + self._FOOTER_SIZE:
+                    # the writer has not finished this record, it is read again on the next call.
+                    break
+                self._add_event(event_pb2.Event.FromString(record[:length]))
+                offset += self._HEADER.size + length + self._FOOTER_SIZE
+        return offset
+
+    def _add_event(self, event):
+        if not event.HasField('summary'):
+            return
+        metrics = {}
+        for value in event.summary.value:
+            if value.HasField('simple_value'):
+                metrics[value.tag] = value.simple_value
+        if metrics:
+            self._metrics[event.step].update(metrics)
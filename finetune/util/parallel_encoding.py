@@ -0,0 +1,81 @@
+"""
+Multi-process text encoding for the input pipeline.
+"""
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from finetune.util.encoding_cache import encoding_settings
+
+_WORKER_PIPELINE = None
+
+
+def _init_worker(pipeline):
+    # Each worker gets its own unpickled copy of the pipeline. Text encoders are
+    # not serialized with it, so they are lazily re-initialized once per process.
+    global _WORKER_PIPELINE
+    _WORKER_PIPELINE = pipeline
+
+
+def _encode_document(X):
+    return list(_WORKER_PIPELINE._cached_text_to_ids(X))
+
+
+def _pool_settings(pipeline, n_workers):
+    config = pipeline.config
+    return (n_workers, config.encoding_cache_dir, config.encoding_cache_max_bytes) + tuple(
+        encoding_settings(pipeline)
+    )
+
+
+class EncodingPool:
+    """
+    A pool of worker processes that encode documents with a copy of the pipeline they were started with.
+
+    Workers are started with the "spawn" method and each initializes its own text encoder, so a pool is kept
+    and reused for as long as the pipeline's encoding settings don't change, see `matches`.
+    """
+
+    def __init__(self, pipeline, n_workers):
+        self.n_workers = n_workers
+        self.settings = _pool_settings(pipeline, n_workers)
+        self.broken = False
+        self.executor = ProcessPoolExecutor(
+            max_workers=n_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(pipeline,),
+        )
+
+    def matches(self, pipeline, n_workers):
+        return not self.broken and _pool_settings(pipeline, n_workers) == self.settings
+
+    def text_to_ids(self, docs, lookahead):
+        """
+        Encodes documents with `pipeline._text_to_ids` across the pool.
+
+        :param docs: An iterable of dicts with the text to encode under "X".
+        :param lookahead: Maximum number of documents submitted ahead of the consumer.
+        :return: A generator of (doc, list of EncodedOutput) in input order.
+        """
+        lookahead = max(lookahead or 0, self.n_workers)
+        pending = deque()
+        try:
+            for doc in docs:
+                pending.append((doc, self.executor.submit(_encode_document, doc["X"])))
+                if len(pending) >= lookahead:
+                    doc, future = pending.popleft()
+                    yield doc, future.result()
+            while pending:
+                doc, future = pending.popleft()
+                yield doc, future.result()
+        except BrokenProcessPool:
+            self.broken = True
+            raise
+        finally:
+            for _, future in pending:
+                future.cancel()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
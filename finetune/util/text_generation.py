@@ -1,7 +1,13 @@
+import time
+import logging
+
+import numpy as np
 import tensorflow as tf
 
 from finetune.util.shapes import shape_list
 
+LOGGER = logging.getLogger("finetune")
+
 
 def sample_with_temperature(logits, temperature):
     """Either argmax or random sampling.
@@ -20,3 +26,146 @@ def sample_with_temperature(logits, temperature):
         choices = tf.random.categorical(logits=reshaped_logits, num_samples=1)
         choices = tf.reshape(choices, logits_shape[:-1])
         return choices
+
+
+def _last_token_logits(decoder_state):
+    hidden = decoder_state["sequence_features"][:, -1]
+    return tf.cast(
+        tf.matmul(hidden, decoder_state["embed_weights"], transpose_b=True), tf.float32
+    )
+
+
+def sample_sequences(decoder, tokens, lengths, max_total, logit_mask, temperature, end_token):
+    """
+    Autoregressively samples a batch of sequences inside the graph, feeding only the newest token to
+    the decoder at each step and reusing the keys and values cached for every previous position.
+
+    :param decoder: fn(X, past) -> dict with "sequence_features", "embed_weights" and "past",
+        see `SourceModel.cached_decoder`.
+    :param tokens: int32 [batch, seed_length] seed token ids, padded on the right.
+    :param lengths: int32 [batch] number of seed tokens per sequence, at least 1.
+    :param max_total: Total length to decode each sequence to, including the seed.
+    :param logit_mask: float32 [1, n_logits] added to the logits before sampling.
+    :param temperature: Sampling temperature, 0.0 for greedy decoding.
+    :param end_token: Sequences stop once this token is sampled.
+    :return: A tuple of the int32 [batch, length] output tokens and the int32 [batch] length of each sequence.
+    """
+    min_length = tf.reduce_min(input_tensor=lengths)
+    padded = tf.pad(tensor=tokens, paddings=[[0, 0], [0, tf.maximum(max_total - shape_list(tokens)[1], 0)]])
+    prefill = decoder(tokens[:, :min_length], None)
+    batch_size = shape_list(tokens)[0]
+
+    def cond(i, logits, past, output, finished, gen_lengths):
+        return tf.logical_and(
+            i < max_total, tf.logical_not(tf.reduce_all(input_tensor=finished))
+        )
+
+    def body(i, logits, past, output, finished, gen_lengths):
+        sampled = tf.cast(sample_with_temperature(logits + logit_mask, temperature), tf.int32)
+        is_seed = i < lengths
+        token = tf.where(is_seed, padded[:, i], sampled)
+        gen_lengths = tf.where(finished, gen_lengths, i + 1)
+        finished = tf.logical_or(
+            finished, tf.logical_and(tf.logical_not(is_seed), tf.equal(token, end_token))
+        )
+        decoder_state = decoder(token[:, None], past)
+        return (
+            i + 1,
+            _last_token_logits(decoder_state),
+            decoder_state["past"],
+            tf.concat([output, token[:, None]], axis=1),
+            finished,
+            gen_lengths,
+        )
+
+    loop_vars = (
+        min_length,
+        _last_token_logits(prefill),
+        prefill["past"],
+        tokens[:, :min_length],
+        tf.zeros([batch_size], dtype=tf.bool),
+        tf.fill([batch_size], min_length),
+    )
+    shape_invariants = tf.nest.map_structure(
+        lambda t: tf.TensorShape([None] * t.shape.ndims), loop_vars
+    )
+    _, _, _, output, _, gen_lengths = tf.while_loop(
+        cond=cond,
+        body=body,
+        loop_vars=loop_vars,
+        shape_invariants=shape_invariants,
+        back_prop=False,
+    )
+    return output, gen_lengths
+
+
+class TextGenerator:
+    """
+    Holds a graph and a live session for `BaseModel.generate_text` so that repeated calls do not rebuild
+    the graph or reload weights. The full sampling loop runs in a single `session.run` per batch of seeds.
+    """
+
+    def __init__(self, decoder, encoder, config, saver, session_config=None):
+        self.variables = saver.variables
+        self.temperature = config.lm_temp
+        self.max_length = config.max_length
+        self.batch_size = config.predict_batch_size
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.compat.v1.set_random_seed(config.seed)
+            self.tokens = tf.compat.v1.placeholder(tf.int32, [None, None])
+            self.lengths = tf.compat.v1.placeholder(tf.int32, [None])
+            self.max_total = tf.compat.v1.placeholder(tf.int32, [])
+            self.logit_mask = tf.compat.v1.placeholder(tf.float32, [1, None])
+            self.output, self.gen_lengths = sample_sequences(
+                decoder=lambda X, past: decoder(X, past, encoder, config),
+                tokens=self.tokens,
+                lengths=self.lengths,
+                max_total=self.max_total,
+                logit_mask=self.logit_mask,
+                temperature=config.lm_temp,
+                end_token=encoder.end_token,
+            )
+            self.session = tf.compat.v1.Session(config=session_config)
+            self.session.run(tf.compat.v1.global_variables_initializer())
+            saver.get_scaffold_init_fn()(None, self.session)
+            self.graph.finalize()
+
+    def generate(self, seed_ids_list, max_total, logit_mask):
+        """
+        :param seed_ids_list: A list of non-empty lists of seed token ids.
+        :param max_total: Length to decode each sequence to, including its seed.
+        :param logit_mask: float32 [1, n_logits] array added to the logits before sampling.
+        :return: A list with one list of token ids per seed, starting with the seed.
+        """
+        results = []
+        n_generated = 0
+        start = time.time()
+        for batch_start in range(0, len(seed_ids_list), self.batch_size):
+            batch = seed_ids_list[batch_start : batch_start + self.batch_size]
+            lengths = np.asarray([len(seed) for seed in batch], dtype=np.int32)
+            tokens = np.zeros([len(batch), lengths.max()], dtype=np.int32)
+            for row, seed in enumerate(batch):
+                tokens[row, : len(seed)] = seed
+            output, gen_lengths = self.session.run(
+                [self.output, self.gen_lengths],
+                feed_dict={
+                    self.tokens: tokens,
+                    self.lengths: lengths,
+                    self.max_total: max_total,
+                    self.logit_mask: logit_mask,
+                },
+            )
+            for seed, row, length in zip(batch, output.tolist(), gen_lengths.tolist()):
+                results.append(list(seed) + row[len(seed) : length])
+                n_generated += max(length - len(seed), 0)
+        elapsed = time.time() - start
+        LOGGER.info(
+            "Generated {} tokens in {:.2f}s ({:.1f} tokens/s)".format(
+                n_generated, elapsed, n_generated / max(elapsed, 1e-9)
+            )
+        )
+        return results
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,46 @@
+import time
+
+import numpy as np
+from tabulate import tabulate
+
+from finetune.nn.crf import viterbi_decode, viterbi_decode_batch
+
+
+def looped_decode(scores, transition_params):
+    # The previous CPU path: one python viterbi_decode per sequence, ignoring lengths.
+    all_predictions = []
+    all_logits = []
+    for score in scores:
+        viterbi_sequence, viterbi_logits = viterbi_decode(score, transition_params)
+        all_predictions.append(viterbi_sequence)
+        all_logits.append(viterbi_logits)
+    return np.array(all_predictions, dtype=np.int32), np.array(all_logits, dtype=np.float32)
+
+
+def benchmark(fn, runs):
+    start = time.time()
+    for _ in range(runs):
+        fn()
+    return (time.time() - start) / runs
+
+
+if __name__ == "__main__":
+    runs = 10
+    num_tags = 9
+    output = []
+    headers = ["Batch Size", "Seq Len", "Padding", "Looped (ms)", "Batched (ms)", "Speedup"]
+    rng = np.random.RandomState(0)
+    transition_params = rng.randn(num_tags, num_tags).astype(np.float32)
+    for batch_size, seq_len in [(2, 128), (20, 512), (48, 512), (256, 512)]:
+        scores = rng.randn(batch_size, seq_len, num_tags).astype(np.float32)
+        for padding in [0.0, 0.5]:
+            lengths = np.full([batch_size], seq_len)
+            lengths[: int(batch_size * padding)] = seq_len // 4
+            looped = benchmark(lambda: looped_decode(scores, transition_params), runs)
+            batched = benchmark(
+                lambda: viterbi_decode_batch(scores, transition_params, lengths), runs
+            )
+            output.append(
+                [batch_size, seq_len, padding, looped * 1000, batched * 1000, looped / batched]
+            )
+    print(tabulate(output, headers=headers))
@@ -0,0 +1,64 @@
+import time
+
+from tabulate import tabulate
+from finetune import SequenceLabeler
+from finetune.base_models import RoBERTa
+from finetune.encoding.target_encoders import SequenceLabelingEncoder
+from synthetic_data import multi_label_sequence_data, sequence_data
+
+
+def scan_transform(encoder, out, labels):
+    # The previous O(labels x tokens) alignment, kept as a reference point.
+    input_text = "".join(out.input_text)
+    labels, pad_idx = encoder.pre_process_label(out, labels)
+    labels_out = [pad_idx for _ in out.tokens]
+    offset = out.offset or 0
+    for label in labels:
+        for i, (start, end, text) in enumerate(zip(out.token_starts, out.token_ends, out.tokens)):
+            if label["end"] < (start + end + 1) // 2:
+                break
+            overlap, agree = encoder.overlaps(label, start, end, text, input_text, offset=offset)
+            if overlap and label["label"] in encoder.lookup:
+                labels_out[i] = encoder.lookup[label["label"]]
+    return labels_out
+
+
+def encoded_chunks(model, x, y):
+    pipeline = model.input_pipeline
+    pipeline._post_data_initialization(pipeline.zip_list_to_dict(X=x, Y=y))
+    chunks = []
+    for xi, yi in zip(x, y):
+        for out in pipeline._text_to_ids(xi):
+            chunks.append(
+                (out, [l for l in yi if l["end"] >= min(out.token_starts) and l["start"] <= max(out.token_ends)])
+            )
+    return pipeline.label_encoder, chunks
+
+
+def benchmark(transform, chunks, runs):
+    start = time.time()
+    for _ in range(runs):
+        for out, labels in chunks:
+            transform(out, labels)
+    return (time.time() - start) / runs
+
+
+if __name__ == "__main__":
+    runs = 3
+    output = []
+    headers = ["Data", "Encoder", "Chunks", "Transform Time", "Scan Time"]
+    for name, (x, y), multi_label in [
+        ("Sequence", sequence_data(), False),
+        ("Multi Sequence", multi_label_sequence_data(), True),
+    ]:
+        model = SequenceLabeler(base_model=RoBERTa, multi_label_sequences=multi_label)
+        label_encoder, chunks = encoded_chunks(model, x, y)
+        transform_time = benchmark(label_encoder.transform, chunks, runs)
+        if isinstance(label_encoder, SequenceLabelingEncoder) and not multi_label:
+            scan_time = benchmark(
+                lambda out, labels: scan_transform(label_encoder, out, labels), chunks, runs
+            )
+        else:
+            scan_time = None
+        output.append([name, type(label_encoder).__name__, len(chunks), transform_time, scan_time])
+    print(tabulate(output, headers=headers))
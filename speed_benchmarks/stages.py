@@ -0,0 +1,265 @@
+"""
+Times each stage of fit, save and predict separately, for several base models and data sizes.
+
+Base models are shrunk to a couple of small layers and start from random weights, so only their vocab
+files are needed and the suite runs on CPU without downloading any pretrained weights. Results are
+written as JSON and can be compared against a stored baseline:
+
+    python stages.py --output baseline.json
+    python stages.py --baseline baseline.json --tolerance 0.25
+
+The comparison exits non-zero when the mean time of any stage regressed by more than `tolerance`.
+Stage times are inclusive, `_text_to_ids` contains `encode_multi_input` and `session_create` contains
+`saver_init_fn`.
+"""
+import argparse
+import contextlib
+import inspect
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from unittest.mock import patch
+
+import numpy as np
+import tensorflow as tf
+from tabulate import tabulate
+
+import finetune
+from finetune import Classifier, SequenceLabeler
+from finetune.base import BaseModel
+from finetune.base_models import BERTModelCased, GPT2Model, GPTModel, RoBERTa
+from finetune.encoding.input_encoder import BaseEncoder
+from finetune.input_pipeline import BasePipeline
+from finetune.nn import crf
+from finetune.saver import Saver
+from finetune.target_models import sequence_labeling
+from finetune.util.indico_estimator import IndicoEstimator
+from finetune.util.mapped_weights import dump_weights
+from synthetic_data import classification_data, sequence_data
+
+TINY_SETTINGS = {
+    "n_layer": 2,
+    "num_layers_trained": 2,
+    "n_heads": 2,
+    "n_embed": 64,
+    "bert_intermediate_size": 256,
+    "max_length": 128,
+    # the tiny base models have no pretrained weights, see `tiny_base_model`.
+    "permit_uninitialized": r"model/featurizer",
+}
+
+BASE_MODELS = [RoBERTa, BERTModelCased, GPTModel, GPT2Model]
+
+SIZES = {
+    "small": dict(num_docs=10, length=1000),
+    "medium": dict(num_docs=50, length=8000),
+}
+
+TASKS = {
+    "classification": (Classifier, classification_data, {}),
+    "sequence": (SequenceLabeler, sequence_data, {"crf_sequence_labeling": True, "use_gpu_crf_predict": False}),
+}
+
+
+def tiny_base_model(base_model, weights_dir):
+    """
+    A copy of `base_model` with `TINY_SETTINGS` whose pretrained weights are replaced by an empty file,
+    so every featurizer variable is randomly initialized.
+    """
+    weights_path = os.path.join(weights_dir, "{}-tiny.ftw".format(base_model.__name__))
+    dump_weights({}, weights_path)
+    pretrained = base_model.settings["base_model_path"]
+    name = "Tiny{}".format(base_model.__name__)
+    tiny = type(
+        name,
+        (base_model,),
+        {
+            "settings": {**base_model.settings, **TINY_SETTINGS, "base_model_path": weights_path},
+            "required_files": [f for f in base_model.required_files if not f["file"].endswith(pretrained)],
+        },
+    )
+    # saved models pickle their base model by reference.
+    tiny.__module__ = __name__
+    setattr(sys.modules[__name__], name, tiny)
+    return tiny
+
+
+class StageTimer:
+    """
+    Records the duration of every call to the patched functions, grouped by stage name.
+    Generator functions are timed across all of their steps.
+    """
+
+    def __init__(self):
+        self.durations = defaultdict(list)
+
+    def _timed_generator(self, stage, gen):
+        total = 0.0
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(gen)
+                except StopIteration:
+                    return
+                finally:
+                    total += time.perf_counter() - start
+                yield item
+        finally:
+            self.durations[stage].append(total)
+
+    def wrap(self, stage, fn):
+        if inspect.isgeneratorfunction(fn):
+            def timed(*args, **kwargs):
+                return self._timed_generator(stage, fn(*args, **kwargs))
+        else:
+            def timed(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    self.durations[stage].append(time.perf_counter() - start)
+        return timed
+
+    @contextlib.contextmanager
+    def stage(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.durations[stage].append(time.perf_counter() - start)
+
+    @contextlib.contextmanager
+    def patched(self):
+        timer = self
+
+        def get_scaffold_init_fn(saver):
+            return timer.wrap("saver_init_fn", original_init_fn(saver))
+
+        original_init_fn = Saver.get_scaffold_init_fn
+        targets = [
+            (BaseEncoder, "encode_multi_input", "encode_multi_input"),
+            (BasePipeline, "_text_to_ids", "_text_to_ids"),
+            (BaseModel, "get_estimator", "get_estimator"),
+            (IndicoEstimator, "_call_model_fn", "graph_build"),
+            (tf.compat.v1.train.MonitoredSession, "__init__", "session_create"),
+            (sequence_labeling, "finetune_to_indico_sequence", "finetune_to_indico_sequence"),
+            (crf, "viterbi_decode_batch", "crf_decode"),
+            (Saver, "save", "saver_save"),
+        ]
+        with contextlib.ExitStack() as stack:
+            for owner, attr, stage in targets:
+                stack.enter_context(patch.object(owner, attr, self.wrap(stage, getattr(owner, attr))))
+            stack.enter_context(patch.object(Saver, "get_scaffold_init_fn", get_scaffold_init_fn))
+            yield self
+
+    def summary(self):
+        return {
+            stage: {
+                "count": len(durations),
+                "total": float(np.sum(durations)),
+                "mean": float(np.mean(durations)),
+            }
+            for stage, durations in self.durations.items()
+        }
+
+
+def benchmark(model_cls, base_model, config, x, y, save_dir):
+    timer = StageTimer()
+    with timer.patched():
+        model = model_cls(base_model=base_model, n_epochs=1, **config)
+        with timer.stage("fit"):
+            model.fit(x, y)
+        model.save(os.path.join(save_dir, "model.jl"))
+        with model.cached_predict():
+            with timer.stage("predict_first_call"):
+                model.predict(x)
+            session = model._cached_estimator.mon_sess
+            with patch.object(session, "run", timer.wrap("cached_predict_batch", session.run)):
+                with timer.stage("predict_cached_call"):
+                    model.predict(x)
+    return timer.summary()
+
+
+def run_suite(base_models, sizes, tasks):
+    results = dict()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for base_model in base_models:
+            tiny = tiny_base_model(base_model, tmp_dir)
+            for task in tasks:
+                model_cls, data_fn, config = TASKS[task]
+                for size in sizes:
+                    x, y = data_fn(**SIZES[size])
+                    key = "{}/{}/{}".format(base_model.__name__, task, size)
+                    print("Running {}".format(key))
+                    results[key] = benchmark(model_cls, tiny, config, x, y, tmp_dir)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Stages whose mean time grew by more than `tolerance` (a fraction) relative to `baseline`.
+    """
+    rows = []
+    regressions = []
+    for key, stages in sorted(results.items()):
+        for stage, timing in sorted(stages.items()):
+            previous = baseline.get(key, {}).get(stage)
+            if previous is None or previous["mean"] <= 0:
+                continue
+            change = timing["mean"] / previous["mean"] - 1
+            rows.append([key, stage, previous["mean"], timing["mean"], "{:+.1%}".format(change)])
+            if change > tolerance:
+                regressions.append(rows[-1])
+    return rows, regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--base-models", nargs="+", default=[m.__name__ for m in BASE_MODELS])
+    parser.add_argument("--sizes", nargs="+", default=list(SIZES), choices=list(SIZES))
+    parser.add_argument("--tasks", nargs="+", default=list(TASKS), choices=list(TASKS))
+    parser.add_argument("--output", help="Write the results to this JSON file.")
+    parser.add_argument("--baseline", help="JSON file from a previous run to compare against.")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed slowdown per stage, as a fraction.")
+    args = parser.parse_args()
+
+    base_models = {m.__name__: m for m in BASE_MODELS}
+    results = run_suite([base_models[name] for name in args.base_models], args.sizes, args.tasks)
+
+    output = []
+    for key, stages in sorted(results.items()):
+        for stage, timing in sorted(stages.items()):
+            output.append([key, stage, timing["count"], timing["total"], timing["mean"]])
+    print(tabulate(output, headers=["Benchmark", "Stage", "Calls", "Total (s)", "Mean (s)"]))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "meta": {
+                        "finetune_version": finetune.__version__,
+                        "tensorflow_version": tf.__version__,
+                        "python_version": platform.python_version(),
+                        "machine": platform.machine(),
+                        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                    },
+                    "results": results,
+                },
+                f,
+                indent=2,
+                sort_keys=True,
+            )
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        rows, regressions = compare(results, baseline, args.tolerance)
+        print(tabulate(rows, headers=["Benchmark", "Stage", "Baseline (s)", "Current (s)", "Change"]))
+        if regressions:
+            print("{} stages regressed by more than {:.0%}".format(len(regressions), args.tolerance))
+            sys.exit(1)
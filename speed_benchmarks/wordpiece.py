@@ -0,0 +1,72 @@
+import time
+
+from tabulate import tabulate
+
+from finetune.base_models import BERTModelCased, DistilBERT
+from finetune.util.download import download_data_if_required
+from synthetic_data import classification_data, sequence_data
+
+
+def substring_wordpiece(wordpiece_tokenizer, word):
+    # The previous implementation: probe the vocab with every candidate substring, longest first.
+    chars = list(word)
+    if len(chars) > wordpiece_tokenizer.max_input_chars_per_word:
+        return None
+    start = 0
+    sub_tokens = []
+    while start < len(chars):
+        end = len(chars)
+        cur_substr = None
+        while start < end:
+            substr = "".join(chars[start:end])
+            if start > 0:
+                substr = "##" + substr
+            if substr in wordpiece_tokenizer.vocab:
+                cur_substr = substr
+                break
+            end -= 1
+        if cur_substr is None:
+            return None
+        sub_tokens.append(cur_substr)
+        start = end
+    return sub_tokens
+
+
+def benchmark(fn, items, runs):
+    start = time.time()
+    for _ in range(runs):
+        for item in items:
+            fn(item)
+    return (time.time() - start) / runs
+
+
+if __name__ == "__main__":
+    runs = 3
+    output = []
+    headers = ["Encoder", "Data", "Words", "Substring (words/s)", "Trie (words/s)", "Encode (chars/s)"]
+    for base_model in [BERTModelCased, DistilBERT]:
+        download_data_if_required(base_model)
+        encoder = base_model.get_encoder(config=None)
+        encoder._lazy_init()
+        tokenizer = encoder.tokenizer
+        wordpiece = tokenizer.wordpiece_tokenizer
+        for name, (x, _) in [("Classification", classification_data()), ("Sequence", sequence_data())]:
+            words = [word for text in x for word in tokenizer.basic_tokenizer.tokenize(text)[0]]
+            for word in set(words):
+                pieces = wordpiece.encode(word)
+                expected = substring_wordpiece(wordpiece, word)
+                assert expected == (None if pieces is None else [piece for piece, _, _, _ in pieces]), word
+            substring_time = benchmark(lambda word: substring_wordpiece(wordpiece, word), words, runs)
+            trie_time = benchmark(wordpiece.encode, words, runs)
+            encode_time = benchmark(lambda text: encoder._encode([text]), x, runs)
+            output.append(
+                [
+                    base_model.__name__,
+                    name,
+                    len(words),
+                    len(words) / substring_time,
+                    len(words) / trie_time,
+                    sum(len(text) for text in x) / encode_time,
+                ]
+            )
+    print(tabulate(output, headers=headers))
@@ -6,8 +6,9 @@ import string
 import gc
 from copy import copy
 import time
+import threading
 from pathlib import Path
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 import warnings
 
 # prevent excessive warning logs
@@ -27,6 +28,8 @@ from finetune.base_models import GPTModelSmall, GPT
 from finetune.datasets import generic_download
 from finetune.config import get_config
 from finetune.errors import FinetuneError
+from finetune.util.mapped_weights import is_mapped_weights, MappedWeights
+from finetune.util.indico_estimator import IndicoEstimator
 
 SST_FILENAME = "SST-binary.csv"
 
@@ -134,6 +137,18 @@ class TestClassifier(unittest.TestCase):
         second_prediction_time = second - first
         self.assertLess(second_prediction_time, first_prediction_time / 2.0)
 
+    def test_cached_predict_failure_stops_feeder(self):
+        model = Classifier(**self.default_config())
+        train_sample = self.dataset.sample(n=self.n_sample)
+        model.fit(train_sample.Text.values, train_sample.Target.values)
+
+        threads = threading.active_count()
+        with model.cached_predict():
+            with patch.object(IndicoEstimator, "_call_model_fn", side_effect=ValueError("model_fn failed")):
+                with self.assertRaises(ValueError):
+                    model.predict(train_sample.Text[:1].values)
+        self.assertEqual(threading.active_count(), threads)
+
     def test_correct_cached_predict(self):
         model = Classifier(**self.default_config())
         train_sample = self.dataset.sample(n=self.n_sample)
@@ -171,6 +186,50 @@ class TestClassifier(unittest.TestCase):
                 ):
                     np.testing.assert_almost_equal(pred_val, cached_pred_val, decimal=4)
 
+    def test_cached_predict_fetches(self):
+        """
+        Ensure cached prediction reuses one graph and only fetches the requested outputs
+        """
+        model = Classifier(**self.default_config())
+        train_sample = self.dataset.sample(n=self.n_sample)
+        valid_sample = self.dataset.sample(n=self.n_sample)
+        model.fit(train_sample.Text.values, train_sample.Target.values)
+
+        with model.cached_predict():
+            model.predict(valid_sample.Text.values[:1])
+            estimator = model._cached_estimator
+            estimator_spec = estimator.estimator_spec
+            run = estimator.mon_sess.run
+            fetched = []
+
+            def recording_run(fetches, **kwargs):
+                fetched.append(set(fetches))
+                return run(fetches, **kwargs)
+
+            estimator.mon_sess.run = recording_run
+            model.predict(valid_sample.Text.values[:1])
+            features = model.featurize(valid_sample.Text.values[:1])
+
+        self.assertIs(estimator.estimator_spec, estimator_spec)
+        self.assertEqual(fetched, [{PredictMode.PROBAS, PredictMode.NORMAL}, {PredictMode.FEATURIZE}])
+        self.assertEqual(len(features), 1)
+
+    def test_streamed_cached_predict(self):
+        model = Classifier(**self.default_config(cached_predict_queue_size=0))
+        train_sample = self.dataset.sample(n=self.n_sample)
+        valid_sample = self.dataset.sample(n=self.n_sample)
+        model.fit(train_sample.Text.values, train_sample.Target.values)
+
+        with model.cached_predict():
+            materialized_preds = model.predict_proba(valid_sample.Text.values)
+            model.config.cached_predict_queue_size = 2
+            streamed_preds = model.predict_proba(valid_sample.Text.values)
+
+        for pred, streamed_pred in zip(materialized_preds, streamed_preds):
+            assert list(pred.keys()) == list(streamed_pred.keys())
+            for pred_val, streamed_pred_val in zip(pred.values(), streamed_pred.values()):
+                np.testing.assert_almost_equal(pred_val, streamed_pred_val, decimal=4)
+
     def test_fit_predict(self):
         """
         Ensure model training does not error out
@@ -299,6 +358,20 @@ class TestClassifier(unittest.TestCase):
         for i, prediction in enumerate(predictions):
             self.assertEqual(prediction, new_predictions[i])
 
+    def test_save_load_mmap_weights(self):
+        save_file = "tests/saved-models/test-save-load-mmap"
+        model = Classifier(**self.default_config(mmap_weights=True))
+        train_sample = self.dataset.sample(n=self.n_sample)
+        valid_sample = self.dataset.sample(n=self.n_sample)
+        model.fit(train_sample.Text, train_sample.Target)
+        predictions = model.predict(valid_sample.Text)
+        model.save(save_file)
+        self.assertTrue(is_mapped_weights(save_file))
+
+        model = Classifier.load(save_file)
+        self.assertIsInstance(model.saver.variables, MappedWeights)
+        self.assertEqual(predictions, model.predict(valid_sample.Text))
+
     def test_featurize(self):
         """
         Ensure featurization returns an array of the right shape
@@ -376,7 +449,8 @@ class TestClassifier(unittest.TestCase):
         self.assertIn("{}Indico RULE".format(start_token).lower(), lm_out_2.lower()) # Both of these models use extra toks
 
     def test_generate_text_stop_early(self):
-        model = Classifier(base_model=GPT)
+        # the estimator is mocked out, so this exercises the estimator based implementation.
+        model = Classifier(base_model=GPT, cached_text_generation=False)
 
         # A dirty mock to make all model inferences output a hundred _classify_ tokens
         fake_estimator = MagicMock()
@@ -392,6 +466,25 @@ class TestClassifier(unittest.TestCase):
         lm_out = model.generate_text(use_extra_toks=True)
         self.assertEqual(lm_out, "{}_classify_".format(start_token))
 
+    def test_generate_text_cached(self):
+        """
+        Ensure greedy decoding against cached keys and values matches the estimator based implementation,
+        and that a list of seeds is generated in one batch.
+        """
+        model = Classifier(base_model=GPT, lm_temp=0.0)
+        cached_out = model.generate_text("The quick brown fox", 12)
+        self.assertEqual(type(cached_out), str)
+        self.assertTrue(cached_out.lower().startswith("the quick brown fox"))
+
+        model.config.cached_text_generation = False
+        self.assertEqual(model.generate_text("The quick brown fox", 12), cached_out)
+
+        model.config.cached_text_generation = True
+        batch_out = model.generate_text(["The quick brown fox", "Indico"], 12)
+        self.assertEqual(len(batch_out), 2)
+        self.assertEqual(batch_out[0], cached_out)
+        self.assertTrue(batch_out[1].lower().startswith("indico"))
+
     def test_validation(self):
         """
         Ensure validation settings do not result in an error
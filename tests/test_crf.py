@@ -0,0 +1,38 @@
+import unittest
+
+import numpy as np
+
+from finetune.nn.crf import viterbi_decode, viterbi_decode_batch
+
+
+class TestViterbiDecodeBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = np.random.RandomState(42)
+
+    def test_matches_viterbi_decode(self):
+        scores = self.rng.randn(8, 50, 5).astype(np.float32)
+        transition_params = self.rng.randn(5, 5).astype(np.float32)
+        tags, probas = viterbi_decode_batch(scores, transition_params)
+        for score, seq_tags, seq_probas in zip(scores, tags, probas):
+            expected_tags, expected_probas = viterbi_decode(score, transition_params)
+            self.assertEqual(list(seq_tags), list(expected_tags))
+            np.testing.assert_allclose(seq_probas, expected_probas, atol=1e-5)
+
+    def test_respects_sequence_length(self):
+        scores = self.rng.randn(6, 40, 4).astype(np.float32)
+        transition_params = self.rng.randn(4, 4).astype(np.float32)
+        lengths = np.array([40, 1, 17, 0, 39, 2])
+        tags, probas = viterbi_decode_batch(scores, transition_params, lengths)
+        self.assertEqual(tags.shape, (6, 40))
+        self.assertEqual(probas.shape, (6, 40, 4))
+        for score, length, seq_tags, seq_probas in zip(scores, lengths, tags, probas):
+            if length == 0:
+                continue
+            expected_tags, expected_probas = viterbi_decode(score[:length], transition_params)
+            self.assertEqual(list(seq_tags[:length]), list(expected_tags))
+            np.testing.assert_allclose(seq_probas[:length], expected_probas, atol=1e-5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -77,6 +77,19 @@ class TestHuggingFace(unittest.TestCase):
         loaded_model = HFS2S.load("test.jl")
         self.assertEqual(loaded_model.predict([text]), [text])
 
+    def test_t5_s2s_beam_search_cache(self):
+        texts = ["sequence test text", "Some other text"]
+        finetune_model = HFS2S(
+            base_model=HFT5,
+            n_epochs=30,
+            batch_size=2,
+            beam_size=3,
+        )
+        finetune_model.fit(texts * 3, texts * 3)
+        cached = finetune_model.predict(texts)
+        finetune_model.config.beam_search_use_cache = False
+        self.assertEqual(finetune_model.predict(texts), cached)
+
     def test_t5_s2s_ner(self):
         with open(os.path.join('Data', 'Sequence', 'reuters.json'), "rt") as fp:
             texts, labels = json.load(fp)
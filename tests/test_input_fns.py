@@ -5,6 +5,7 @@ import shutil
 import string
 import gc
 from copy import copy
+from collections import deque
 import time
 from pathlib import Path
 from unittest.mock import MagicMock, patch
@@ -27,7 +28,12 @@ from finetune.base_models import GPTModelSmall, GPT
 from finetune.datasets import generic_download
 from finetune.config import get_config
 from finetune.errors import FinetuneError
-from finetune.util.input_utils import InputMode
+from finetune.util.input_utils import (
+    InputMode,
+    length_buckets,
+    token_budget_batches,
+    restore_order,
+)
 
 SST_FILENAME = "SST-binary.csv"
 
@@ -138,3 +144,65 @@ class TestInputFns(unittest.TestCase):
             
 
         
+
+    @patch('finetune.input_pipeline.batch_dataset')
+    def test_bucket_training_batches(self, mock_batch_dataset):
+        model = Classifier(max_length=64, batch_size=4, val_size=0, bucket_training_batches=True)
+        model.input_pipeline.make_dataset_fn = dummy_make_dataset_fn
+        train_sample = self.dataset.sample(n=50)
+        zipped_data = model.input_pipeline.zip_list_to_dict(X=train_sample.Text.values, Y=train_sample.Target.values)
+        model.input_pipeline.get_dataset_from_list(zipped_data, InputMode.TRAIN)
+        (train_ds,), train_call = mock_batch_dataset.call_args_list[-2]
+        self.assertEqual(train_call["batch_size"], 4)
+
+        def batch_lengths(data):
+            lengths = [len(x["tokens"]) for x, _ in data]
+            return [lengths[i : i + 4] for i in range(0, len(lengths), 4)]
+
+        first_epoch = list(train_ds["data_fn"]())
+        second_epoch = list(train_ds["data_fn"]())
+        self.assertEqual(len(first_epoch), model.config.dataset_size)
+        self.assertEqual(len(second_epoch), model.config.dataset_size)
+        # same number of batches, but each batch covers a narrower range of lengths than a random split would.
+        bucketed_spread = sum(max(b) - min(b) for b in batch_lengths(first_epoch))
+        model.config.bucket_training_batches = False
+        model.input_pipeline.get_dataset_from_list(zipped_data, InputMode.TRAIN)
+        (unbucketed_ds,), _ = mock_batch_dataset.call_args_list[-2]
+        unbucketed_spread = sum(max(b) - min(b) for b in batch_lengths(unbucketed_ds["data_fn"]()))
+        self.assertLess(bucketed_spread, unbucketed_spread)
+
+    def test_token_budget_batches(self):
+        lengths = [3, 200, 5, 17, 120, 4, 60, 2, 250, 9]
+        examples = [{"tokens": np.arange(length) + 1} for length in lengths]
+        order = deque()
+        batches = list(
+            token_budget_batches(examples, max_tokens=256, boundaries=length_buckets(256), order_sink=order)
+        )
+        self.assertEqual(sorted(order), list(range(len(lengths))))
+        for batch in batches:
+            n, padded_length = batch["tokens"].shape
+            self.assertIn(padded_length, length_buckets(256))
+            self.assertTrue(n * padded_length <= 256 or n == 1)
+            self.assertTrue(np.all(batch["length"] <= padded_length))
+
+        # predictions come back in batch order, restore_order undoes the grouping.
+        predictions = [
+            tokens[:length] for batch in batches for tokens, length in zip(batch["tokens"], batch["length"])
+        ]
+        restored = list(restore_order(iter(predictions), order))
+        for pred, example in zip(restored, examples):
+            np.testing.assert_array_equal(pred, example["tokens"])
+
+    def test_predict_max_tokens_per_batch(self):
+        model = Classifier(max_length=64, chunk_long_sequences=True)
+        train_sample = self.dataset.sample(n=20)
+        model.fit(train_sample.Text.values, train_sample.Target.values)
+        valid_sample = self.dataset.sample(n=30).Text.values
+        probas = model.predict_proba(valid_sample)
+
+        model.config.max_tokens_per_batch = 256
+        budget_probas = model.predict_proba(valid_sample)
+        for pred, budget_pred in zip(probas, budget_probas):
+            self.assertEqual(list(pred.keys()), list(budget_pred.keys()))
+            for value, budget_value in zip(pred.values(), budget_pred.values()):
+                np.testing.assert_almost_equal(value, budget_value, decimal=4)
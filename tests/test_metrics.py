@@ -1,3 +1,5 @@
+import copy
+import random
 import unittest
 from finetune.util.metrics import (
     seq_recall,
@@ -5,6 +7,10 @@ from finetune.util.metrics import (
     get_seq_count_fn,
     micro_f1,
     sequence_f1,
+    sequence_labeling_counts,
+    sequences_overlap,
+    sequence_exact_match,
+    sequence_superset,
 )
 
 
@@ -574,3 +580,24 @@ class TestMetrics(unittest.TestCase):
                 span_type=span_type,
             )
 
+    def test_interval_matching_matches_pairwise(self):
+        random.seed(42)
+        x = "  Alert: Pepsi Company stocks are up today April 5, 2010 and no one profited. "
+
+        def random_labels():
+            labels = []
+            for _ in range(random.randint(0, 8)):
+                start = random.randint(0, len(x) - 1)
+                end = random.randint(start + 1, len(x))
+                labels.append({"start": start, "end": end, "text": x[start:end], "label": random.choice(["a", "b"])})
+            return labels
+
+        Y = [random_labels() for _ in range(50)]
+        Y_pred = [random_labels() for _ in range(50)]
+        for equality_fn in [sequences_overlap, sequence_exact_match, sequence_superset]:
+            counts = sequence_labeling_counts(copy.deepcopy(Y), copy.deepcopy(Y_pred), equality_fn)
+            # a wrapped function is not recognized, so every pair of annotations is compared
+            pairwise_counts = sequence_labeling_counts(
+                copy.deepcopy(Y), copy.deepcopy(Y_pred), lambda true_seq, pred_seq: equality_fn(true_seq, pred_seq)
+            )
+            self.assertEqual(counts, pairwise_counts, msg=equality_fn.__name__)
@@ -1,8 +1,12 @@
 import os
+import asyncio
 import unittest
 import time
 import shutil
+import threading
 import warnings
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
 
 # prevent excessive warning logs
 warnings.filterwarnings('ignore')
@@ -10,6 +14,7 @@ os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 
 from finetune.base_models import RoBERTa, GPT
 from finetune import Classifier
+from finetune.base import BaseModel
 from finetune.scheduler import Scheduler
 
 
@@ -79,3 +84,128 @@ class TestScheduler(unittest.TestCase):
         self.assertEqual(pred1a, pred1b)
         pred2a = shed.predict(m2, ["A"]) # Load another model.
         self.assertEqual(len(shed.loaded_models), 1)
+
+    def test_scheduler_close_busy_model(self):
+        m1 = os.path.join(self.folder, self.model1)
+        m2 = os.path.join(self.folder, self.model2)
+        shed = Scheduler(max_models=1)
+        shed.predict(m1, ["A"])
+        model = shed.model_cache[m1]
+        started, release = threading.Event(), threading.Event()
+        original_predict = model.predict
+
+        def blocking_predict(x, *args, **kwargs):
+            started.set()
+            release.wait()
+            return original_predict(x, *args, **kwargs)
+
+        model.predict = blocking_predict
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            busy = executor.submit(shed.predict, m1, ["A"])
+            started.wait()
+            evicting = executor.submit(shed.predict, m2, ["A"])
+            time.sleep(1.0)
+            # closing m1 waits for its call to finish without blocking the rest of the scheduler.
+            self.assertFalse(evicting.done())
+            self.assertEqual(list(shed.stats()["models"]), [])
+            release.set()
+            self.assertEqual(len(busy.result()), 1)
+            self.assertEqual(len(evicting.result()), 1)
+        self.assertEqual(shed.loaded_models, [m2])
+
+    def test_scheduler_share_base_weights(self):
+        m1 = os.path.join(self.folder, self.model1)
+        m1_copy = os.path.join(self.folder, "1-copy.jl")
+        shutil.copy(m1, m1_copy)
+        m2 = os.path.join(self.folder, self.model2)
+        shed = Scheduler(share_base_weights=True)
+        pred1a = shed.predict(m1, ["A"])
+        pred1b = shed.predict(m1_copy, ["A"])
+        self.assertEqual(pred1a, pred1b)
+        # the base weights are released once they are loaded into each model's session.
+        self.assertEqual(shed.fallback_cache.references(), {})
+
+        # savers that need them at the same time share a single copy, acquired again after a release.
+        base_model_path = shed.model_cache[m1].config.base_model_path
+        savers = [shed.model_cache[m1].saver, shed.model_cache[m1_copy].saver]
+        self.assertIs(savers[0].fallback, savers[1].fallback)
+        self.assertEqual(shed.fallback_cache.references(), {base_model_path: 2})
+        savers[0].release_fallback()
+        self.assertEqual(shed.fallback_cache.references(), {base_model_path: 1})
+
+        shed.predict(m2, ["A"])
+        self.assertEqual(shed.fallback_cache.references(), {base_model_path: 1})
+        shed.close_all()
+        self.assertEqual(shed.fallback_cache.references(), {})
+
+    def test_scheduler_cpu_memory_budget(self):
+        m1 = os.path.join(self.folder, self.model1)
+        m2 = os.path.join(self.folder, self.model2)
+        shed = Scheduler(cpu_memory_budget=64 * 1024 ** 3)
+        shed.predict(m1, ["A"])
+        shed.predict(m1, ["B"])
+        stats = shed.stats()
+        self.assertTrue(stats["cpu_accounting"])
+        model_stats = stats["models"][m1]
+        self.assertEqual(model_stats["calls"], 2)
+        self.assertGreater(model_stats["weight_bytes"] + model_stats["base_weight_bytes"], 0)
+        self.assertGreaterEqual(model_stats["resident_bytes"], 0)
+        self.assertGreaterEqual(model_stats["peak_predict_bytes"], 0)
+
+        # with no room left in the budget the first model is closed before loading the second.
+        shed.cpu_memory_budget = 1
+        shed.predict(m2, ["A"])
+        self.assertEqual(shed.loaded_models, [m2])
+        self.assertEqual(list(shed.stats()["models"]), [m2])
+
+    def test_scheduler_concurrent_single_flight(self):
+        m1 = os.path.join(self.folder, self.model1)
+        shed = Scheduler()
+        loads = []
+        original_load = BaseModel.load
+
+        def counting_load(*args, **kwargs):
+            loads.append(args[0])
+            return original_load(*args, **kwargs)
+
+        with patch.object(BaseModel, "load", counting_load):
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                preds = list(executor.map(lambda text: shed.predict(m1, [text]), ["A", "B"] * 4))
+        self.assertEqual(loads, [m1])
+        self.assertEqual(preds[0::2], [preds[0]] * 4)
+        self.assertEqual(preds[1::2], [preds[1]] * 4)
+
+    def test_scheduler_coalesce(self):
+        m1 = os.path.join(self.folder, self.model1)
+        shed = Scheduler(coalesce_max_wait=1.0, coalesce_max_batch=8)
+        expected = shed.predict(m1, ["A", "B"])
+        model = shed.model_cache[m1]
+        calls = []
+        original_predict = model.predict
+
+        def counting_predict(x, *args, **kwargs):
+            calls.append(len(x))
+            return original_predict(x, *args, **kwargs)
+
+        model.predict = counting_predict
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            preds = list(executor.map(lambda text: shed.predict(m1, [text]), ["A", "B"] * 4))
+        self.assertEqual(preds, [[expected[0]], [expected[1]]] * 4)
+        self.assertEqual(sum(calls), 8)
+        self.assertLess(len(calls), 8)
+
+    def test_scheduler_async(self):
+        m1 = os.path.join(self.folder, self.model1)
+        shed = Scheduler(async_max_pending=2)
+        expected = shed.predict(m1, ["A", "B"])
+
+        async def predict_all():
+            return await asyncio.gather(*[shed.apredict(m1, [text]) for text in ["A", "B"] * 3])
+
+        preds = asyncio.run(predict_all())
+        self.assertEqual(preds, [[expected[0]], [expected[1]]] * 3)
+        features = asyncio.run(shed.afeaturize(m1, ["A"]))
+        self.assertEqual(len(features), 1)
+
+        with self.assertRaises(asyncio.TimeoutError):
+            asyncio.run(shed.apredict(m1, ["A"] * 100, timeout=1e-6))
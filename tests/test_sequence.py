@@ -28,6 +28,7 @@ from finetune import SequenceLabeler
 from finetune.base_models import GPT
 from finetune.config import get_config
 from finetune.encoding.sequence_encoder import finetune_to_indico_sequence
+from finetune.encoding.target_encoders import SequenceLabelingEncoder
 from finetune.util.metrics import (
     sequence_labeling_token_precision, sequence_labeling_token_recall,
     sequence_labeling_overlap_precision, sequence_labeling_overlap_recall
@@ -264,6 +265,57 @@ class TestSequenceLabeler(unittest.TestCase):
         self.assertEqual(len(predictions[0]), 20)
         self.assertTrue(any(pred["text"].strip() == "dog" for pred in predictions[0]))
 
+    def test_predict_encodes_once(self):
+        test_sequence = ["I am a dog. A dog that's incredibly bright. I can talk, read, and write! " * 10] * 3
+        path = os.path.join(os.path.dirname(__file__), "data", "testdata.json")
+        self.model.config.chunk_long_sequences = True
+        self.model.config.max_length = 20
+
+        with open(path, "rt") as fp:
+            text, labels = json.load(fp)
+        self.model.finetune(text * 10, labels * 10)
+
+        pipeline = self.model.input_pipeline
+        text_to_ids = pipeline._text_to_ids
+        calls = []
+
+        def counting_text_to_ids(*args, **kwargs):
+            calls.append(args)
+            return text_to_ids(*args, **kwargs)
+
+        pipeline._text_to_ids = counting_text_to_ids
+        try:
+            predictions = self.model.predict(test_sequence)
+        finally:
+            del pipeline._text_to_ids
+        self.assertEqual(len(calls), len(test_sequence))
+        self.assertEqual(len(predictions), len(test_sequence))
+        self.assertTrue(any(pred["text"].strip() == "dog" for pred in predictions[0]))
+
+    def test_predict_span_assembly(self):
+        model = SequenceLabeler()
+        encoder = SequenceLabelingEncoder(pad_token=model.config.pad_token)
+        encoder.fit([[{"label": "dog"}, {"label": "cat"}]])
+        model.input_pipeline.label_encoder = encoder
+        pad, cat, dog = [encoder.classes_.index(c) for c in [model.config.pad_token, "cat", "dog"]]
+        text = "big dog and a cat"
+        probas = np.full([6, 3], 0.1, dtype=np.float32)
+        probas[[1, 2], dog] = [0.9, 0.7]
+        probas[4, cat] = 0.8
+        labels = [encoder.classes_[i] for i in [pad, dog, dog, pad, cat, pad]]
+        chunks = [
+            # start, end, start_of_doc, end_of_doc, labels, probas, useful start, useful end
+            ([0, 4, 6, 8, 14, -1], [3, 6, 7, 13, 17, -1], True, False, labels, probas, 0, 3),
+            ([0, 4, 6, 8, 14, -1], [3, 6, 7, 13, 17, -1], False, True, labels, probas, 3, 6),
+        ]
+        model.process_long_sequence = lambda *args, **kwargs: iter(chunks)
+        prediction = model._predict([{"X": text}], return_negative_confidence=True)[0]
+        self.assertEqual([(p["text"], p["label"]) for p in prediction["prediction"]], [("dog", "dog"), ("cat", "cat")])
+        self.assertEqual(prediction["prediction"][0]["confidence"]["dog"], approx(0.8))
+        # classes are ignored from their first predicted token on
+        self.assertEqual(prediction["negative_confidence"]["dog"], approx(0.1))
+        self.assertEqual(prediction["negative_confidence"]["cat"], approx(0.1))
+
     def test_fit_predict_multi_model(self):
         """
         Ensure model training does not error out
@@ -1,7 +1,7 @@
 import numpy as np
 
 from finetune.encoding.input_encoder import EncodedOutput
-from finetune.encoding.target_encoders import SequenceLabelingEncoder
+from finetune.encoding.target_encoders import SequenceLabelingEncoder, SequenceMultiLabelingEncoder
 
 def test_sequence_label_encoder():
     encoder = SequenceLabelingEncoder(pad_token="<PAD>")
@@ -70,3 +70,48 @@ def test_sequence_label_encoder_half():
     )
     label_arr = encoder.transform(out, labels)
     assert label_arr == [0, 1, 0]
+
+
+def test_sequence_label_encoder_many_labels():
+    encoder = SequenceLabelingEncoder(pad_token="<PAD>")
+    text = "fox dog " * 50
+    labels = [
+        {'start': i, 'end': i + 3, 'label': 'fox' if text[i] == "f" else 'dog', 'text': text[i: i + 3]}
+        for i in range(0, len(text), 4)
+    ]
+    encoder.fit([labels])
+    starts = np.arange(0, len(text), 4)
+    out = EncodedOutput(
+        token_ids=np.arange(len(starts) + 2),
+        tokens=np.array(['0'] + [text[s: s + 3] for s in starts] + ['2']),
+        token_ends=np.concatenate([[-1], starts + 3, [-1]]),
+        token_starts=np.concatenate([[-1], starts, [-1]]),
+        useful_start=0,
+        useful_end=512,
+        input_text=[text]
+    )
+    label_arr = encoder.transform(out, labels)
+    fox, dog, pad = encoder.lookup['fox'], encoder.lookup['dog'], encoder.lookup["<PAD>"]
+    assert label_arr == [pad] + [fox, dog] * 50 + [pad]
+
+
+def test_sequence_multi_label_encoder():
+    encoder = SequenceMultiLabelingEncoder(pad_token="<PAD>")
+    labels = [
+        {'start': 0, 'end': 12, 'label': 'a', 'text': 'five percent'},
+        {'start': 5, 'end': 17, 'label': 'b', 'text': 'percent (5%)'},
+    ]
+    encoder.fit([labels])
+    out = EncodedOutput(
+        token_ids=np.array([   0, 9583,  139,   40,  249, 8875,    2]),
+        tokens=np.array(['0', 'five', ' percent', ' (', '5', '%)', '2'], dtype='<U21'),
+        token_ends=np.array([-1,  4, 12, 14, 15, 17, -1]),
+        token_starts=np.array([-1,  0,  5, 13, 14, 15, -1]),
+        useful_start=0,
+        useful_end=512,
+        input_text=["five percent (5%)"]
+    )
+    label_arr = encoder.transform(out, labels)
+    a, b = encoder.lookup['a'], encoder.lookup['b']
+    assert [row[a] for row in label_arr] == [0, 1, 1, 0, 0, 0, 0]
+    assert [row[b] for row in label_arr] == [0, 0, 1, 1, 1, 1, 0]
@@ -3,7 +3,9 @@ import os.path
 import random
 import json
 from collections import Counter
+from types import SimpleNamespace
 import math
+import tempfile
 import pytest
 
 import numpy as np
@@ -19,13 +21,19 @@ from finetune.optimizers.gradient_accumulation import get_grad_accumulation_opti
 from finetune.util.imbalance import compute_class_weights
 from finetune.util.optimize_loss import OPTIMIZERS
 from finetune.util.timing import ProgressBar
+from finetune.util.metrics import EvalMetricsReader, read_eval_metrics
 from finetune.errors import FinetuneError
+from finetune.config import get_config
+from finetune.saver import Saver, SaverHook
+from finetune.util.mapped_weights import dump_weights, load_weights, convert_weights, is_mapped_weights
+from finetune.util.featurizer_cache import FeaturizerCache, CACHED_OUTPUTS, featurizer_cache_key
 from finetune import Classifier, SequenceLabeler
-from finetune.base_models import GPT, GPT2, BERT
+from finetune.base_models import GPT, GPT2, BERT, RoBERTa
 from finetune.base_models.gpt.encoder import GPTEncoder
 from finetune.base_models.gpt2.encoder import GPT2Encoder
 from finetune.base_models.bert.roberta_encoder import RoBERTaEncoderV2, RoBERTaEncoder, RoBERTaEncoderSlow
 from finetune.base_models.bert.encoder import BERTEncoderMultuilingal, BERTEncoder
+from finetune.base_models.bert.tokenizer import FullTokenizer
 from finetune.base_models.oscar.encoder import GPCEncoder
 
 class TestGPTEncoder(unittest.TestCase):
@@ -91,6 +99,52 @@ class TestBertEncoder(TestGPTEncoder):
 class TestOscarEncoder(TestGPTEncoder):
     Encoder = GPCEncoder
     
+class TestWordpieceTokenizer(unittest.TestCase):
+
+    vocab = ["[UNK]", "[CLS]", "[SEP]", "un", "unaff", "##aff", "##able", "##a", "##b", "a", "b", "ab", "the", "##s", ","]
+
+    def setUp(self):
+        with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False) as f:
+            f.write("\n".join(self.vocab))
+        self.tokenizer = FullTokenizer(vocab_file=f.name, do_lower_case=True)
+        os.remove(f.name)
+
+    def reference_wordpiece(self, word):
+        # greedy longest-match-first by probing the vocab with every substring.
+        pieces = []
+        start = 0
+        while start < len(word):
+            for end in range(len(word), start, -1):
+                piece = word[start:end] if start == 0 else "##" + word[start:end]
+                if piece in self.tokenizer.vocab:
+                    pieces.append(piece)
+                    break
+            else:
+                return None
+            start = end
+        return pieces
+
+    def test_tokenize_to_ids(self):
+        tokens, ids, starts, ends = self.tokenizer.tokenize_to_ids("The  unaffable abs, xyz")
+        self.assertEqual(tokens, ["the", "unaff", "##able", "ab", "##s", ",", "xyz"])
+        self.assertEqual(ids, [12, 4, 6, 11, 13, 14, 0])
+        self.assertEqual(starts, [0, 5, 10, 15, 17, 18, 20])
+        self.assertEqual(ends, [3, 10, 14, 17, 18, 19, 23])
+        self.assertEqual(self.tokenizer.tokenize("The  unaffable abs, xyz"), (tokens, starts, ends))
+
+    def test_matches_reference(self):
+        rng = random.Random(0)
+        for _ in range(500):
+            word = "".join(rng.choice("unafbles") for _ in range(rng.randint(1, 12)))
+            pieces = self.tokenizer.wordpiece_tokenizer.encode(word)
+            expected = self.reference_wordpiece(word)
+            if expected is None:
+                self.assertIsNone(pieces)
+            else:
+                self.assertEqual([piece for piece, _, _, _ in pieces], expected)
+                self.assertEqual(pieces[-1][-1], len(word))
+
+
 class TestFinetuneIndicoConverters(unittest.TestCase):
 
     def test_invalid_keyword(self):
@@ -253,6 +307,367 @@ class TestFinetuneIndicoConverters(unittest.TestCase):
         self.assertEqual(weights[1], 1.0)
 
 
+class TestParallelEncoding(unittest.TestCase):
+
+    def test_matches_serial_encoding(self):
+        model = Classifier(max_length=16, chunk_long_sequences=True)
+        docs = [{"X": "Indico is the best " * (i + 1)} for i in range(10)]
+        pipeline = model.input_pipeline
+
+        serial = list(pipeline._tokenize_documents(docs))
+        model.config.encoding_workers = 2
+        model.config.encoding_workers_min_docs = 0
+        model.config.encoding_lookahead = 3
+        parallel = list(pipeline._tokenize_documents(docs))
+        model.close()
+
+        self.assertEqual(len(serial), len(parallel))
+        for serial_feats, parallel_feats in zip(serial, parallel):
+            np.testing.assert_array_equal(serial_feats["tokens"], parallel_feats["tokens"])
+
+    def test_pool_reuse(self):
+        model = Classifier(max_length=16, encoding_workers=2, encoding_workers_min_docs=5)
+        pipeline = model.input_pipeline
+        docs = [{"X": "Indico is the best " * (i + 1)} for i in range(5)]
+
+        # too few documents, encoded in this process.
+        list(pipeline._tokenize_documents(docs[:4]))
+        self.assertIsNone(pipeline._encoding_pool)
+
+        list(pipeline._tokenize_documents(iter(docs)))
+        pool = pipeline._encoding_pool
+        list(pipeline._tokenize_documents(docs))
+        self.assertIs(pipeline._encoding_pool, pool)
+
+        # workers encoding with stale settings are replaced.
+        model.config.max_length = 32
+        list(pipeline._tokenize_documents(docs))
+        self.assertIsNot(pipeline._encoding_pool, pool)
+
+        model.close()
+        self.assertIsNone(pipeline._encoding_pool)
+
+
+class TestFeaturizerCache(unittest.TestCase):
+
+    def test_cache_roundtrip(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = FeaturizerCache(cache_dir, "base-model")
+            key = cache.example_key([1, 2, 3])
+            outputs = {
+                "features": np.random.rand(8).astype(np.float32),
+                "sequence_features": np.random.rand(3, 8).astype(np.float32),
+                "lengths": np.int32(3),
+            }
+            self.assertIsNone(cache.get(key))
+            cache.put({key: outputs})
+
+            # shards written by another instance are visible after a refresh.
+            other = FeaturizerCache(cache_dir, "base-model")
+            other_key = other.example_key([4, 5])
+            other.put({other_key: {name: value[:2] if value.ndim > 1 else value for name, value in outputs.items()}})
+            self.assertNotIn(other_key, cache)
+            cache.refresh()
+            self.assertIn(other_key, cache)
+
+            cached = cache.get(key)
+            for name in CACHED_OUTPUTS:
+                np.testing.assert_array_equal(cached[name], outputs[name])
+            self.assertIsNone(FeaturizerCache(cache_dir, "other-base-model").get(key))
+
+    def test_eviction(self):
+        def outputs(seed):
+            rng = np.random.RandomState(seed)
+            return {
+                "features": rng.rand(8).astype(np.float32),
+                "sequence_features": rng.rand(256, 8).astype(np.float32),
+                "lengths": np.int32(256),
+            }
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = FeaturizerCache(cache_dir, "base-model", max_bytes=25000)
+            keys = [cache.example_key([i]) for i in range(3)]
+            cache.put({keys[0]: outputs(0)})
+            first = cache.get(keys[0])
+            cache.put({keys[1]: outputs(1)})
+            self.assertEqual(cache.stats()["evictions"], 0)
+            os.utime(cache._entries[keys[0]], (0, 0))
+            cache.put({keys[2]: outputs(2)})
+
+            # the least recently used shard is evicted, arrays read from it stay valid.
+            self.assertEqual(cache.stats()["evictions"], 1)
+            self.assertNotIn(keys[0], cache)
+            self.assertIn(keys[2], cache)
+            self.assertLessEqual(cache.stats()["bytes"], 25000)
+            np.testing.assert_array_equal(first["sequence_features"], outputs(0)["sequence_features"])
+            self.assertNotIn(keys[0], FeaturizerCache(cache_dir, "base-model"))
+
+    def test_fit_from_cache(self):
+        X = ["this is good", "this is bad", "it was great", "it was awful"] * 5
+        Y = ["pos", "neg", "pos", "neg"] * 5
+        with tempfile.TemporaryDirectory() as cache_dir:
+            model = Classifier(
+                base_model=BERT,
+                num_layers_trained=0,
+                train_embeddings=False,
+                featurizer_cache_dir=cache_dir,
+                max_length=16,
+                n_epochs=2,
+                val_size=0,
+            )
+            model.fit(X, Y)
+            [cache_subdir] = os.listdir(cache_dir)
+            cache = FeaturizerCache(cache_dir, cache_subdir)
+            self.assertEqual(cache.stats()["entries"], 4)
+
+            # The cached features are the features the featurizer produces for prediction.
+            features = model.featurize(X[:4])
+            for text, expected in zip(X[:4], features):
+                [encoded] = model.input_pipeline._text_to_ids(text)
+                np.testing.assert_allclose(
+                    cache.get(cache.example_key(encoded.token_ids))["features"], expected, atol=1e-5
+                )
+
+            self.assertEqual(len(model.predict(X)), len(X))
+            shards = cache.stats()["shards"]
+            model.fit(X, Y)
+            cache.refresh()
+            self.assertEqual(cache.stats()["shards"], shards)
+
+    def test_key_covers_featurizer_settings(self):
+        config = get_config(base_model=BERT)
+        key = featurizer_cache_key(config, None)
+        self.assertEqual(featurizer_cache_key(get_config(base_model=BERT), None), key)
+        for setting in ["bert_use_pooler", "bert_use_type_embed"]:
+            self.assertIn(setting, BERT.featurizer_settings)
+            self.assertNotEqual(featurizer_cache_key(get_config(base_model=BERT, **{setting: True}), None), key)
+        self.assertEqual(featurizer_cache_key(get_config(base_model=BERT, n_epochs=7), None), key)
+
+
+class TestEncodingCache(unittest.TestCase):
+
+    def test_cache_roundtrip(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            model = SequenceLabeler(max_length=16, chunk_long_sequences=True, encoding_cache_dir=cache_dir)
+            pipeline = model.input_pipeline
+            text = "Indico is the best " * 10
+            expected = list(pipeline._text_to_ids(text))
+
+            first = list(pipeline._cached_text_to_ids(text))
+            second = list(pipeline._cached_text_to_ids(text))
+            self.assertEqual(pipeline.encoding_cache.stats()["misses"], 1)
+            self.assertEqual(pipeline.encoding_cache.stats()["hits"], 1)
+
+            for outputs in [first, second]:
+                self.assertEqual(len(outputs), len(expected))
+                for out, exp in zip(outputs, expected):
+                    for field in ["token_ids", "token_starts", "token_ends", "tokens"]:
+                        np.testing.assert_array_equal(getattr(out, field), getattr(exp, field))
+                    self.assertEqual(out.useful_start, exp.useful_start)
+                    self.assertEqual(out.useful_end, exp.useful_end)
+                    self.assertEqual(out.input_text, exp.input_text)
+
+            # A different max_length must not hit the same entry.
+            model.config.max_length = 32
+            list(pipeline._cached_text_to_ids(text))
+            self.assertEqual(pipeline.encoding_cache.stats()["misses"], 2)
+
+    def test_cache_eviction(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            model = SequenceLabeler(max_length=16, encoding_cache_dir=cache_dir, encoding_cache_max_bytes=4096)
+            pipeline = model.input_pipeline
+            for i in range(50):
+                list(pipeline._cached_text_to_ids("Indico is the best {}".format(i)))
+            stats = pipeline.encoding_cache.stats()
+            self.assertGreater(stats["evictions"], 0)
+            self.assertLessEqual(stats["bytes"], 4096)
+
+    def test_cache_key_includes_base_model(self):
+        class VocablessEncoder:
+            # a single encoder class for every vocab and without vocab files, like HuggingFaceEncoder.
+            def __init__(self, encoder):
+                self.encoder = encoder
+
+            def __getattr__(self, name):
+                if name in ["encoder_path", "vocab_path"]:
+                    raise AttributeError(name)
+                return getattr(self.__dict__["encoder"], name)
+
+        def token_ids(encoded):
+            return [np.asarray(out.token_ids).tolist() for out in encoded]
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            text = "Indico is the best"
+            pipelines = []
+            for base_model in [BERT, RoBERTa]:
+                model = SequenceLabeler(base_model=base_model, max_length=16, encoding_cache_dir=cache_dir)
+                pipeline = model.input_pipeline
+                pipeline._text_encoder = VocablessEncoder(pipeline.text_encoder)
+                pipelines.append(pipeline)
+            expected = [token_ids(pipeline._text_to_ids(text)) for pipeline in pipelines]
+            self.assertNotEqual(expected[0], expected[1])
+            for pipeline, exp in zip(pipelines, expected):
+                self.assertEqual(token_ids(pipeline._cached_text_to_ids(text)), exp)
+                self.assertEqual(pipeline.encoding_cache.stats()["misses"], 1)
+
+    def test_pretokenized_multi_label(self):
+        model = SequenceLabeler(max_length=16, multi_label_sequences=True)
+        pipeline = model.input_pipeline
+        text = "Indico is the best"
+        pipeline.pretokenize([text])
+        self.assertEqual(len(pipeline._pretokenized), 1)
+        feats = list(pipeline.text_to_tokens_mask(text))
+        # the encoding is consumed by the prediction rather than encoded again.
+        self.assertEqual(pipeline._pretokenized, {})
+        self.assertEqual(len(feats), 1)
+
+
+class TestSaverDiff(unittest.TestCase):
+
+    def test_remove_unchanged(self):
+        rng = np.random.RandomState(0)
+        fallback = {name: rng.randn(64, 32).astype(np.float32) for name in "abcd"}
+        fallback["e"] = fallback["a"].round()
+        variables = {
+            "a": fallback["a"].copy(),  # unchanged
+            "b": fallback["b"] + 1e-9,  # within tolerance
+            "c": fallback["c"].copy(),  # changed away from the sampled elements
+            "d": fallback["d"][:32],  # shape mismatch
+            "e": fallback["e"].astype(np.int64),  # dtype mismatch but equal
+            "f": rng.randn(4),  # not in the base model
+        }
+        variables["c"][1, 1] += 1.0
+        saver = Saver()
+        names, values = saver.remove_unchanged(variables.keys(), variables.values(), fallback)
+        self.assertEqual(names, ["c", "d", "f"])
+        for name, value in zip(names, values):
+            self.assertIs(value, variables[name])
+
+    def test_remove_unchanged_applies_transforms(self):
+        fallback = {"a": np.zeros(8)}
+        saver = Saver(variable_transforms=[lambda name, value: value + 1])
+        names, _ = saver.remove_unchanged(["a"], [np.ones(8)], fallback)
+        self.assertEqual(names, [])
+        names, _ = saver.remove_unchanged(["a"], [np.zeros(8)], fallback)
+        self.assertEqual(names, ["a"])
+
+    def test_saver_hook_writes_weights_in_background(self):
+        class Estimator:
+            def __init__(self, model_dir):
+                self.model_dir = model_dir
+
+            def eval_dir(self):
+                return os.path.join(self.model_dir, "eval")
+
+        with tempfile.TemporaryDirectory() as tmp_dir, tf.Graph().as_default():
+            tf.compat.v1.train.create_global_step()
+            var = tf.compat.v1.get_variable("a", initializer=np.arange(4, dtype=np.float32))
+            hook = SaverHook(
+                Saver(),
+                estimator=Estimator(tmp_dir),
+                keep_best_model=False,
+                early_stopping_steps=None,
+                steps_per_epoch=1,
+                eval_frequency=1,
+                cache_weights_to_file=True,
+            )
+            hook.begin()
+            with tf.compat.v1.Session() as session:
+                session.run(tf.compat.v1.global_variables_initializer())
+                hook._get_weights(session)
+                session.run(var.assign(var + 1))
+                hook.end(session)
+
+            np.testing.assert_array_equal(hook.saver.variables["a:0"], np.arange(1, 5))
+            cached = jl.load(os.path.join(tmp_dir, "weights.jl"))
+            np.testing.assert_array_equal(cached["a:0"], np.arange(1, 5))
+            self.assertEqual(os.listdir(tmp_dir), ["weights.jl"])
+
+
+class TestEvalMetricsReader(unittest.TestCase):
+
+    def test_incremental_read(self):
+        def summary(loss):
+            return tf.compat.v1.Summary(value=[tf.compat.v1.Summary.Value(tag="loss", simple_value=loss)])
+
+        with tempfile.TemporaryDirectory() as eval_dir, tf.Graph().as_default():
+            reader = EvalMetricsReader(eval_dir)
+            writer = tf.compat.v1.summary.FileWriter(eval_dir)
+            writer.add_summary(summary(2.0), global_step=10)
+            writer.flush()
+            self.assertEqual(dict(reader.read()), {10: {"loss": 2.0}})
+            offsets = dict(reader._offsets)
+
+            writer.add_summary(summary(1.0), global_step=20)
+            writer.close()
+            self.assertEqual(dict(reader.read()), {10: {"loss": 2.0}, 20: {"loss": 1.0}})
+            self.assertGreater(sum(reader._offsets.values()), sum(offsets.values()))
+            self.assertEqual(reader.read(), read_eval_metrics(eval_dir))
+
+
+class TestMappedWeights(unittest.TestCase):
+
+    def test_round_trip(self):
+        variables = {
+            "model/featurizer/we:0": np.random.randn(16, 8).astype(np.float32),
+            "global_step:0": np.int64(100),
+            "strided:0": np.arange(20)[::2],
+            "empty:0": np.zeros((0, 4), dtype=np.float16),
+        }
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "weights.bin")
+            dump_weights(variables, path, obj={"config": "value"})
+            self.assertTrue(is_mapped_weights(path))
+            loaded, obj = load_weights(path)
+            self.assertEqual(obj, {"config": "value"})
+            self.assertEqual(list(loaded.keys()), list(variables.keys()))
+            for name, value in variables.items():
+                self.assertEqual(loaded[name].dtype, np.asarray(value).dtype)
+                np.testing.assert_array_equal(loaded[name], value)
+            self.assertFalse(loaded["model/featurizer/we:0"].flags.writeable)
+
+    def test_convert_joblib(self):
+        variables = {"a:0": np.random.randn(4, 4)}
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            joblib_path = os.path.join(tmp_dir, "weights.jl")
+            path = os.path.join(tmp_dir, "weights.bin")
+            jl.dump(variables, joblib_path)
+            self.assertFalse(is_mapped_weights(joblib_path))
+            convert_weights(joblib_path, path)
+            loaded, obj = load_weights(path)
+            self.assertIsNone(obj)
+            np.testing.assert_array_equal(loaded["a:0"], variables["a:0"])
+
+    def test_overwrite_mapped_file(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, "weights.bin")
+            dump_weights({"a:0": np.zeros(1024, dtype=np.float32)}, path)
+            loaded, _ = load_weights(path)
+            dump_weights({"a:0": np.ones(16, dtype=np.float32)}, path)
+            # The mapped arrays keep reading the replaced file rather than a truncated one.
+            np.testing.assert_array_equal(loaded["a:0"], np.zeros(1024, dtype=np.float32))
+            reloaded, _ = load_weights(path)
+            np.testing.assert_array_equal(reloaded["a:0"], np.ones(16, dtype=np.float32))
+            self.assertEqual(os.listdir(tmp_dir), ["weights.bin"])
+
+    def test_saver_load_then_save_same_path(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            fallback_path = os.path.join(tmp_dir, "base.jl")
+            path = os.path.join(tmp_dir, "model.jl")
+            jl.dump({}, fallback_path)
+            for mmap_weights in [True, False]:
+                saver = Saver(fallback_filename=fallback_path, mmap_weights=mmap_weights)
+                saver.variables = {"a:0": np.arange(1024, dtype=np.float32)}
+                saver.save(SimpleNamespace(config={}), path)
+                saver = Saver(fallback_filename=fallback_path, mmap_weights=mmap_weights)
+                saver.load(path)
+                saver.save(SimpleNamespace(config={}), path)
+                np.testing.assert_array_equal(saver.variables["a:0"], np.arange(1024, dtype=np.float32))
+                saver = Saver(fallback_filename=fallback_path, mmap_weights=mmap_weights)
+                saver.load(path)
+                np.testing.assert_array_equal(saver.variables["a:0"], np.arange(1024, dtype=np.float32))
+
+
 class TestGradientAccumulation(unittest.TestCase):
 
     @tf.function
@@ -284,6 +699,33 @@ class TestGradientAccumulation(unittest.TestCase):
                 self.assertEqual(val_before - (grad_before + grad_after1) * lr, val_after2)
     
 
+    def test_gradient_accumulating_optimizer_sparse(self):
+        with tf.Graph().as_default():
+            embedding = tf.compat.v1.get_variable(
+                "embedding", initializer=np.zeros([8, 2], dtype=np.float32), use_resource=True
+            )
+            ids = tf.compat.v1.placeholder(tf.int32, [None])
+            loss = tf.reduce_sum(tf.nn.embedding_lookup(embedding, ids))
+            opt = get_grad_accumulation_optimizer(tf.compat.v1.train.GradientDescentOptimizer, 2)(1.0)
+            grads_and_vars = opt.compute_gradients(loss, [embedding])
+            self.assertIsInstance(grads_and_vars[0][0], tf.IndexedSlices)
+            train_op = opt.apply_gradients(grads_and_vars)
+            self.assertEqual(opt.accumulator_bytes, 8 * 2 * 4)
+
+            sess = tf.compat.v1.Session()
+            sess.run(tf.compat.v1.global_variables_initializer())
+            sess.run(train_op, {ids: [1, 1]})
+            np.testing.assert_array_equal(sess.run(embedding), np.zeros([8, 2]))
+            sess.run(train_op, {ids: [2]})
+            expected = np.zeros([8, 2])
+            expected[1] = -2
+            expected[2] = -1
+            np.testing.assert_array_equal(sess.run(embedding), expected)
+            sess.run(train_op, {ids: [3]})
+            sess.run(train_op, {ids: [3]})
+            expected[3] = -2
+            np.testing.assert_array_equal(sess.run(embedding), expected)
+
     @pytest.mark.xfail
     def test_gradient_accumulating_optimizer_keras(self):
         self.body_of_test_gradient_accumulating_optimizer(tf.keras.optimizers.SGD)